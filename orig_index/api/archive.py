@@ -1,23 +1,42 @@
 from fastapi.exceptions import HTTPException
+from sqlalchemy import select
 
-from ..db import Archive, Session
+from ..db import Archive, File, FileInArchive
 
 
-def api_explore_files_in_archive(hash):
-    with Session() as sess:
-        archive = sess.get(Archive, hash)
-        if not archive:
-            raise HTTPException(404)
+async def api_explore_files_in_archive(hash, session):
+    archive = await session.get(Archive, hash)
+    if not archive:
+        raise HTTPException(404)
 
-        ret = {
-            "url": archive.url,
-            "files": [
-                {
-                    "normalized_hash": fia.file.normalized_hash,
-                    "sample_name": fia.sample_name,
-                }
-                for fia in archive.files
-            ],
-        }
+    ret = {
+        "url": archive.url,
+        "files": [
+            {
+                "normalized_hash": normalized_hash,
+                "sample_name": sample_name,
+            }
+            for sample_name, normalized_hash in await session.execute(
+                select(FileInArchive.sample_name, File.normalized_hash)
+                .join(FileInArchive.file)
+                .where(FileInArchive.archive_hash == hash)
+                .order_by(FileInArchive.sample_name)
+            )
+        ],
+    }
 
-        return ret
+    return ret
+
+
+def archive_summary(archive, timestamp):
+    """
+    What the APIs say about a first-seen archive, or None if not known (which
+    is the case for things imported before that was recorded).
+    """
+    if archive is None:
+        return None
+    return {
+        "hash": archive.hash,
+        "purl": archive.purl,
+        "timestamp": timestamp,
+    }
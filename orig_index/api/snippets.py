@@ -1,18 +1,19 @@
 from fastapi.exceptions import HTTPException
 from sqlalchemy import func, select
+from sqlalchemy.orm import joinedload
 
 from ..db import (
     Archive,
     File,
     FileInArchive,
     NormalizedFile,
-    Session,
     Snippet,
     SnippetInNormalizedFile,
 )
+from .archive import archive_summary
 
 
-def api_snippet_detail(hash):
+async def api_snippet_detail(hash, session):
     """
     Returns:
     - the snippet text
@@ -22,36 +23,36 @@ def api_snippet_detail(hash):
     ret = {
         "hash": hash,
     }
-    with Session() as sess:
-        snip = sess.get(Snippet, hash)
-        if not snip:
-            raise HTTPException(404)
-        ret["text"] = snip.text
-        ret["archives"] = []
-        for cn, h, ts, c in sess.execute(
-            select(
-                Archive.canonical_name,
-                func.min(Archive.hash),
-                func.min(Archive.timestamp).label("ts"),
-                func.count(),
-            )
-            .join(File.normalized)
-            .join(File.archives)
-            .join(NormalizedFile.snippets)
-            .join(FileInArchive.archive)
-            .join(SnippetInNormalizedFile.snippet)
-            .where(Snippet.hash == hash)
-            .group_by(Archive.canonical_name)
-            .order_by("ts")
-        ):
-            ret["archives"].append(
-                {
-                    "hash": h,
-                    "purl": f"pkg:pypi/{cn}",
-                    "earliest_timestamp": ts,
-                    "count": c,
-                }
-            )
+    snip = await session.get(Snippet, hash, options=[joinedload(Snippet.first_archive)])
+    if not snip:
+        raise HTTPException(404)
+    ret["text"] = snip.text
+    ret["first_seen"] = archive_summary(snip.first_archive, snip.first_seen)
+    ret["archives"] = []
+    for cn, h, ts, c in await session.execute(
+        select(
+            Archive.canonical_name,
+            func.min(Archive.hash),
+            func.min(Archive.timestamp).label("ts"),
+            func.count(),
+        )
+        .join(File.normalized)
+        .join(File.archives)
+        .join(NormalizedFile.snippets)
+        .join(FileInArchive.archive)
+        .join(SnippetInNormalizedFile.snippet)
+        .where(Snippet.hash == hash)
+        .group_by(Archive.canonical_name)
+        .order_by("ts")
+    ):
+        ret["archives"].append(
+            {
+                "hash": h,
+                "purl": f"pkg:pypi/{cn}",
+                "earliest_timestamp": ts,
+                "count": c,
+            }
+        )
 
     return ret
 
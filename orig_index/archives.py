@@ -0,0 +1,156 @@
+"""
+Reading python files straight out of sdists and wheels.
+
+Nothing is extracted to disk, and members that aren't `.py` files are skipped
+without being read (although for compressed tarballs they still have to be
+decompressed past).
+"""
+
+import hashlib
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+from pathlib import Path, PurePosixPath
+from typing import IO, Iterable, Iterator, Union
+
+SKIP_DIR_NAMES = {".venv"}
+
+# Zips need a seekable file for their central directory, so they're buffered
+# in memory up to this size and spill to disk beyond it.
+ZIP_SPOOL_MAX = 64 * 1024 * 1024
+
+Member = tuple[PurePosixPath, bytes]
+
+
+def is_zip_name(name: str) -> bool:
+    return name.endswith((".zip", ".whl"))
+
+
+def _wanted(name: str) -> PurePosixPath | None:
+    # TODO consider pyi?
+    if not name.endswith(".py"):
+        return None
+    path = PurePosixPath(name)
+    if path.is_absolute() or ".." in path.parts:
+        return None
+    if SKIP_DIR_NAMES.intersection(path.parts[:-1]):
+        return None
+    return path
+
+
+def iter_tar_members(tf: tarfile.TarFile) -> Iterator[Member]:
+    """
+    Works on tarfiles opened in stream mode ("r|*") as well, since each member
+    is read before moving on to the next.
+    """
+    for info in tf:
+        if not info.isfile():
+            continue
+        path = _wanted(info.name)
+        if path is None:
+            continue
+        f = tf.extractfile(info)
+        assert f is not None
+        yield path, f.read()
+
+
+def iter_zip_members(zf: zipfile.ZipFile) -> Iterator[Member]:
+    for info in zf.infolist():
+        if info.is_dir():
+            continue
+        path = _wanted(info.filename)
+        if path is None:
+            continue
+        yield path, zf.read(info)
+
+
+def iter_archive_members(
+    local_file: Union[str, Path], fileobj: IO[bytes] | None = None
+) -> Iterator[Member]:
+    """
+    Yields (relative name, data) of the python files in an archive, by
+    filename.  If `fileobj` is given it's read instead of opening `local_file`
+    (which then only needs to have the right suffix).
+    """
+    name = os.fspath(local_file)
+    if is_zip_name(name):
+        with zipfile.ZipFile(fileobj or name) as zf:
+            yield from iter_zip_members(zf)
+    else:
+        with tarfile.open(name=None if fileobj else name, fileobj=fileobj) as tf:
+            yield from iter_tar_members(tf)
+
+
+def iter_local_dir(local_dir: Union[str, Path]) -> Iterable[Member]:
+    """
+    The equivalent of `iter_archive_members` for an already-extracted tree.
+    """
+    for dirpath, dirnames, filenames in os.walk(local_dir):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_DIR_NAMES]
+        for f in filenames:
+            fp = Path(dirpath, f)
+            path = _wanted(fp.relative_to(local_dir).as_posix())
+            if path is not None:
+                yield path, fp.read_bytes()
+
+
+class HashingReader(io.RawIOBase):
+    """
+    A readable, non-seekable file over an iterable of byte chunks (such as
+    `requests.Response.iter_content`) that hashes everything passing through.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+        self.hasher = hashlib.sha256()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buf:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self.hasher.update(chunk)
+            self._buf = memoryview(chunk)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def drain(self) -> str:
+        """
+        Consumes whatever the archive reader didn't need (e.g. tar padding) and
+        returns the hexdigest of the whole stream.
+        """
+        while self.read(1024 * 1024):
+            pass
+        return self.hasher.hexdigest()
+
+
+def stream_archive_members(
+    name: str, chunks: Iterable[bytes]
+) -> tuple[str, list[Member]]:
+    """
+    Reads the python files of an archive (named `name`, only the suffix
+    matters) from `chunks` as they arrive, returning the sha256 of the archive
+    and its members.
+
+    Tarballs are decompressed and read in a single pass, zips are spooled.
+    """
+    reader = HashingReader(chunks)
+    if is_zip_name(name):
+        with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX) as spool:
+            while chunk := reader.read(1024 * 1024):
+                spool.write(chunk)
+            spool.seek(0)
+            with zipfile.ZipFile(spool) as zf:
+                members = list(iter_zip_members(zf))
+    else:
+        with tarfile.open(fileobj=reader, mode="r|*") as tf:
+            members = list(iter_tar_members(tf))
+    return reader.drain(), members
@@ -0,0 +1,238 @@
+"""
+Import throughput benchmarks, run with `orig benchmark-import`.
+
+Each stage of the import path is timed on its own over a synthetic corpus (see
+`corpus.py`), so that it's clear whether model time, AST time or database time
+dominates.  The database stage runs against in-memory sqlite by default, or
+the configured postgres (in a transaction that gets rolled back).
+"""
+
+import ast
+import contextlib
+import datetime
+import hashlib
+import os
+import resource
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+import numpy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from ..db import Base, EMBEDDING_DIMENSION
+from ..embedding import EmbeddingBatcher, length_batches
+from ..importer import add_archive_members
+from ..norm import normalize
+from ..prepare import PreparedFile
+from ..split import segment, unparse_and_segment
+from .corpus import generate_corpus, Member
+
+
+@dataclass
+class StageResult:
+    name: str
+    seconds: float
+    files: int
+    snippets: int
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def snippets_per_second(self) -> float:
+        return self.snippets / self.seconds if self.seconds else 0.0
+
+
+class ZeroModel:
+    """
+    Stands in for the model in the insert stage, so that it only measures the
+    database.
+    """
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION) -> None:
+        self.dimension = dimension
+
+    def encode(self, texts, batch_size: int = 32):
+        return numpy.zeros((len(texts), self.dimension), dtype=numpy.float32)
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on mac
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class Stages:
+    def __init__(self) -> None:
+        self.results: list[StageResult] = []
+
+    def time(self, name: str, files: int, snippets: int, func: Callable[[], Any]):
+        t0 = time.perf_counter()
+        rv = func()
+        self.results.append(
+            StageResult(name, time.perf_counter() - t0, files, snippets)
+        )
+        return rv
+
+
+def run_benchmark(
+    packages: list[list[Member]],
+    model: Any,
+    session_factory: Optional[Callable[[], Any]] = None,
+) -> list[StageResult]:
+    """
+    `session_factory` returns a context manager giving a session; whatever is
+    written is rolled back.  If None, the insert stage is skipped.
+    """
+    stages = Stages()
+    datas = [data for members in packages for _, data in members]
+    n = len(datas)
+
+    hashes = stages.time(
+        "hash", n, 0, lambda: [hashlib.sha256(d).hexdigest() for d in datas]
+    )
+    mods = stages.time("parse", n, 0, lambda: [ast.parse(d) for d in datas])
+    normalized = stages.time(
+        "normalize",
+        n,
+        0,
+        lambda: [ast.unparse(normalize(m)) for m in mods],
+    )
+    # segment() expects the normalized module, not text
+    mods = [normalize(ast.parse(d)) for d in datas]
+    segments = stages.time(
+        "segment",
+        n,
+        0,
+        lambda: [[t for a, b, t in segment(m)] for m in mods],
+    )
+    n_snippets = sum(len(s) for s in segments)
+    stages.results[-1].snippets = n_snippets
+    assert len(normalized) == n
+
+    unique = {
+        hashlib.sha256(t.encode("utf-8")).hexdigest(): t for s in segments for t in s
+    }
+
+    def encode():
+        for batch in length_batches(list(unique.items())):
+            model.encode([t for _, t in batch], batch_size=len(batch))
+
+    stages.time("encode", n, len(unique), encode)
+
+    if session_factory is not None:
+        # What the earlier stages produced, so that this one is only the database
+        prepared = iter(
+            PreparedFile(
+                hash=h,
+                normalized_hash=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+                segments=s,
+            )
+            for h, text, s in zip(hashes, normalized, segments)
+        )
+        by_package = [[next(prepared) for _ in members] for members in packages]
+        stages.time(
+            "insert",
+            n,
+            n_snippets,
+            lambda: _insert(packages, by_package, session_factory),
+        )
+
+    return stages.results
+
+
+def run_normalize_benchmark(datas: list[bytes]) -> list[StageResult]:
+    """
+    Times getting from source to normalized text and segments the old way
+    (unparsing, then reparsing to find functions, then unparsing each of them)
+    against `unparse_and_segment`, and checks they agree.
+    """
+    stages = Stages()
+    n = len(datas)
+
+    def roundtrip():
+        ret = []
+        for d in datas:
+            mod = normalize(ast.parse(d))
+            ret.append((ast.unparse(mod), list(segment(mod))))
+        return ret
+
+    def single_pass():
+        return [unparse_and_segment(normalize(ast.parse(d))) for d in datas]
+
+    expected = stages.time("roundtrip", n, 0, roundtrip)
+    actual = stages.time("single", n, 0, single_pass)
+    assert actual == expected
+    n_snippets = sum(len(segments) for _, segments in actual)
+    for r in stages.results:
+        r.snippets = n_snippets
+    return stages.results
+
+
+def sqlite_session_factory() -> Callable[[], Any]:
+    """
+    An in-process stand-in for postgres.  Not representative of absolute
+    numbers, but the number of statements is the same.
+    """
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return sessionmaker(engine)
+
+
+def _insert(
+    packages: list[list[Member]],
+    prepared: list[list[PreparedFile]],
+    session_factory,
+) -> None:
+    with session_factory() as session, open(
+        os.devnull, "w"
+    ) as devnull, contextlib.redirect_stdout(devnull):
+        embedder = EmbeddingBatcher(ZeroModel)
+        for i, (members, package_prepared) in enumerate(zip(packages, prepared)):
+            add_archive_members(
+                archive_hash=f"benchmark-{i}",
+                archive_url=f"https://example.com/benchmark-{i}.tar.gz",
+                archive_date=datetime.datetime(2000, 1, 1),
+                members=members,
+                session=session,
+                project=f"benchmark-{i}",
+                version="1.0",
+                embedder=embedder,
+                prepared=package_prepared,
+            )
+        embedder.flush(session)
+        session.flush()
+        session.rollback()
+
+
+def format_report(results: list[StageResult]) -> str:
+    lines = [
+        "%-10s %10s %10s %12s" % ("stage", "seconds", "files/s", "snippets/s"),
+    ]
+    for r in results:
+        lines.append(
+            "%-10s %10.3f %10.1f %12s"
+            % (
+                r.name,
+                r.seconds,
+                r.files_per_second,
+                "%.1f" % r.snippets_per_second if r.snippets else "-",
+            )
+        )
+    lines.append("peak rss %.1f MB" % peak_rss_mb())
+    return "\n".join(lines)
+
+
+__all__ = [
+    "format_report",
+    "generate_corpus",
+    "run_benchmark",
+    "run_normalize_benchmark",
+    "sqlite_session_factory",
+    "StageResult",
+    "ZeroModel",
+]
@@ -0,0 +1,106 @@
+"""
+A deterministic synthetic corpus of python packages.
+
+The shape roughly follows what we see on PyPI: mostly small packages, a few
+large ones, some files vendored verbatim into other packages, and some that
+only differ in docstrings/annotations (so they normalize to the same thing).
+"""
+
+import random
+from pathlib import PurePosixPath
+
+Member = tuple[PurePosixPath, bytes]
+
+# (number of packages, files per package)
+DEFAULT_SHAPE = ((8, 5), (3, 40), (1, 200))
+
+NAMES = (
+    "value",
+    "item",
+    "path",
+    "config",
+    "result",
+    "data",
+    "node",
+    "key",
+    "count",
+    "buf",
+)
+
+
+def _function(r: random.Random, name: str, annotated: bool) -> str:
+    args = r.sample(NAMES, r.randint(0, 3))
+    if annotated:
+        sig = ", ".join(f"{a}: int" for a in args)
+    else:
+        sig = ", ".join(args)
+    lines = [f"def {name}({sig}):"]
+    if annotated:
+        lines.append(f'    """Docstring for {name}."""')
+    for _ in range(r.randint(1, 12)):
+        target = r.choice(NAMES)
+        op = r.choice(["+", "-", "*", "//"])
+        lines.append(f"    {target} = {r.choice(NAMES)} {op} {r.randint(0, 99)}")
+        if r.random() < 0.2:
+            lines.append(f"    if {target} > {r.randint(0, 9)}:")
+            lines.append(f"        return {target}")
+    lines.append(f"    return {r.choice(NAMES)}")
+    return "\n".join(lines) + "\n"
+
+
+def _class(r: random.Random, name: str, annotated: bool) -> str:
+    lines = [f"class {name}:"]
+    if annotated:
+        lines.append(f'    """Docstring for {name}."""')
+    for i in range(r.randint(1, 6)):
+        method = _function(r, f"method{i}", annotated)
+        method = method.replace("def method%d(" % i, "def method%d(self, " % i, 1)
+        lines.extend("    " + line for line in method.splitlines())
+    return "\n".join(lines) + "\n"
+
+
+def make_module(r: random.Random, annotated: bool = False) -> bytes:
+    parts = [f"import {m}\n" for m in r.sample(["os", "re", "sys", "json"], 2)]
+    for i in range(r.randint(1, 25)):
+        if r.random() < 0.3:
+            parts.append(_class(r, f"Class{i}", annotated))
+        else:
+            parts.append(_function(r, f"func{i}", annotated))
+        if r.random() < 0.2:
+            parts.append(f"CONSTANT_{i} = {r.randint(0, 1000)}\n")
+    return "\n\n".join(parts).encode("utf-8")
+
+
+def generate_corpus(seed: int = 0, shape=DEFAULT_SHAPE) -> list[list[Member]]:
+    """
+    Returns a list of packages, each a list of (relative name, data) like the
+    importer takes.
+    """
+    r = random.Random(seed)
+    shared: list[bytes] = []
+    seeds: list[int] = []
+    packages = []
+    for n_packages, n_files in shape:
+        for _ in range(n_packages):
+            prefix = PurePosixPath(f"pkg{len(packages)}-1.0")
+            members = []
+            for i in range(n_files):
+                roll = r.random()
+                if shared and roll < 0.1:
+                    # Vendored copy of something from an earlier package
+                    data = r.choice(shared)
+                    name = prefix / "pkg" / "_vendor" / f"mod{i}.py"
+                else:
+                    if seeds and roll < 0.2:
+                        # Same code as an earlier module, but annotated and
+                        # documented, so it normalizes the same.
+                        data = make_module(random.Random(r.choice(seeds)), True)
+                    else:
+                        seeds.append(r.getrandbits(32))
+                        data = make_module(random.Random(seeds[-1]))
+                    name = prefix / "pkg" / f"mod{i}.py"
+                    if r.random() < 0.1:
+                        shared.append(data)
+                members.append((name, data))
+            packages.append(members)
+    return packages
@@ -0,0 +1,134 @@
+"""
+Bulk reads and writes that stay within postgres' limits.
+
+A single INSERT can only carry 65535 bind parameters, which some generated
+modules exceed on their own (cdktf-cdktf-provider-aws 19.29.0 was the first we
+found), so multi-row inserts get chunked by parameter count.  Rows that don't
+need ON CONFLICT handling or RETURNING go through COPY when the driver supports
+it, or executemany otherwise.  Existence checks are IN queries chunked the same
+way.
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator, Sequence, TypeVar
+
+from sqlalchemy import select, Table
+from sqlalchemy.dialects.postgresql import insert
+
+from .metrics import METRICS
+
+T = TypeVar("T")
+
+MAX_PARAMETERS = 65535
+# Somewhat below the hard limit to keep individual statements a reasonable
+# size, the per-statement overhead is negligible by this point.
+DEFAULT_PARAMETER_BUDGET = 30000
+
+
+@dataclass
+class BulkStats:
+    rows: int = 0
+    statements: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return "%d rows in %d statements (%.0f rows/s)" % (
+            self.rows,
+            self.statements,
+            self.rows_per_second,
+        )
+
+
+STATS: dict[str, BulkStats] = {}
+
+
+def chunks(seq: Sequence[T], n: int) -> Iterator[Sequence[T]]:
+    for i in range(0, len(seq), n):
+        yield seq[i : i + n]
+
+
+def rows_per_statement(columns: int, budget: int = DEFAULT_PARAMETER_BUDGET) -> int:
+    return max(1, min(budget, MAX_PARAMETERS) // max(1, columns))
+
+
+def _record(table: Table, rows: int, statements: int, t0: float) -> None:
+    stats = STATS.setdefault(table.name, BulkStats())
+    stats.rows += rows
+    stats.statements += statements
+    stats.seconds += time.monotonic() - t0
+    METRICS.incr(f"{table.name}_rows", rows)
+
+
+def select_in(
+    session,
+    key,
+    values: Iterable[Any],
+    *columns,
+    budget: int = DEFAULT_PARAMETER_BUDGET,
+) -> list[Any]:
+    """
+    SELECT key, *columns WHERE key IN (values), in as few statements as the
+    parameter budget allows.  Returns rows (or plain values if there are no
+    extra columns).
+    """
+    unique = sorted(set(values))
+    ret: list[Any] = []
+    for chunk in chunks(unique, min(budget, MAX_PARAMETERS)):
+        result = session.execute(select(key, *columns).where(key.in_(chunk)))
+        ret.extend(result if columns else result.scalars())
+    return ret
+
+
+def insert_ignoring_conflicts(
+    session,
+    table: Table,
+    rows: Sequence[dict[str, Any]],
+    returning=None,
+    budget: int = DEFAULT_PARAMETER_BUDGET,
+) -> list[Any]:
+    """
+    INSERT ... ON CONFLICT DO NOTHING, chunked so that no statement exceeds
+    `budget` parameters.  If `returning` is a column, returns its values for
+    the rows that were actually inserted.
+    """
+    if not rows:
+        return []
+    t0 = time.monotonic()
+    n = rows_per_statement(len(rows[0]), budget)
+    ret: list[Any] = []
+    statements = 0
+    for chunk in chunks(rows, n):
+        stmt = insert(table).values(list(chunk)).on_conflict_do_nothing()
+        if returning is not None:
+            ret.extend(session.execute(stmt.returning(returning)).scalars())
+        else:
+            session.execute(stmt)
+        statements += 1
+    _record(table, len(rows), statements, t0)
+    return ret
+
+
+def copy_rows(session, table: Table, rows: Sequence[dict[str, Any]]) -> None:
+    """
+    Appends rows that are known not to conflict, using COPY on psycopg and
+    executemany on anything else.
+    """
+    if not rows:
+        return
+    t0 = time.monotonic()
+    columns = list(rows[0])
+    connection = session.connection()
+    if connection.dialect.driver == "psycopg":
+        cursor = connection.connection.driver_connection.cursor()
+        column_list = ", ".join(columns)
+        with cursor.copy(f"COPY {table.name} ({column_list}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row([row[c] for c in columns])
+    else:
+        session.execute(table.insert(), list(rows))
+    _record(table, len(rows), 1, t0)
@@ -0,0 +1,158 @@
+"""
+Progress of `import-project` runs, so that they can be resumed.
+
+For each project, the archives picked from its page (for a given
+`--shard/--of-shards`) are recorded before any are imported, and each archive
+is marked done or failed as the importer gets to it.  `import-project
+--resume` then goes straight to the archives still pending, without fetching
+project pages again or looking up archives that are already done.
+
+Checkpoints are only advisory -- the archive table is what says what's been
+imported -- so failing to write one is reported but doesn't stop the import.
+"""
+
+import datetime
+from typing import Any, Callable, Iterable, Optional
+
+from sqlalchemy import delete, select, update
+
+from . import db
+from .config import DEFAULT_ATTEMPTS
+from .db import ArchiveCheckpoint, ProjectCheckpoint
+from .retry import with_retries
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+class Checkpoints:
+    def __init__(
+        self,
+        selection: str,
+        session_factory: Optional[Callable[[], Any]] = None,
+        attempts: int = DEFAULT_ATTEMPTS,
+    ) -> None:
+        self.selection = selection
+        self.session_factory = session_factory or db.Session
+        self.attempts = attempts
+
+    def _write(self, description: str, work: Callable[[Any], None]) -> None:
+        def attempt() -> None:
+            with self.session_factory() as session:
+                work(session)
+                session.commit()
+
+        try:
+            with_retries(attempt, self.attempts, description=description)
+        except Exception as e:
+            print(f"  -> couldn't checkpoint {description}: {e!r}")
+
+    def pending(self, project: str) -> Optional[list[dict[str, Any]]]:
+        """
+        The archives of `project` that are left to import, or None if it
+        hasn't been listed (for this selection of shards).
+        """
+        with self.session_factory() as session:
+            checkpoint = session.get(ProjectCheckpoint, project)
+            if checkpoint is None or checkpoint.selection != self.selection:
+                return None
+            if checkpoint.failed is not None:
+                return []
+            return [
+                {
+                    "project": a.project,
+                    "version": a.version,
+                    "url": a.url,
+                    "hash": a.hash,
+                    "date": a.date,
+                }
+                for a in session.scalars(
+                    select(ArchiveCheckpoint).where(
+                        ArchiveCheckpoint.project == project,
+                        ArchiveCheckpoint.status == "pending",
+                    )
+                )
+            ]
+
+    def listed(self, project: str, archives: Iterable[Any]) -> None:
+        """
+        Records the archives (`ArchiveTask`s) picked for `project`, keeping
+        what's known about any that were listed before.
+        """
+        archives = list(archives)
+
+        def work(session) -> None:
+            session.merge(
+                ProjectCheckpoint(
+                    name=project, selection=self.selection, listed=_now(), failed=None
+                )
+            )
+            urls = [a.url for a in archives]
+            session.execute(
+                delete(ArchiveCheckpoint).where(
+                    ArchiveCheckpoint.project == project,
+                    ArchiveCheckpoint.status == "pending",
+                    ArchiveCheckpoint.url.not_in(urls),
+                )
+            )
+            known = set(
+                session.scalars(
+                    select(ArchiveCheckpoint.url).where(ArchiveCheckpoint.url.in_(urls))
+                )
+            )
+            session.add_all(
+                ArchiveCheckpoint(
+                    url=a.url,
+                    project=project,
+                    version=a.version,
+                    hash=a.hash,
+                    date=a.date,
+                    status="pending",
+                    attempts=0,
+                )
+                for a in archives
+                if a.url not in known
+            )
+
+        self._write(f"listing of {project}", work)
+
+    def project_failed(self, project: str, error: BaseException) -> None:
+        """
+        Gives up on the rest of `project`, e.g. after a py2-era parse error.
+        """
+
+        def work(session) -> None:
+            session.merge(
+                ProjectCheckpoint(
+                    name=project, selection=self.selection, failed=repr(error)
+                )
+            )
+
+        self._write(f"failure of {project}", work)
+
+    def archive_done(self, url: str) -> None:
+        self._update(url, "done", None)
+
+    def archive_failed(self, url: str, error: BaseException, permanent: bool) -> None:
+        """
+        A failure that's not `permanent` leaves the archive pending, so that
+        resuming tries it again.
+        """
+        self._update(url, "failed" if permanent else "pending", repr(error))
+
+    def _update(self, url: str, status: str, error: Optional[str]) -> None:
+        def work(session) -> None:
+            session.execute(
+                update(ArchiveCheckpoint)
+                .where(ArchiveCheckpoint.url == url)
+                .values(
+                    status=status,
+                    error=error,
+                    attempts=ArchiveCheckpoint.attempts + 1,
+                    updated=_now(),
+                )
+                .execution_options(synchronize_session=False)
+            )
+
+        self._write(url, work)
@@ -1,26 +1,43 @@
+import ast
 import datetime
 import hashlib
+import os
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator, TYPE_CHECKING
 
 import click
-import moreorless.click
-import uvicorn
-from packaging.utils import canonicalize_name
-from packaging.version import Version
-from pypi_simple import ACCEPT_JSON_ONLY, PyPISimple
 
-from .db import _createdb, NormalizedFile, Session, Snippet
-
-from .importer import import_archive, import_one_local_file, import_url
-from .similarity import (
-    find_archives_containing_file,
-    find_archives_containing_normalized_file,
-    find_archives_containing_similar_snippet,
+# Only what's needed to define the commands is imported up front, so that
+# `orig --help` doesn't wait on sqlalchemy, numpy, uvicorn and the rest; each
+# command imports what it uses.
+from .config import (
+    ConfigurationError,
+    DEFAULT_ATTEMPTS,
+    DEFAULT_EMBED_SOCKET,
+    DEFAULT_OVERFETCH,
+    DEFAULT_RERANK,
+    HNSW_EF_CONSTRUCTION,
+    HNSW_M,
+    QUANTIZATIONS,
+    VECTOR_QUANTIZATION,
 )
-from .util import _unpack_range, rank
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+
+class Main(click.Group):
+    def invoke(self, ctx: click.Context):
+        try:
+            return super().invoke(ctx)
+        except ConfigurationError as e:
+            # Settings are commonly wrong before anything has happened, and
+            # where that's detected (e.g. importing db.py) isn't interesting
+            raise click.ClickException(str(e)) from e
 
 
-@click.group()
+@click.group(cls=Main)
 def main():
     pass
 
@@ -32,6 +49,8 @@ def web(port: int, reload: bool):
     """
     Launch webapp
     """
+    import uvicorn
+
     uvicorn.run(
         "orig_index.web:APP",
         host="0.0.0.0",
@@ -40,115 +59,432 @@ def web(port: int, reload: bool):
     )  # nosec
 
 
+@main.command()
+@click.option("--processes", default=1, show_default=True)
+@click.option("--poll-interval", default=1.0, show_default=True)
+def worker(processes: int, poll_interval: float) -> None:
+    """
+    Run jobs queued by the webapp (imports and file identification)
+    """
+    from .jobs import run_workers
+
+    run_workers(processes, poll_interval)
+
+
+def quantization_option(f):
+    return click.option(
+        "--quantization",
+        type=click.Choice(QUANTIZATIONS),
+        default=VECTOR_QUANTIZATION,
+        show_default=True,
+        help="How the vector index stores embeddings (VECTOR_QUANTIZATION)",
+    )(f)
+
+
+def hnsw_options(f):
+    f = quantization_option(f)
+    f = click.option(
+        "--m",
+        default=HNSW_M,
+        show_default=True,
+        help="HNSW links per node; more is better recall, bigger and slower to build",
+    )(f)
+    return click.option(
+        "--ef-construction",
+        default=HNSW_EF_CONSTRUCTION,
+        show_default=True,
+        help="HNSW candidate list size while building",
+    )(f)
+
+
 @main.command()
 @click.option("--clear", is_flag=True)
-def createdb(clear: bool) -> None:
-    _createdb(clear)
+@hnsw_options
+def createdb(clear: bool, m: int, ef_construction: int, quantization: str) -> None:
+    from .db import _createdb
+
+    _createdb(clear, m, ef_construction, quantization)
+
+
+@main.command()
+def backfill_first_seen() -> None:
+    """
+    Computes the oldest archive of every normalized file and snippet, for
+    databases with imports from before that was recorded at import time.
+    """
+    from .db import _backfill_first_seen
+
+    _backfill_first_seen()
+
+
+@main.command()
+@hnsw_options
+@click.option(
+    "--maintenance-work-mem",
+    help="e.g. 8GB; the build is much faster if the graph fits in memory",
+)
+def reindex_vectors(
+    m: int, ef_construction: int, quantization: str, maintenance_work_mem: str
+) -> None:
+    """
+    Rebuilds the snippet embedding index (concurrently, so imports and lookups
+    can continue) and swaps it in.
+    """
+    from .db import create_vector_index
+
+    create_vector_index(
+        m,
+        ef_construction,
+        quantization,
+        replace=True,
+        maintenance_work_mem=maintenance_work_mem,
+    )
+
+
+def jobs_option(f):
+    return click.option(
+        "--jobs",
+        "-j",
+        default=1,
+        show_default=True,
+        help="Processes to parse, normalize and segment files in",
+    )(f)
+
+
+@contextmanager
+def executor_for(jobs: int) -> Iterator["Executor | None"]:
+    from .prepare import make_executor
+
+    executor = make_executor(jobs)
+    try:
+        yield executor
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
 
 @main.command()
 @click.option("--shard", default="0-99")
 @click.option("--of-shards", default="100")
+@jobs_option
+@click.option(
+    "--downloads",
+    default=4,
+    show_default=True,
+    help="Concurrent project page and archive downloads",
+)
+@click.option(
+    "--queue-size",
+    default=4,
+    show_default=True,
+    help="Downloaded archives that may wait to be imported",
+)
+@click.option(
+    "--stream/--no-stream",
+    default=True,
+    show_default=True,
+    help="Read python files from archives as they download, without saving them",
+)
+@click.option(
+    "--embed-server",
+    envvar="EMBED_SERVER",
+    help="Socket of an `orig embed-server` to encode with instead of loading the model",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue with the archives a previous run (with the same shards) left",
+)
+@click.option(
+    "--attempts",
+    default=DEFAULT_ATTEMPTS,
+    show_default=True,
+    help="Tries of anything failing transiently, e.g. database connections",
+)
 @click.argument("projects", nargs=-1)
-def import_project(projects: list[str], shard: str, of_shards: str) -> None:
+def import_project(
+    projects: list[str],
+    shard: str,
+    of_shards: str,
+    jobs: int,
+    downloads: int,
+    queue_size: int,
+    stream: bool,
+    embed_server: str | None,
+    resume: bool,
+    attempts: int,
+) -> None:
+    """
+    Imports archives of PROJECTS from PyPI, newest version first.  Progress is
+    checkpointed in the database, so an interrupted run can be continued with
+    --resume.
+    """
+    from .checkpoints import Checkpoints
+    from .embedding import EmbeddingBatcher
+    from .importer import get_model, in_transaction
+    from .metrics import METRICS
+    from .scheduler import ImportScheduler
+    from .util import _unpack_range
+
+    if embed_server:
+        # For get_model
+        os.environ["EMBED_SERVER"] = embed_server
     shards = _unpack_range(shard)
     total_shards = int(of_shards)
     if total_shards != len(shards):
         print("Importing %.1f%% of project" % (len(shards) * 100.0 / total_shards,))
 
-    # TODO this could use cachecontrol session
-    ps = PyPISimple(accept=ACCEPT_JSON_ONLY)
-    for project in projects:
-        cn = canonicalize_name(project)
-        pp = ps.get_project_page(cn)
-        versions = sorted(
-            {dp.version for dp in pp.packages if dp.version is not None},
-            key=Version,  # type: ignore[arg-type]
-            reverse=True,
+    # Snippets are encoded across archives (and projects) in large batches,
+    # anything left over is flushed at the end.
+    embedder = EmbeddingBatcher(get_model)
+    try:
+        with executor_for(jobs) as executor:
+            ImportScheduler(
+                embedder,
+                executor,
+                downloads=downloads,
+                queue_size=queue_size,
+                stream=stream,
+                checkpoints=Checkpoints(f"{shard}/{of_shards}", attempts=attempts),
+                resume=resume,
+                attempts=attempts,
+            ).run(projects, shards, total_shards)
+    finally:
+        in_transaction(
+            embedder.flush, embedder, attempts, description="final embeddings"
         )
-        for version in versions:
-            distribution_package = max(
-                [dp for dp in pp.packages if dp.version == version],
-                key=rank,
-            )
+        print(METRICS.summary())
+
+
+@main.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    default=DEFAULT_EMBED_SOCKET,
+    show_default=True,
+    help="Where to listen; point EMBED_SERVER here",
+)
+@click.option(
+    "--linger-ms",
+    default=5.0,
+    show_default=True,
+    help="How long to wait for more requests to batch with one to an idle model",
+)
+def embed_server(socket_path: str, linger_ms: float) -> None:
+    """
+    Load the model once and encode snippets for other orig processes on this
+    machine (e.g. several import-project runs), batching their requests.
+    """
+    import asyncio
+    import signal
+
+    from .embed_server import EmbedServer
+    from .importer import load_model
+
+    server = EmbedServer(load_model(), linger=linger_ms / 1000)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    print(f"Serving {server.model.model_id} on {socket_path}")
+    try:
+        asyncio.run(server.serve(socket_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(
+            f"{server.requests} requests, {server.texts} texts "
+            f"in {server.batches} batches"
+        )
+
+
+@main.command()
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--scale", default=1, show_default=True, help="Multiplies the number of packages"
+)
+@click.option(
+    "--model",
+    type=click.Choice(["simple", "real"]),
+    default="simple",
+    show_default=True,
+    help="SimpleModel, or whatever get_model() returns",
+)
+@click.option(
+    "--db",
+    type=click.Choice(["sqlite", "postgres", "none"]),
+    default="sqlite",
+    show_default=True,
+    help="Where to insert (and roll back) the corpus",
+)
+def benchmark_import(seed: int, scale: int, model: str, db: str) -> None:
+    """
+    Time each stage of importing a synthetic corpus.
+    """
+    from .benchmarks import format_report, run_benchmark, sqlite_session_factory
+    from .benchmarks.corpus import DEFAULT_SHAPE, generate_corpus
+    from .db import EMBEDDING_DIMENSION, Session
+    from .importer import get_model
+    from .overly_simple_embedding import SimpleModel
+
+    packages = generate_corpus(
+        seed, tuple((n * scale, files) for n, files in DEFAULT_SHAPE)
+    )
+    print(
+        "%d packages, %d files"
+        % (len(packages), sum(len(members) for members in packages))
+    )
+    if db == "sqlite":
+        session_factory = sqlite_session_factory()
+    elif db == "postgres":
+        session_factory = Session
+    else:
+        session_factory = None
+    results = run_benchmark(
+        packages,
+        SimpleModel(EMBEDDING_DIMENSION) if model == "simple" else get_model(),
+        session_factory,
+    )
+    print(format_report(results))
+
+
+@main.command()
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--scale", default=1, show_default=True, help="Multiplies the number of packages"
+)
+@click.argument("paths", nargs=-1)
+def benchmark_normalize(seed: int, scale: int, paths: tuple[str, ...]) -> None:
+    """
+    Compare normalizing and segmenting in a single pass with the old roundtrip,
+    over .py files under PATHS or else the synthetic corpus.
+    """
+    from .benchmarks import format_report, run_normalize_benchmark
+    from .benchmarks.corpus import DEFAULT_SHAPE, generate_corpus
+
+    if paths:
+        datas = []
+        for p in paths:
+            for f in sorted(Path(p).rglob("*.py")) if Path(p).is_dir() else [Path(p)]:
+                data = f.read_bytes()
+                try:
+                    ast.parse(data)
+                except (SyntaxError, ValueError):
+                    continue
+                datas.append(data)
+    else:
+        packages = generate_corpus(
+            seed, tuple((n * scale, files) for n, files in DEFAULT_SHAPE)
+        )
+        datas = [data for members in packages for _, data in members]
+    print("%d files" % len(datas))
+    print(format_report(run_normalize_benchmark(datas)))
+
+
+def open_vector_index(directory: str):
+    from .db import Snippet
+    from .vector_index import LocalVectorIndex
+
+    return LocalVectorIndex(directory, Snippet.__table__.c.embedding.type.dim)
+
+
+@main.command()
+@click.option("--train", is_flag=True, help="Recompute the IVF lists afterwards")
+@click.option("--nlist", type=int, help="IVF lists to train, default sqrt(rows)")
+@click.argument("directory", envvar="VECTOR_INDEX_DIR")
+def refresh_vector_index(directory: str, train: bool, nlist: int | None) -> None:
+    """
+    Copies embeddings of snippets that aren't in a local vector index yet into
+    it, which `lookup --vector-index` can search instead of pgvector.
+    """
+    from .db import Session
+
+    index = open_vector_index(directory)
+    with Session() as session:
+        print("Added", index.refresh(session), "snippets, now", len(index))
+    if train:
+        index.train(nlist)
+
 
-            # .filename
-            # .digests["sha256"]
-            # .url
-            # .size (only if json-fetched)
-            # .upload_time (only if json-fetched)
-            # .package_type == "wheel" for now
-            if distribution_package.package_type not in ("sdist", "wheel"):
-                continue
-
-            if (
-                int.from_bytes(
-                    hashlib.sha256(distribution_package.url.encode()).digest()
-                )
-                % total_shards
-            ) not in shards:
-                print("omit", distribution_package.url)
-                continue
-
-            try:
-                upload_time = distribution_package.upload_time
-                assert upload_time is not None
-                import_url(
-                    hash=distribution_package.digests["sha256"],
-                    url=distribution_package.url,
-                    date=upload_time,
-                    project=cn,
-                    version=version,
-                )
-            except Exception as e:
-                print("done with", project, repr(e))
-                break
+@main.command()
+def embed_missing() -> None:
+    """
+    Fill in embeddings for snippets that don't have one, e.g. after an import
+    run was interrupted before its final flush.
+    """
+    from sqlalchemy import select
+
+    from .db import Session, Snippet
+    from .embedding import EmbeddingBatcher
+    from .importer import get_model
+
+    embedder = EmbeddingBatcher(get_model)
+    with Session() as session:
+        for h, t in session.execute(
+            select(Snippet.hash, Snippet.text).where(Snippet.embedding.is_(None))
+        ):
+            embedder.add(h, t)
+        print("Encoding", len(embedder), "snippets")
+        embedder.flush(session)
+        session.commit()
 
 
 @main.command()
 @click.option("--project", required=True)
 @click.option("--version", required=True)
+@jobs_option
 @click.argument("url")
-def import_a_url(url: str, project: str, version: str):
+def import_a_url(url: str, project: str, version: str, jobs: int):
     # Does not validate project name on purpose -- this is mostly useful for
     # non-pypi projects or explicit malware that will be referred to either with
     # a PURL style name, or an illegal one starting with "-"
-    import_url(
-        hash=None,
-        url=url,
-        date=datetime.datetime(3000, 1, 1, tzinfo=datetime.UTC),
-        project=project,
-        version=version,
-    )
+    from .importer import import_url
+
+    with executor_for(jobs) as executor:
+        import_url(
+            hash=None,
+            url=url,
+            date=datetime.datetime(3000, 1, 1, tzinfo=datetime.UTC),
+            project=project,
+            version=version,
+            executor=executor,
+        )
 
 
 @main.command()
 @click.option("--project", required=True)
 @click.option("--version", required=True)
+@jobs_option
 # TODO multiple, require it exists
 @click.argument("local_file")
-def import_local_archive(local_file: str, project: str, version: str) -> None:
+def import_local_archive(
+    local_file: str, project: str, version: str, jobs: int
+) -> None:
+    from .importer import import_archive
+
     with open(local_file, "rb") as f:
         h = hashlib.sha256()
         while chunk := f.read(8192):
             h.update(chunk)
 
-    import_archive(
-        hash=h.hexdigest(),
-        url=local_file,  # TODO could also take an arg, or see if it's on files.pythonhosted.org
-        date=datetime.datetime(
-            3000, 1, 1, tzinfo=datetime.UTC
-        ),  # TODO could also use mtime?
-        local_file=local_file,
-        project=project,
-        version=version,
-    )
+    with executor_for(jobs) as executor:
+        import_archive(
+            hash=h.hexdigest(),
+            url=local_file,  # TODO could also take an arg, or see if it's on files.pythonhosted.org
+            date=datetime.datetime(
+                3000, 1, 1, tzinfo=datetime.UTC
+            ),  # TODO could also use mtime?
+            local_file=local_file,
+            project=project,
+            version=version,
+            executor=executor,
+        )
 
 
 @main.command()
 # TODO multiple, require it exists
 @click.argument("local_file")
 def import_local_file(local_file: str) -> None:
+    from .db import Session
+    from .importer import import_one_local_file
+
     with Session() as session:
         print(
             import_one_local_file(
@@ -164,45 +500,98 @@ def lookup():
 
 
 @lookup.command()
+@click.option(
+    "--ef-search",
+    type=int,
+    help="HNSW candidates per snippet query (pgvector's default is 40)",
+)
+@click.option(
+    "--overfetch",
+    default=DEFAULT_OVERFETCH,
+    show_default=True,
+    help="Nearest snippets considered per result, some won't be in any archive",
+)
+@click.option("--max-distance", type=float, help="Ignore matches further than this")
+@click.option(
+    "--vector-index",
+    envvar="VECTOR_INDEX_DIR",
+    help="Find near snippets with a local index (see refresh-vector-index)",
+)
+@quantization_option
+@click.option(
+    "--rerank",
+    default=DEFAULT_RERANK,
+    show_default=True,
+    help="Candidates from a quantized index to rerank per one wanted",
+)
 @click.argument("local_file")
-def local_file(local_file: str) -> None:
+def local_file(
+    local_file: str,
+    ef_search: int | None,
+    overfetch: int,
+    max_distance: float | None,
+    vector_index: str | None,
+    quantization: str,
+    rerank: int,
+) -> None:
+    import moreorless.click
+
+    from .db import Session
+    from .lookup import embed_snippets, find_snippet_matches, lookup_file
+    from .similarity import (
+        find_archives_containing_file,
+        find_archives_containing_normalized_file,
+    )
+
+    backend = open_vector_index(vector_index) if vector_index else None
     with Session() as session:
-        imported = import_one_local_file(Path(local_file), Path(local_file), session)
-        session.commit()
+        # Read-only, the file isn't added to the index
+        looked_up = lookup_file(Path(local_file).read_bytes(), session)
 
-        print("hash:", imported.hash)
-        print("normalized:", imported.normalized.hash)
+        print("hash:", looked_up.hash)
+        print("normalized:", looked_up.normalized_hash)
+        if looked_up.normalized_hash is None:
+            print("No python code in that file")
+            return
 
         found = False
-        for (m,) in find_archives_containing_file(imported.hash, session).all():
-            print(m.sample_name, "in", m.archive.filename, m.vendor_level)
-            found = True
+        if looked_up.known_file:
+            for (m,) in find_archives_containing_file(looked_up.hash, session).all():
+                print(m.sample_name, "in", m.archive.filename, m.vendor_level)
+                found = True
 
         if not found:
             print("No exact matches, checking near matches...")
-            for (m,) in find_archives_containing_normalized_file(
-                imported.normalized.hash, session
-            ).all():
-                print(m.sample_name, "in", m.archive.filename, m.vendor_level)
-            # find_
-            for snippet in imported.normalized.snippets:
-                print(repr(snippet.snippet.text))
-                for (
-                    m,
-                    distance,
-                    norm_snippet,
-                ) in find_archives_containing_similar_snippet(
-                    snippet.snippet, session
+            if looked_up.known_normalized:
+                for (m,) in find_archives_containing_normalized_file(
+                    looked_up.normalized_hash, session
                 ).all():
+                    print(m.sample_name, "in", m.archive.filename, m.vendor_level)
+            snippets = looked_up.snippets
+            embed_snippets(snippets, session)
+            # Verbatim copies of known snippets first, at distance 0
+            similar = find_snippet_matches(
+                snippets,
+                session,
+                ef_search=ef_search,
+                overfetch=overfetch,
+                max_distance=max_distance,
+                backend=backend,
+                quantization=quantization,
+                rerank=rerank,
+            )
+            for snippet in snippets:
+                print(repr(snippet.text))
+                for m, distance, norm_snippet in similar[snippet.hash]:
                     print(
                         m.sample_name,
                         "in",
                         m.archive.filename,
                         m.vendor_level,
                         distance,
-                    )  # , norm_snippet.snippet.text)
+                    )
                     moreorless.click.echo_color_unified_diff(
-                        snippet.snippet.text + "\n",
+                        snippet.text + "\n",
                         norm_snippet.snippet.text + "\n",
                         "",
                     )
@@ -212,6 +601,8 @@ def local_file(local_file: str) -> None:
 @lookup.command()
 @click.argument("hash")
 def normalized_hash(hash: str) -> None:
+    from .db import NormalizedFile, Session
+
     with Session() as session:
         normalized_file = session.get(NormalizedFile, hash)
         if normalized_file is None:
@@ -226,6 +617,8 @@ def normalized_hash(hash: str) -> None:
 @lookup.command()
 @click.argument("hash")
 def snippet_hash(hash: str) -> None:
+    from .db import Session, Snippet
+
     with Session() as session:
         snippet = session.get(Snippet, hash)
         assert snippet is not None
@@ -0,0 +1,46 @@
+"""
+Settings and defaults that the CLI needs just to define its options.
+
+This is kept free of heavy imports (sqlalchemy, numpy, ...) so that `orig
+--help` and the like start quickly.
+"""
+
+import os
+from pathlib import Path
+
+# Defaults for the HNSW index on snippet.embedding; see `db.create_vector_index`.
+VECTOR_INDEX_NAME = "ix_snippet"
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+
+# What the HNSW index stores: full float32 vectors ("none"), float16
+# ("halfvec", half the size) or one bit per dimension ("binary", 1/32).  The
+# table always keeps float32 embeddings, which lookups rerank candidates with,
+# so only the (much smaller) index needs to stay in memory.  Lookups have to
+# use the same setting as the index was built with.
+QUANTIZATIONS = ("none", "halfvec", "binary")
+VECTOR_QUANTIZATION = os.environ.get("VECTOR_QUANTIZATION", "none")
+
+# Candidates from a quantized index per one that's wanted, see
+# `similarity.quantized_distance`
+DEFAULT_RERANK = 4
+
+# How many more nearest snippets to fetch than results wanted, since some
+# won't be in any archive (e.g. only imported by `import-local-file`).
+DEFAULT_OVERFETCH = 4
+
+# Where `orig embed-server` listens by default (clients use EMBED_SERVER)
+DEFAULT_EMBED_SOCKET = str(Path("~/.cache/orig-index/embed.sock").expanduser())
+
+# How many times to try things that fail transiently during imports (a dropped
+# database connection, a reset download), and the first wait between tries;
+# see `retry.py`.
+DEFAULT_ATTEMPTS = 5
+DEFAULT_BACKOFF = 1.0
+
+
+class ConfigurationError(ValueError):
+    """
+    A setting is missing or wrong; the message says which one to change.  The
+    CLI reports these without a traceback.
+    """
@@ -1,18 +1,32 @@
+import threading
+from typing import Callable
+
 from pgvector.sqlalchemy import Vector
 from sqlalchemy import (
     create_engine,
     DateTime,
     ForeignKey,
+    func,
     Index,
     Integer,
+    JSON,
+    LargeBinary,
     String,
     Text,
     text,
 )
 from sqlalchemy.orm import declarative_base, mapped_column, relationship, sessionmaker
 
+from .config import HNSW_EF_CONSTRUCTION, HNSW_M, VECTOR_INDEX_NAME, VECTOR_QUANTIZATION
+from .embedding_backends import embedding_dimension
+
 Base = declarative_base()
 
+# Of snippet embeddings, from the configured backend (see `embedding_backends`).
+# The tables need it to be defined, so an unknown model without
+# EMBEDDING_DIMENSION set fails here, with a ConfigurationError saying so.
+EMBEDDING_DIMENSION = embedding_dimension()
+
 
 class Archive(Base):
     __tablename__ = "archive"
@@ -98,6 +112,11 @@ class NormalizedFile(Base):
 
     denorm_files = relationship("File", back_populates="normalized")
 
+    # Denormalized from the archives containing it, kept up to date on import
+    first_seen = mapped_column(DateTime)
+    first_archive_hash = mapped_column(String(64), ForeignKey("archive.hash"))
+    first_archive = relationship("Archive")
+
 
 class SnippetInNormalizedFile(Base):
     __tablename__ = "snippet_in_normalized_file"
@@ -130,47 +149,308 @@ class Snippet(Base):
 
     text = mapped_column(Text)
     # This should probably be denormalized further, with the model or other params as another field.
-    embedding = mapped_column(Vector(768))
+    embedding = mapped_column(Vector(EMBEDDING_DIMENSION))
     normalized_files = relationship("SnippetInNormalizedFile", back_populates="snippet")
 
-    __tableargs__ = (
+    # Denormalized from the archives containing it, kept up to date on import
+    first_seen = mapped_column(DateTime)
+    first_archive_hash = mapped_column(String(64), ForeignKey("archive.hash"))
+    first_archive = relationship("Archive")
+
+    __table_args__ = (
+        # Building this can take hours on a populated table, so rather than
+        # create_all it's `create_vector_index` that builds it (concurrently).
         Index(
-            "ix_snippet",
+            VECTOR_INDEX_NAME,
             embedding,
             postgresql_using="hnsw",
-            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_with={"m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION},
             postgresql_ops={"embedding": "vector_l2_ops"},
-        ),
+        ).ddl_if(callable_=lambda *args, **kwargs: False),
     )
 
 
-def _createdb(clear: bool) -> None:
+class Job(Base):
+    """
+    Work handed off by the webapp to `orig worker` processes, see `jobs.py`.
+    """
+
+    __tablename__ = "job"
+
+    id = mapped_column(Integer, primary_key=True)
+    kind = mapped_column(String(64), nullable=False)
+    params = mapped_column(JSON, nullable=False)
+    # e.g. an uploaded file
+    payload = mapped_column(LargeBinary)
+    # queued -> running -> done or failed
+    status = mapped_column(String(16), nullable=False, default="queued", index=True)
+    result = mapped_column(JSON)
+    error = mapped_column(Text)
+    attempts = mapped_column(Integer, nullable=False, default=0)
+    created = mapped_column(DateTime, nullable=False, server_default=func.now())
+    started = mapped_column(DateTime)
+    finished = mapped_column(DateTime)
+
+
+class ProjectCheckpoint(Base):
+    """
+    A project `import-project` has listed the archives of, so that `--resume`
+    doesn't need its page again; see `checkpoints.py`.
+    """
+
+    __tablename__ = "project_checkpoint"
+
+    name = mapped_column(String(256), primary_key=True)
+    # The --shard/--of-shards the archives were picked for
+    selection = mapped_column(String(256), nullable=False)
+    listed = mapped_column(DateTime, nullable=False, server_default=func.now())
+    # Why the rest of the project was given up on, e.g. a py2-era parse error
+    failed = mapped_column(Text)
+
+
+class ArchiveCheckpoint(Base):
+    __tablename__ = "archive_checkpoint"
+
+    url = mapped_column(String(256), primary_key=True)
+    project = mapped_column(
+        String(256), ForeignKey("project_checkpoint.name"), nullable=False, index=True
+    )
+    version = mapped_column(String(256), nullable=False)
+    # As the project page says, checked against the download
+    hash = mapped_column(String(64), nullable=False)
+    date = mapped_column(DateTime, nullable=False)
+    # pending -> done or failed
+    status = mapped_column(String(16), nullable=False, default="pending")
+    attempts = mapped_column(Integer, nullable=False, default=0)
+    error = mapped_column(Text)
+    updated = mapped_column(DateTime)
+
+
+def _createdb(
+    clear: bool,
+    m: int = HNSW_M,
+    ef_construction: int = HNSW_EF_CONSTRUCTION,
+    quantization: str = VECTOR_QUANTIZATION,
+) -> None:
     if clear:
-        Base.metadata.drop_all(engine)
+        Base.metadata.drop_all(get_engine())
     with Session() as session:
         session.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         session.commit()
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine())
+    create_vector_index(m, ef_construction, quantization)
+
+
+def _backfill_first_seen() -> None:
+    """
+    Adds the first-seen columns to a database created before they existed,
+    and fills them in from scratch.  Imports keep them current after that.
+    """
+    statements = [
+        f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}"
+        for table in ("normalized_file", "snippet")
+        for column in (
+            "first_seen TIMESTAMP WITHOUT TIME ZONE",
+            "first_archive_hash VARCHAR(64) REFERENCES archive (hash)",
+        )
+    ]
+    statements.append(
+        """
+        UPDATE normalized_file
+        SET first_seen = oldest.timestamp, first_archive_hash = oldest.archive_hash
+        FROM (
+            SELECT DISTINCT ON (file.normalized_hash)
+                file.normalized_hash, archive.hash AS archive_hash, archive.timestamp
+            FROM file
+            JOIN file_in_archive ON file_in_archive.file_hash = file.hash
+            JOIN archive ON archive.hash = file_in_archive.archive_hash
+            ORDER BY file.normalized_hash, archive.timestamp
+        ) AS oldest
+        WHERE normalized_file.hash = oldest.normalized_hash
+        """
+    )
+    # Relies on the normalized files having been done first
+    statements.append(
+        """
+        UPDATE snippet
+        SET first_seen = oldest.first_seen,
+            first_archive_hash = oldest.first_archive_hash
+        FROM (
+            SELECT DISTINCT ON (snippet_in_normalized_file.snippet_hash)
+                snippet_in_normalized_file.snippet_hash,
+                normalized_file.first_seen,
+                normalized_file.first_archive_hash
+            FROM snippet_in_normalized_file
+            JOIN normalized_file
+                ON normalized_file.hash = snippet_in_normalized_file.normalized_file_hash
+            WHERE normalized_file.first_seen IS NOT NULL
+            ORDER BY snippet_in_normalized_file.snippet_hash, normalized_file.first_seen
+        ) AS oldest
+        WHERE snippet.hash = oldest.snippet_hash
+        """
+    )
+    with Session() as session:
+        for statement in statements:
+            session.execute(text(statement))
+        session.commit()
 
 
+def vector_index_ddl(
+    name: str,
+    m: int,
+    ef_construction: int,
+    quantization: str = VECTOR_QUANTIZATION,
+) -> str:
+    dim = Snippet.__table__.c.embedding.type.dim
+    # These have to be written the same as the expressions in similarity.py
+    # for the planner to use the index.
+    if quantization == "none":
+        indexed = "embedding vector_l2_ops"
+    elif quantization == "halfvec":
+        indexed = f"(CAST(embedding AS HALFVEC({dim}))) halfvec_l2_ops"
+    elif quantization == "binary":
+        indexed = f"(CAST(binary_quantize(embedding) AS BIT({dim}))) bit_hamming_ops"
+    else:
+        raise ValueError(f"Unknown quantization {quantization!r}")
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON snippet "
+        f"USING hnsw ({indexed}) "
+        f"WITH (m = {int(m)}, ef_construction = {int(ef_construction)})"
+    )
+
+
+def create_vector_index(
+    m: int = HNSW_M,
+    ef_construction: int = HNSW_EF_CONSTRUCTION,
+    quantization: str = VECTOR_QUANTIZATION,
+    replace: bool = False,
+    maintenance_work_mem: str | None = None,
+    progress: Callable[[str], None] | None = print,
+    poll_interval: float = 10.0,
+) -> None:
+    """
+    Builds the HNSW index on snippet.embedding without blocking imports, if it
+    doesn't exist yet -- or with `replace`, builds a new one alongside and
+    swaps it in, which is how to change `m`/`ef_construction`/`quantization`.
+
+    While the build runs, `progress` is called with lines from
+    pg_stat_progress_create_index every `poll_interval` seconds.
+    """
+    name = f"{VECTOR_INDEX_NAME}_new" if replace else VECTOR_INDEX_NAME
+    # CONCURRENTLY can't run inside a transaction
+    autocommit = get_engine().execution_options(isolation_level="AUTOCOMMIT")
+    errors: list[BaseException] = []
+
+    def build() -> None:
+        try:
+            with autocommit.connect() as conn:
+                if maintenance_work_mem:
+                    conn.execute(
+                        text("SELECT set_config('maintenance_work_mem', :v, false)"),
+                        {"v": maintenance_work_mem},
+                    )
+                if replace:
+                    # Left invalid by an earlier build that was interrupted
+                    conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+                conn.execute(
+                    text(vector_index_ddl(name, m, ef_construction, quantization))
+                )
+        except BaseException as e:
+            errors.append(e)
+
+    t = threading.Thread(target=build, daemon=True)
+    t.start()
+    with autocommit.connect() as conn:
+        while True:
+            t.join(poll_interval)
+            if not t.is_alive():
+                break
+            if progress is None:
+                continue
+            for row in conn.execute(
+                text(
+                    "SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total"
+                    " FROM pg_stat_progress_create_index"
+                    " WHERE relid = 'snippet'::regclass"
+                )
+            ):
+                progress(
+                    f"{name}: {row.phase} "
+                    f"blocks {row.blocks_done}/{row.blocks_total} "
+                    f"tuples {row.tuples_done}/{row.tuples_total}"
+                )
+    if errors:
+        raise errors[0]
+
+    if replace:
+        with get_engine().begin() as conn:
+            conn.execute(text(f"DROP INDEX IF EXISTS {VECTOR_INDEX_NAME}"))
+            conn.execute(text(f"ALTER INDEX {name} RENAME TO {VECTOR_INDEX_NAME}"))
+    if progress is not None:
+        progress(
+            f"{VECTOR_INDEX_NAME}: done (m={m}, ef_construction={ef_construction}, "
+            f"quantization={quantization})"
+        )
+
+
+# Created on first use rather than at import, so that commands (and modules)
+# that never touch the database don't pay for connecting to it.
 engine = None
-Session = None
+_sessionmaker = None
+# For the webapp, which shares one pool of connections between requests
+async_engine = None
+_async_sessionmaker = None
+_engine_lock = threading.Lock()
 
 
 def recreate_engine():
     global engine
-    global Session
+    global _sessionmaker
+    global async_engine
+    global _async_sessionmaker
     try:
         import local_conf
     except ImportError:
         print("You probably need to adjust PYTHONPATH to have local_conf.py dir")
         return
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
     engine = create_engine(
         local_conf.CONNECTION_STRING,
         # echo=True,
         future=True,
     )
-    Session = sessionmaker(engine)
+    _sessionmaker = sessionmaker(engine)
+    # psycopg (3) does async with the same connection string
+    async_engine = create_async_engine(
+        local_conf.CONNECTION_STRING,
+        pool_size=getattr(local_conf, "POOL_SIZE", 10),
+        max_overflow=getattr(local_conf, "POOL_MAX_OVERFLOW", 10),
+        pool_pre_ping=True,
+    )
+    # Nothing is used after commit in a request, and lazy loading can't happen
+    # in async code anyway.
+    _async_sessionmaker = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+def get_engine():
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                recreate_engine()
+        if engine is None:
+            raise RuntimeError("No database configured, see local_conf.py")
+    return engine
+
+
+def Session(**kwargs):
+    """
+    A new session, as from a `sessionmaker` (which this used to be).
+    """
+    get_engine()
+    return _sessionmaker(**kwargs)
 
 
-recreate_engine()
+def AsyncSession(**kwargs):
+    get_engine()
+    return _async_sessionmaker(**kwargs)
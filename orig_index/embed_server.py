@@ -0,0 +1,238 @@
+"""
+One warm model for many processes.
+
+`orig embed-server` loads the model once and encodes for any number of local
+clients (import runs, job workers, the webapp) over a Unix socket.  Requests
+that arrive while the model is busy are coalesced and re-split by length (see
+`embedding.length_batches`), so several importers sharing a server get larger
+and better-packed batches than each would alone, without each paying seconds
+and a GB of memory to load its own copy.
+
+Use it by pointing `EMBED_SERVER` (or `import-project --embed-server`) at the
+socket; `get_model` then returns an `EmbedClient`.
+
+The protocol is frames of a 4-byte big-endian length and a body.  A request is
+one JSON frame, `{"texts": [...]}` (with no texts to ask which model this is),
+and the response a JSON frame `{"model_id", "dimension", "rows"}` (or
+`{"error"}`) followed by a frame of rows * dimension native float32.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy
+
+from .embedding import DEFAULT_CHAR_BUDGET, DEFAULT_MAX_BATCH, length_batches
+
+# How long to wait for more requests to coalesce with one that arrives while
+# the model is idle.  Those arriving while it's busy wait for it anyway.
+DEFAULT_LINGER = 0.005
+
+_LENGTH = struct.Struct("!I")
+
+
+def _frame(body: bytes) -> bytes:
+    return _LENGTH.pack(len(body)) + body
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> bytes:
+    (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return await reader.readexactly(length)
+
+
+class EmbedServer:
+    def __init__(
+        self,
+        model: Any,
+        max_batch: int = DEFAULT_MAX_BATCH,
+        char_budget: int = DEFAULT_CHAR_BUDGET,
+        linger: float = DEFAULT_LINGER,
+    ) -> None:
+        self.model = model
+        self.max_batch = max_batch
+        self.char_budget = char_budget
+        self.linger = linger
+        # The model runs here, one batch at a time, so the event loop stays
+        # free to accept (and queue up) more requests meanwhile.
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="encode")
+        self._pending: list[tuple[list[str], asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._connections: set[asyncio.Task] = set()
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+
+    async def encode(self, texts: list[str]) -> numpy.ndarray:
+        assert self._wakeup is not None
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((texts, future))
+        self._wakeup.set()
+        return await future
+
+    async def _encode_pending(self) -> None:
+        assert self._wakeup is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.linger)
+            self._wakeup.clear()
+            requests, self._pending = self._pending, []
+
+            items = [(i, t) for i, t in enumerate(t for r, _ in requests for t in r)]
+            out = numpy.zeros((len(items), self.model.dimension), dtype=numpy.float32)
+            try:
+                for batch in length_batches(items, self.max_batch, self.char_budget):
+                    out[[i for i, _ in batch]] = await loop.run_in_executor(
+                        self._executor,
+                        self.model.encode,
+                        [t for _, t in batch],
+                        len(batch),
+                    )
+                    self.batches += 1
+            except Exception as e:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            start = 0
+            for texts, future in requests:
+                if not future.done():
+                    future.set_result(out[start : start + len(texts)])
+                start += len(texts)
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    request = json.loads(await _read_frame(reader))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                texts = request.get("texts", [])
+                self.requests += 1
+                self.texts += len(texts)
+                try:
+                    embeddings = await self.encode(texts) if texts else None
+                except Exception as e:
+                    header = {"error": f"{type(e).__name__}: {e}"}
+                    data = b""
+                else:
+                    header = {
+                        "model_id": self.model.model_id,
+                        "dimension": self.model.dimension,
+                        "rows": len(texts),
+                    }
+                    data = b"" if embeddings is None else embeddings.tobytes()
+                writer.write(_frame(json.dumps(header).encode()) + _frame(data))
+                await writer.drain()
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def serve(
+        self, path: Union[str, Path], started: Optional[threading.Event] = None
+    ) -> None:
+        """
+        Serves on the socket at `path` until `stop` is called.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stop = asyncio.Event()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A previous server that didn't get to clean up
+        path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self._handle, path)
+        os.chmod(path, 0o600)
+        encoder = asyncio.create_task(self._encode_pending())
+        if started is not None:
+            started.set()
+        try:
+            async with server:
+                await self._stop.wait()
+                # Clients that are still connected get disconnected
+                for connection in list(self._connections):
+                    connection.cancel()
+                await asyncio.gather(*self._connections, return_exceptions=True)
+        finally:
+            encoder.cancel()
+            path.unlink(missing_ok=True)
+            self._executor.shutdown()
+
+    def stop(self) -> None:
+        """
+        Can be called from any thread.
+        """
+        if self._loop is not None and self._stop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+
+class EmbedClient:
+    """
+    A model (as far as `EmbeddingBatcher` and friends are concerned) that asks
+    an `EmbedServer` to do the encoding.  Safe to share between threads.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+        self._file = self._sock.makefile("rb")
+        header, _ = self._request([])
+        self.model_id = header["model_id"]
+        self.dimension = header["dimension"]
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+    def _read_exactly(self, n: int) -> bytes:
+        data = self._file.read(n)
+        if len(data) != n:
+            raise ConnectionError(f"embed server at {self.path} went away")
+        return data
+
+    def _read_frame(self) -> bytes:
+        (length,) = _LENGTH.unpack(self._read_exactly(_LENGTH.size))
+        return self._read_exactly(length)
+
+    def _request(self, texts: list[str]) -> tuple[dict[str, Any], bytes]:
+        with self._lock:
+            self._sock.sendall(_frame(json.dumps({"texts": texts}).encode()))
+            header = json.loads(self._read_frame())
+            data = self._read_frame()
+        if "error" in header:
+            raise RuntimeError(f"embed server: {header['error']}")
+        return header, data
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(
+        self, texts_or_text: Union[Sequence[str], str], batch_size: int = 32
+    ) -> numpy.ndarray:
+        if isinstance(texts_or_text, str):
+            return self.encode([texts_or_text])[0]
+        if not texts_or_text:
+            return numpy.zeros((0, self.dimension), dtype=numpy.float32)
+        header, data = self._request(list(texts_or_text))
+        return (
+            numpy.frombuffer(data, dtype=numpy.float32)
+            .reshape(header["rows"], self.dimension)
+            .copy()
+        )
@@ -0,0 +1,108 @@
+"""
+Batching of snippet embeddings.
+
+Most files only contribute a handful of new snippets, so encoding them one file
+at a time leaves the model (and its thread pool) mostly idle.  Instead the
+importer queues new snippets here, possibly across many files and archives, and
+they get encoded together in batches of similar length before the embeddings
+are written back with one bulk UPDATE per batch.
+"""
+
+from typing import Any, Callable, Iterator, Sequence
+
+from sqlalchemy import update
+
+from .db import Snippet
+from .metrics import METRICS
+
+# Roughly the number of characters (of all texts combined, after padding to
+# the longest one) that we're willing to put into a single forward pass.  Long
+# snippets get small batches, short ones get large batches.
+DEFAULT_CHAR_BUDGET = 64 * 1024
+DEFAULT_MAX_BATCH = 256
+DEFAULT_FLUSH_THRESHOLD = 2048
+
+
+def length_batches(
+    items: Sequence[tuple[str, str]],
+    max_batch: int = DEFAULT_MAX_BATCH,
+    char_budget: int = DEFAULT_CHAR_BUDGET,
+) -> Iterator[list[tuple[str, str]]]:
+    """
+    Given (hash, text) pairs, yields lists of them sorted by text length such
+    that `len(batch) * longest_text` stays within `char_budget`.
+
+    A single text longer than the budget still gets a batch of its own.
+    """
+    batch: list[tuple[str, str]] = []
+    for item in sorted(items, key=lambda i: len(i[1])):
+        longest = len(item[1])
+        if batch and (
+            len(batch) >= max_batch or (len(batch) + 1) * longest > char_budget
+        ):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+class EmbeddingBatcher:
+    """
+    Collects (hash, text) of snippets that have been inserted without an
+    embedding, and fills them in on `flush`.
+
+    The snippet rows must already exist (in the database, or at least flushed
+    in the session passed to `flush`).
+    """
+
+    def __init__(
+        self,
+        model_factory: Callable[[], Any],
+        max_batch: int = DEFAULT_MAX_BATCH,
+        char_budget: int = DEFAULT_CHAR_BUDGET,
+        flush_threshold: int = DEFAULT_FLUSH_THRESHOLD,
+    ) -> None:
+        self.model_factory = model_factory
+        self.max_batch = max_batch
+        self.char_budget = char_budget
+        self.flush_threshold = flush_threshold
+        self.pending: dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(self, hash: str, text: str) -> None:
+        self.pending.setdefault(hash, text)
+
+    def should_flush(self) -> bool:
+        return len(self.pending) >= self.flush_threshold
+
+    def flush(self, session) -> int:
+        """
+        Encodes everything pending and writes it back using `session` (which
+        the caller commits).  Returns the number of snippets updated.
+        """
+        if not self.pending:
+            return 0
+
+        model = self.model_factory()
+        count = 0
+        for batch in length_batches(
+            list(self.pending.items()), self.max_batch, self.char_budget
+        ):
+            with METRICS.timer("encode"):
+                embeddings = model.encode(
+                    [text for _, text in batch], batch_size=len(batch)
+                )
+            with METRICS.timer("insert"):
+                session.execute(
+                    update(Snippet),
+                    [
+                        {"hash": h, "embedding": e}
+                        for (h, _), e in zip(batch, embeddings)
+                    ],
+                )
+            count += len(batch)
+        self.pending.clear()
+        return count
@@ -0,0 +1,150 @@
+"""
+Where snippet embeddings come from.
+
+A backend encodes a batch of texts to a float32 matrix, and says how many
+dimensions that has and which model it is (for `embedding_cache.py`, which
+must never mix up vectors of different models).  `EMBEDDING_BACKEND` picks one:
+
+- "sentence-transformers" (default): `MODEL_NAME` with PyTorch.
+- "onnx": the same model exported to ONNX and dynamically quantized to int8
+  weights, run with ONNX Runtime.  The export is done once, into
+  `ONNX_EXPORT_DIR`.  Embeddings are close to but not the same as the float
+  ones, so don't mix the two in one database.
+- "simple": `overly_simple_embedding.SimpleModel`, no model at all.
+
+The snippet embedding column's dimension is `EMBEDDING_DIMENSION`, which
+defaults to what's known about the configured model so that nothing needs to
+be loaded just to define the tables; `get_model` checks the backend agrees.
+
+Nothing heavy is imported until a backend is made.
+"""
+
+import os
+import re
+from pathlib import Path
+from typing import Any, Optional, Protocol, Sequence, TYPE_CHECKING, Union
+
+from .config import ConfigurationError
+
+if TYPE_CHECKING:
+    import numpy
+
+DEFAULT_MODEL_NAME = "flax-sentence-embeddings/st-codesearch-distilroberta-base"
+BACKENDS = ("sentence-transformers", "onnx", "simple")
+# MODEL_NAME that selects the simple backend, as EMBEDDING_BACKEND=simple does
+SIMPLE_MODEL_NAME = "simple"
+SIMPLE_DIMENSION = 768
+# So that EMBEDDING_DIMENSION rarely needs to be set by hand
+KNOWN_DIMENSIONS = {
+    DEFAULT_MODEL_NAME: 768,
+    "sentence-transformers/all-MiniLM-L6-v2": 384,
+    "sentence-transformers/all-mpnet-base-v2": 768,
+}
+DEFAULT_ONNX_EXPORT_DIR = Path("~/.cache/orig-index/onnx").expanduser()
+# Which of onnxruntime's dynamic quantization configs to use (see
+# `sentence_transformers.export_dynamic_quantized_onnx_model`)
+DEFAULT_ONNX_QUANTIZATION = "avx2"
+
+
+class EmbeddingBackend(Protocol):
+    model_id: str
+    dimension: int
+
+    def encode(
+        self, texts_or_text: Union[Sequence[str], str], batch_size: int = 32
+    ) -> "numpy.ndarray": ...
+
+
+def backend_name() -> str:
+    if os.environ.get("MODEL_NAME") == SIMPLE_MODEL_NAME:
+        return "simple"
+    name = os.environ.get("EMBEDDING_BACKEND", "sentence-transformers")
+    if name not in BACKENDS:
+        raise ConfigurationError(
+            f"Unknown EMBEDDING_BACKEND {name!r}, expected {BACKENDS}"
+        )
+    return name
+
+
+def model_name() -> str:
+    return os.environ.get("MODEL_NAME", DEFAULT_MODEL_NAME)
+
+
+def embedding_dimension() -> int:
+    if "EMBEDDING_DIMENSION" in os.environ:
+        return int(os.environ["EMBEDDING_DIMENSION"])
+    if backend_name() == "simple":
+        return SIMPLE_DIMENSION
+    try:
+        return KNOWN_DIMENSIONS[model_name()]
+    except KeyError:
+        raise ConfigurationError(
+            f"Don't know the embedding dimension of MODEL_NAME={model_name()!r}; "
+            "set EMBEDDING_DIMENSION to the size of its embeddings"
+        ) from None
+
+
+class SentenceTransformerBackend:
+    def __init__(self, name: str, **kwargs: Any) -> None:
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(name, **kwargs)
+        self.model_id = name
+        self.dimension = self.model.get_sentence_embedding_dimension()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+    def encode(
+        self, texts_or_text: Union[Sequence[str], str], batch_size: int = 32
+    ) -> "numpy.ndarray":
+        import numpy
+
+        return numpy.asarray(
+            self.model.encode(texts_or_text, batch_size=batch_size),
+            dtype=numpy.float32,
+        )
+
+
+class OnnxBackend(SentenceTransformerBackend):
+    def __init__(
+        self,
+        name: str,
+        export_dir: Union[str, Path] = DEFAULT_ONNX_EXPORT_DIR,
+        quantization: str = DEFAULT_ONNX_QUANTIZATION,
+    ) -> None:
+        path = Path(export_dir, re.sub(r"[^\w.-]+", "_", name))
+        file_name = f"onnx/model_qint8_{quantization}.onnx"
+        if not (path / file_name).exists():
+            _export_quantized(name, path, quantization)
+        super().__init__(
+            str(path), backend="onnx", model_kwargs={"file_name": file_name}
+        )
+        self.model_id = f"{name}:onnx-qint8"
+
+
+def _export_quantized(name: str, path: Path, quantization: str) -> None:
+    from sentence_transformers import (
+        export_dynamic_quantized_onnx_model,
+        SentenceTransformer,
+    )
+
+    # Loading with the onnx backend exports onnx/model.onnx if there isn't one
+    model = SentenceTransformer(name, backend="onnx")
+    model.save_pretrained(str(path))
+    export_dynamic_quantized_onnx_model(model, quantization, str(path))
+
+
+def make_backend(name: Optional[str] = None) -> EmbeddingBackend:
+    name = name or backend_name()
+    if name == "simple":
+        from .overly_simple_embedding import SimpleModel
+
+        return SimpleModel(embedding_dimension())
+    if name == "onnx":
+        return OnnxBackend(
+            model_name(),
+            os.environ.get("ONNX_EXPORT_DIR", DEFAULT_ONNX_EXPORT_DIR),
+            os.environ.get("ONNX_QUANTIZATION", DEFAULT_ONNX_QUANTIZATION),
+        )
+    return SentenceTransformerBackend(model_name())
@@ -0,0 +1,243 @@
+"""
+A local, persistent cache of embeddings keyed by (model name, sha256 of text).
+
+Vectors live in a memory-mapped float32 file of fixed capacity, and a small
+sqlite database maps keys to rows of it.  When full, the least recently used
+rows are reused.  Because the key is the same as `Snippet.hash`, this survives
+`createdb --clear` and makes a subsequent reindex skip the model for anything
+seen before.
+
+Enable for the importer by setting `EMBEDDING_CACHE_DIR` (and optionally
+`EMBEDDING_CACHE_SIZE`, the number of vectors per model).  Several processes
+can share one directory: every write takes sqlite's write lock before reading
+anything it depends on, so they never hand out the same slot.
+"""
+
+import contextlib
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Sequence, Union
+
+import numpy
+
+DEFAULT_CAPACITY = 1_000_000
+# How many rows to free at once when full, as a fraction of capacity
+EVICT_FRACTION = 0.05
+# Seconds to wait for another process's write transaction to finish
+BUSY_TIMEOUT = 60.0
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        model_name: str,
+        dimension: int,
+        capacity: int = DEFAULT_CAPACITY,
+    ) -> None:
+        self.path = Path(directory, re.sub(r"[^\w.-]+", "_", model_name))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.dimension = dimension
+        self._lock = threading.Lock()
+
+        # Transactions are begun explicitly, see `_write`
+        self.db = sqlite3.connect(
+            self.path / "index.sqlite",
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=BUSY_TIMEOUT,
+        )
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS entry (
+                key TEXT PRIMARY KEY,
+                slot INTEGER NOT NULL UNIQUE,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entry_last_used ON entry (last_used);
+            CREATE TABLE IF NOT EXISTS free_slot (slot INTEGER PRIMARY KEY);
+            """
+        )
+        with self._write():
+            meta = dict(self.db.execute("SELECT key, value FROM meta"))
+            if not meta:
+                meta = {
+                    "model_name": model_name,
+                    "dimension": str(dimension),
+                    "capacity": str(capacity),
+                    "high_water": "0",
+                }
+                self.db.executemany("INSERT INTO meta VALUES (?, ?)", meta.items())
+        # An existing cache keeps its shape, regardless of what was asked for
+        if int(meta["dimension"]) != dimension:
+            raise ValueError(
+                f"Cache at {self.path} has dimension {meta['dimension']}, "
+                f"not {dimension}"
+            )
+        self.capacity = int(meta["capacity"])
+
+        vectors_path = self.path / "vectors.f32"
+        self.vectors = numpy.memmap(
+            vectors_path,
+            dtype=numpy.float32,
+            mode="r+" if vectors_path.exists() else "w+",
+            shape=(self.capacity, dimension),
+        )
+
+    @contextlib.contextmanager
+    def _write(self):
+        """
+        A transaction that holds the write lock from the start (rather than
+        from its first write, as a plain BEGIN would), committed on success.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        with self.db:
+            yield
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+
+    def _slots(self, keys: Sequence[str]) -> dict[str, int]:
+        slots: dict[str, int] = {}
+        unique = list(set(keys))
+        # sqlite's default limit on parameters is 32766
+        for i in range(0, len(unique), 10000):
+            chunk = unique[i : i + 10000]
+            placeholders = ",".join("?" * len(chunk))
+            slots.update(
+                self.db.execute(
+                    f"SELECT key, slot FROM entry WHERE key IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return slots
+
+    def get_many(self, keys: Sequence[str]) -> dict[str, numpy.ndarray]:
+        with self._lock:
+            slots = self._slots(keys)
+            if slots:
+                now = time.time()
+                with self._write():
+                    self.db.executemany(
+                        "UPDATE entry SET last_used = ? WHERE key = ?",
+                        [(now, k) for k in slots],
+                    )
+            return {k: numpy.array(self.vectors[slot]) for k, slot in slots.items()}
+
+    def put_many(self, keys: Sequence[str], vectors: Any) -> None:
+        with self._lock:
+            new = dict(zip(keys, vectors))
+            existing = self._slots(list(new))
+            pending = [(k, v) for k, v in new.items() if k not in existing]
+            # Never try to hold more than capacity from one call
+            pending = pending[-self.capacity :]
+            if not pending:
+                return
+            slots = self._allocate(len(pending))
+            for (_, v), slot in zip(pending, slots):
+                self.vectors[slot] = v
+            self.vectors.flush()
+            now = time.time()
+            with self._write():
+                # Another process may have cached some of the same keys since,
+                # in which case the slots written here go back to be reused
+                raced = self._slots([k for k, _ in pending])
+                self.db.executemany(
+                    "INSERT INTO entry (key, slot, last_used) VALUES (?, ?, ?)",
+                    [
+                        (k, slot, now)
+                        for (k, _), slot in zip(pending, slots)
+                        if k not in raced
+                    ],
+                )
+                self.db.executemany(
+                    "INSERT INTO free_slot VALUES (?)",
+                    [(slot,) for (k, _), slot in zip(pending, slots) if k in raced],
+                )
+
+    def _allocate(self, n: int) -> list[int]:
+        """
+        Returns `n` unused slots: previously evicted ones first, then ones that
+        have never been used, and finally evicting the least recently used.
+        """
+        with self._write():
+            slots = [
+                slot
+                for (slot,) in self.db.execute(
+                    "SELECT slot FROM free_slot LIMIT ?", (n,)
+                )
+            ]
+            self.db.executemany(
+                "DELETE FROM free_slot WHERE slot = ?", [(s,) for s in slots]
+            )
+
+            (high_water,) = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'high_water'"
+            ).fetchone()
+            high_water = int(high_water)
+            fresh = min(n - len(slots), self.capacity - high_water)
+            slots.extend(range(high_water, high_water + fresh))
+            self.db.execute(
+                "UPDATE meta SET value = ? WHERE key = 'high_water'",
+                (str(high_water + fresh),),
+            )
+
+            if len(slots) < n:
+                # Evict a bit more than needed so this doesn't happen every call
+                evict = max(n - len(slots), int(self.capacity * EVICT_FRACTION))
+                rows = self.db.execute(
+                    "SELECT key, slot FROM entry ORDER BY last_used LIMIT ?",
+                    (evict,),
+                ).fetchall()
+                self.db.executemany(
+                    "DELETE FROM entry WHERE key = ?", [(k,) for k, _ in rows]
+                )
+                evicted = [slot for _, slot in rows]
+                needed = n - len(slots)
+                slots.extend(evicted[:needed])
+                self.db.executemany(
+                    "INSERT INTO free_slot VALUES (?)",
+                    [(s,) for s in evicted[needed:]],
+                )
+        return slots
+
+
+class CachedModel:
+    """
+    Wraps something with a SentenceTransformer-like `encode` so that only
+    texts missing from `cache` reach it.
+    """
+
+    def __init__(self, model: Any, cache: EmbeddingCache) -> None:
+        self.model = model
+        self.cache = cache
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.model, name)
+
+    def encode(self, texts_or_text: Union[Sequence[str], str], **kwargs: Any):
+        if isinstance(texts_or_text, str):
+            return self.encode([texts_or_text], **kwargs)[0]
+
+        keys = [text_key(t) for t in texts_or_text]
+        found = self.cache.get_many(keys)
+        missing = {k: t for k, t in zip(keys, texts_or_text) if k not in found}
+        if missing:
+            encoded = self.model.encode(list(missing.values()), **kwargs)
+            self.cache.put_many(list(missing), encoded)
+            found.update(zip(missing, encoded))
+
+        ret = numpy.zeros((len(keys), self.cache.dimension), dtype=numpy.float32)
+        for i, k in enumerate(keys):
+            ret[i] = found[k]
+        return ret
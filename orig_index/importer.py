@@ -1,17 +1,34 @@
-import ast
 import datetime
 import hashlib
 import os
 import shutil
 import tempfile
-from pathlib import Path
-from typing import IO
+from concurrent.futures import Executor
+from pathlib import Path, PurePath
+from typing import Any, Callable, IO, Sequence, TypeVar
 
 import requests
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import or_, select, update
 
+from .archives import (
+    is_zip_name,
+    iter_archive_members,
+    iter_local_dir,
+    stream_archive_members,
+)
+
+from .bulk import (
+    chunks,
+    copy_rows,
+    DEFAULT_PARAMETER_BUDGET,
+    insert_ignoring_conflicts,
+    select_in,
+    STATS as BULK_STATS,
+)
+from .config import DEFAULT_ATTEMPTS
 from .db import (
     Archive,
+    EMBEDDING_DIMENSION,
     File,
     FileInArchive,
     NormalizedFile,
@@ -19,29 +36,65 @@ from .db import (
     Snippet,
     SnippetInNormalizedFile,
 )
-from .norm import normalize
-from .split import segment
+from .embedding import EmbeddingBatcher
+from .embedding_backends import make_backend
+from .metrics import METRICS
+from .prepare import prepare_file, PreparedFile
+from .retry import with_retries
 
 MODEL = None
 
+T = TypeVar("T")
+
 VENDOR_DIR_NAMES = {"vendor", "_vendor", "vendored", "_vendored"}
 
 
+def load_model():
+    """
+    The configured backend (see `embedding_backends`), behind the local
+    embedding cache if `EMBEDDING_CACHE_DIR` is set.
+    """
+    model = make_backend()
+    cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+    if cache_dir:
+        from .embedding_cache import CachedModel, DEFAULT_CAPACITY, EmbeddingCache
+
+        model = CachedModel(
+            model,
+            EmbeddingCache(
+                cache_dir,
+                model.model_id,
+                model.dimension,
+                int(os.getenv("EMBEDDING_CACHE_SIZE", DEFAULT_CAPACITY)),
+            ),
+        )
+    return model
+
+
 def get_model():
+    """
+    The model this process encodes snippets with: a client of the `orig
+    embed-server` at `EMBED_SERVER` if that's set, otherwise `load_model()`.
+    """
     global MODEL
     if MODEL is None:
-        from sentence_transformers import SentenceTransformer
+        embed_server = os.getenv("EMBED_SERVER")
+        if embed_server:
+            from .embed_server import EmbedClient
 
-        MODEL = SentenceTransformer(
-            os.getenv(
-                "MODEL_NAME",
-                "flax-sentence-embeddings/st-codesearch-distilroberta-base",
+            model = EmbedClient(embed_server)
+        else:
+            model = load_model()
+        if model.dimension != EMBEDDING_DIMENSION:
+            raise ValueError(
+                f"{model.model_id} has dimension {model.dimension}, but the "
+                f"snippet table has {EMBEDDING_DIMENSION} (EMBEDDING_DIMENSION)"
             )
-        )
+        MODEL = model
     return MODEL
 
 
-def have_hash(sha256: str) -> bool:
+def have_hash(sha256: str, attempts: int = DEFAULT_ATTEMPTS) -> bool:
     """
     Assume that once added, things are never deleted.
 
@@ -49,56 +102,217 @@ def have_hash(sha256: str) -> bool:
 
     Revisit if there are ever multiple ways to compute normalized code, or embeddings.
     """
-    with Session() as session:
-        t = session.get(Archive, sha256)
-        return bool(t)
+
+    def lookup() -> bool:
+        with METRICS.timer("lookup"), Session() as session:
+            return session.get(Archive, sha256) is not None
+
+    return with_retries(lookup, attempts, description=f"lookup of {sha256}")
+
+
+def check_hash(expected: str | None, actual: str, url: str) -> None:
+    if expected is not None and expected != actual:
+        raise ValueError(f"{url} has sha256 {actual}, expected {expected}")
+
+
+def download_url(url: str, dest_dir) -> tuple[Path, str]:
+    """
+    Downloads `url` into `dest_dir`, returning the local path and its sha256.
+    """
+    local_file = Path(dest_dir, url.split("/")[-1])
+    hasher = hashlib.sha256()
+    with METRICS.timer("download"), open(local_file, "wb") as f:
+        with requests.get(url, stream=True) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(None):
+                f.write(chunk)
+                hasher.update(chunk)
+    return local_file, hasher.hexdigest()
+
+
+def fetch_members(url: str) -> tuple[str, list[tuple[PurePath, bytes]]]:
+    """
+    Downloads `url`, returning its sha256 and the python files in it without
+    writing it to disk (except for large zips, see `stream_archive_members`).
+    """
+    # Unpacking happens as the download arrives, so it's counted as download.
+    with METRICS.timer("download"), requests.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        return stream_archive_members(
+            url.split("/")[-1], resp.iter_content(1024 * 1024)
+        )
 
 
 def import_url(
-    hash: str | None, url: str, date: datetime.datetime, project: str, version: str
+    hash: str | None,
+    url: str,
+    date: datetime.datetime,
+    project: str,
+    version: str,
+    embedder: EmbeddingBatcher | None = None,
+    executor: Executor | None = None,
+    stream: bool = True,
 ) -> None:
+    """
+    If `stream` is set, python files are read from the response as it arrives
+    instead of from a downloaded copy.
+    """
     if hash is not None and have_hash(hash):
+        METRICS.tier("archive", hits=1)
         return
 
-    with tempfile.TemporaryDirectory() as td:
-        local_filename = url.split("/")[-1]
-        hasher = hashlib.sha256()
-        with open(Path(td, local_filename), "wb") as f:
-            with requests.get(url, stream=True) as resp:
-                for chunk in resp.iter_content(None):
-                    f.write(chunk)
-                    hasher.update(chunk)
+    if stream:
+        computed_hash, members = fetch_members(url)
+        check_hash(hash, computed_hash, url)
+        print(f"[FILE] {computed_hash} from {url}")
+        if have_hash(computed_hash):
+            print("  -> already have")
+            METRICS.tier("archive", hits=1)
+            return
+        return import_members(
+            computed_hash,
+            url,
+            date,
+            members,
+            project,
+            version,
+            embedder=embedder,
+            executor=executor,
+        )
 
+    with tempfile.TemporaryDirectory() as td:
+        local_file, computed_hash = download_url(url, td)
+        check_hash(hash, computed_hash, url)
         return import_archive(
-            hasher.hexdigest(), url, date, Path(td, local_filename), project, version
+            computed_hash,
+            url,
+            date,
+            local_file,
+            project,
+            version,
+            embedder=embedder,
+            executor=executor,
         )
 
 
 def import_archive(
-    hash, url, date, local_file, project, version
+    hash,
+    url,
+    date,
+    local_file,
+    project,
+    version,
+    embedder=None,
+    executor=None,
+    extract=False,
+    attempts=DEFAULT_ATTEMPTS,
 ) -> None:  # TODO maybe return a stats object?
+    """
+    If `embedder` is provided, new snippets are queued on it and only encoded
+    once enough have accumulated -- the caller is responsible for a final
+    flush.  Otherwise they are encoded before this archive is committed.
+
+    Python files are read straight out of the archive unless `extract` is set,
+    which unpacks everything to a temporary directory first.
+    """
     print(f"[FILE] {hash} from {url}")
-    if have_hash(hash):
+    if have_hash(hash, attempts):
         print("  -> already have")
+        METRICS.tier("archive", hits=1)
         return
 
-    # TODO ignore cleanup errors
-    with tempfile.TemporaryDirectory() as td:
-        format = "zip" if local_file.suffix in (".zip", ".whl") else "tar"
-        shutil.unpack_archive(local_file, td, format=format)
+    local_file = Path(local_file)
+    if extract:
+        # TODO ignore cleanup errors
+        with METRICS.timer("unpack"), tempfile.TemporaryDirectory() as td:
+            format = "zip" if is_zip_name(local_file.name) else "tar"
+            shutil.unpack_archive(local_file, td, format=format)
+            members = list(iter_local_dir(td))
+    else:
+        with METRICS.timer("unpack"):
+            members = list(iter_archive_members(local_file))
+
+    import_members(
+        hash,
+        url,
+        date,
+        members,
+        project,
+        version,
+        embedder=embedder,
+        executor=executor,
+        attempts=attempts,
+    )
+
+
+def in_transaction(
+    work: Callable[[Any], T],
+    embedder: EmbeddingBatcher | None = None,
+    attempts: int = DEFAULT_ATTEMPTS,
+    description: str = "",
+) -> T:
+    """
+    Runs `work(session)` and commits, all over again if that fails
+    transiently.  Whatever `embedder` had pending beforehand is restored
+    after any failure (including the last), as a rollback loses both the
+    snippets queued since and the embeddings it wrote.
+    """
+    pending = dict(embedder.pending) if embedder is not None else {}
 
-        # TODO handle retries here until it succeeds!
+    def attempt() -> T:
         with Session() as session:
-            import_local_dir(
-                archive_hash=hash,
-                archive_url=url,
-                archive_date=date,
-                local_dir=td,
-                session=session,
-                project=project,
-                version=version,
-            )
+            result = work(session)
             session.commit()
+            return result
+
+    def undo(e: BaseException) -> None:
+        if embedder is not None:
+            embedder.pending.clear()
+            embedder.pending.update(pending)
+
+    try:
+        return with_retries(attempt, attempts, description=description, on_retry=undo)
+    except BaseException as e:
+        undo(e)
+        raise
+
+
+def import_members(
+    hash,
+    url,
+    date,
+    members: Sequence[tuple[PurePath, bytes]],
+    project,
+    version,
+    embedder=None,
+    executor=None,
+    attempts=DEFAULT_ATTEMPTS,
+) -> None:
+    """
+    Imports an archive given the (relative name, data) of its python files, in
+    one transaction (retried if the database connection fails).
+    """
+    archive_embedder = EmbeddingBatcher(get_model) if embedder is None else embedder
+
+    def work(session) -> None:
+        add_archive_members(
+            archive_hash=hash,
+            archive_url=url,
+            archive_date=date,
+            members=members,
+            session=session,
+            project=project,
+            version=version,
+            embedder=archive_embedder,
+            executor=executor,
+        )
+        if embedder is None or embedder.should_flush():
+            archive_embedder.flush(session)
+
+    in_transaction(work, archive_embedder, attempts, description=url)
+    for table_name, stats in sorted(BULK_STATS.items()):
+        print(f"  -> {table_name}: {stats}")
+    BULK_STATS.clear()
 
 
 def import_local_dir(
@@ -109,7 +323,39 @@ def import_local_dir(
     session,
     project: str,
     version: str,
+    embedder: EmbeddingBatcher,
+    executor: Executor | None = None,
 ):
+    add_archive_members(
+        archive_hash=archive_hash,
+        archive_url=archive_url,
+        archive_date=archive_date,
+        members=list(iter_local_dir(local_dir)),
+        session=session,
+        project=project,
+        version=version,
+        embedder=embedder,
+        executor=executor,
+    )
+
+
+def add_archive_members(
+    archive_hash: str,
+    archive_url: str,
+    archive_date,
+    members: Sequence[tuple[PurePath, bytes]],
+    session,
+    project: str,
+    version: str,
+    embedder: EmbeddingBatcher,
+    executor: Executor | None = None,
+    prepared: Sequence[PreparedFile] | None = None,
+):
+    """
+    If `executor` is provided (generally from `prepare.make_executor`), new
+    files are parsed, normalized and segmented there, while this process does
+    the database work.  `prepared` is passed on to `import_files`.
+    """
     archive = session.get(Archive, archive_hash)
     if archive is None:
         archive = Archive(
@@ -121,36 +367,95 @@ def import_local_dir(
         )
         print("  -> create")
         session.add(archive)
+        METRICS.tier("archive", misses=1)
+
+    file_hashes = import_files(
+        members,
+        session,
+        embedder=embedder,
+        executor=executor,
+        prepared=prepared,
+    )
+
+    for (relative_name, _), h in zip(members, file_hashes):
+        vendor_level = sum(
+            1 for part in relative_name.parts if part in VENDOR_DIR_NAMES
+        )
+        if h is not None:
+            orm_file_in_archive = FileInArchive(
+                archive=archive,
+                file_hash=h,
+                sample_name=relative_name.as_posix(),
+                vendor_level=vendor_level,
+            )
+            session.add(orm_file_in_archive)
+
+    _record_first_seen(archive, [h for h in file_hashes if h is not None], session)
+
 
-    for dirpath, dirnames, filenames in os.walk(local_dir):
-        dirnames[:] = [d for d in dirnames if d not in (".venv",)]
-        for f in filenames:
-            # TODO consider pyi?
-            if f.endswith(".py"):
-                fp = Path(dirpath, f)
-                relative_name = fp.relative_to(local_dir)
-                orm_file = import_one_local_file(fp, fp.relative_to(local_dir), session)
-                vendor_level = sum(
-                    1 for part in relative_name.parts if part in VENDOR_DIR_NAMES
+def _record_first_seen(archive: Archive, file_hashes: list[str], session) -> None:
+    """
+    Makes `archive` the first seen archive of the normalized files (and their
+    snippets) of `file_hashes`, where it's older than what they have.
+
+    A snippet is never first seen later than the normalized files containing
+    it, so only snippets of normalized files that this archive predates can
+    need updating.  When it predates none (say, a newer version of something
+    already imported) that's one read per chunk, and nothing is written.
+    """
+    # The archive needs to exist for the foreign key
+    session.flush()
+
+    def later(cls):
+        return or_(cls.first_seen.is_(None), cls.first_seen > archive.timestamp)
+
+    values = {"first_seen": archive.timestamp, "first_archive_hash": archive.hash}
+    with METRICS.timer("insert"):
+        for chunk in chunks(sorted(set(file_hashes)), DEFAULT_PARAMETER_BUDGET):
+            normalized = list(
+                session.scalars(
+                    select(NormalizedFile.hash)
+                    .join(File, File.normalized_hash == NormalizedFile.hash)
+                    .where(File.hash.in_(chunk), later(NormalizedFile))
+                    .distinct()
                 )
-                if orm_file:
-                    orm_file_in_archive = FileInArchive(
-                        archive=archive,
-                        file=orm_file,
-                        sample_name=relative_name.as_posix(),
-                        vendor_level=vendor_level,
-                    )
-                    session.add(orm_file_in_archive)
+            )
+            if not normalized:
+                continue
+            session.execute(
+                update(NormalizedFile)
+                .where(NormalizedFile.hash.in_(normalized))
+                .values(**values)
+                # Nothing in the session needs to see this before commit
+                .execution_options(synchronize_session=False)
+            )
+            snippets = select(SnippetInNormalizedFile.snippet_hash).where(
+                SnippetInNormalizedFile.normalized_file_hash.in_(normalized)
+            )
+            session.execute(
+                update(Snippet)
+                .where(Snippet.hash.in_(snippets), later(Snippet))
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
 
 
 def import_one_local_file(
-    fp: Path, rel: Path, session, file: IO[bytes] | None = None
-) -> File:
+    fp: Path,
+    rel: Path,
+    session,
+    file: IO[bytes] | None = None,
+    embedder: EmbeddingBatcher | None = None,
+) -> File | None:
     """
     Provide either fp (Path) or file (a file-like object positioned at the
     start) to import some bytes.
 
     rel is only used for printing stuff.
+
+    New snippets are queued on `embedder` if given (and it's the caller's job
+    to flush it before relying on the embeddings), otherwise they're encoded
+    before returning.
     """
 
     if file:
@@ -158,68 +463,158 @@ def import_one_local_file(
     else:
         data = fp.read_bytes()
 
-    h = hashlib.sha256(data).hexdigest()
-    orm_file = session.get(File, h)
-    if orm_file is not None:
-        print("  [HIT ]", rel)
+    (h,) = import_files([(rel, data)], session, embedder=embedder)
+    if h is None:
+        return None
+    return session.get(File, h)
+
+
+def import_files(
+    files: Sequence[tuple[PurePath, bytes]],
+    session,
+    embedder: EmbeddingBatcher | None = None,
+    executor: Executor | None = None,
+    prepared: Sequence[PreparedFile] | None = None,
+) -> list[str | None]:
+    """
+    Imports (relative name, data) pairs, returning the file hash of each (or
+    None if it has nothing worth indexing, like an empty file).
+
+    Everything is hashed up front so that known files, normalized files and
+    snippets are each resolved with a few IN queries rather than a lookup per
+    file, and only the misses get normalized (in `executor` if given).  With
+    `prepared` (one per file, from an earlier pass over the same data) files
+    aren't hashed or normalized again at all.
+    """
+    if prepared is None:
+        hashes = [hashlib.sha256(data).hexdigest() for _, data in files]
+    else:
+        hashes = [p.hash for p in prepared]
+    # file hash -> normalized hash, or None if there are no segments
+    with METRICS.timer("lookup"):
+        normalized_hashes: dict[str, str | None] = dict(
+            select_in(session, File.hash, hashes, File.normalized_hash)
+        )
+
+    misses: dict[str, tuple[PurePath, bytes]] = {}
+    for (rel, data), h in zip(files, hashes):
+        if h in normalized_hashes:
+            print("  [HIT ]", rel)
+        else:
+            misses.setdefault(h, (rel, data))
+    METRICS.tier("file", hits=len(files) - len(misses), misses=len(misses))
+
+    if prepared is not None:
+        by_hash = {p.hash: p for p in prepared}
+        prepared_files = [by_hash[h] for h in misses]
+    elif executor is None:
+        prepared_files = [prepare_file(data, h) for h, (_, data) in misses.items()]
     else:
-        # Step 1: normalize
-        mod = normalize(ast.parse(data))
-        normalized_bytes = ast.unparse(mod).encode("utf-8")
-        nh = hashlib.sha256(normalized_bytes).hexdigest()
-        orm_normalized = session.get(NormalizedFile, nh)
-        if orm_normalized is not None:
+        prepared_files = list(
+            executor.map(
+                prepare_file,
+                [data for _, data in misses.values()],
+                list(misses),
+                chunksize=8,
+            )
+        )
+
+    for prepared in prepared_files:
+        for stage, seconds in prepared.timings.items():
+            METRICS.add_time(stage, seconds)
+
+    with METRICS.timer("lookup"):
+        known_normalized = set(
+            select_in(
+                session,
+                NormalizedFile.hash,
+                [p.normalized_hash for p in prepared_files],
+            )
+        )
+    # normalized hash -> snippet values, in order
+    new_normalized: dict[str, list[dict[str, str]]] = {}
+    for prepared in prepared_files:
+        rel = misses[prepared.hash][0]
+        nh = prepared.normalized_hash
+        if nh in known_normalized or nh in new_normalized:
             print("  [HIT2]", rel)
+        elif not prepared.segments:
+            # An empty or whitespace-only file has no segments, don't bother indexing.
+            print("  [    ]", rel)
+            normalized_hashes[prepared.hash] = None
+            continue
         else:
-            # Step 2: normalized missing too, upsert/collect snippet objects
-            segments = list(segment(mod))
-            if not segments:
-                # An empty or whitespace-only file has no segments, don't bother indexing.
-                print("  [    ]", rel)
-                return
             print("  [----]", rel)
-            values = [
+            new_normalized[nh] = [
                 {
                     "hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
                     "text": text,
                 }
-                for a, b, text in segments
+                for text in prepared.segments
             ]
-            # TODO seems "number of parameters must be between 0 and 65535" so
-            # we need to batch this.  Found on cdktf-cdktf-provider-aws 19.29.0
-            stmt = (
-                insert(Snippet)
-                .values(values)
-                .on_conflict_do_nothing()
-                .returning(Snippet)
-            )
-            ret = session.execute(stmt)
-            model = get_model()
-            texts = [x[0].text for x in ret]
-            if texts:
-                embeddings = model.encode(texts)
-                for (x,), e in zip(ret, embeddings):
-                    x.embedding = e
-
-            hashes = [v["hash"] for v in values]
-            # result = session.execute(select(Snippet).where(Snippet.hash.in_(hashes)))
-            # result_all = {r[0].hash: r[0] for r in result.all()}
-
-            # TODO probably batch this too
-            new_snippet_in_normalized = [
-                SnippetInNormalizedFile(
-                    normalized_file_hash=nh,
-                    snippet_hash=h,
-                    sequence=i,
-                )
-                for i, h in enumerate(hashes)
-            ]
-            for s in new_snippet_in_normalized:
-                session.add(s)
+        normalized_hashes[prepared.hash] = nh
+
+    METRICS.tier(
+        "normalized",
+        hits=sum(p.normalized_hash in known_normalized for p in prepared_files),
+        misses=len(new_normalized),
+    )
+    if new_normalized:
+        _insert_normalized(new_normalized, session, embedder)
+
+    with METRICS.timer("insert"):
+        for prepared in prepared_files:
+            nh = normalized_hashes[prepared.hash]
+            if nh is not None:
+                session.add(File(hash=prepared.hash, normalized_hash=nh))
+        session.flush()
+
+    return [h if normalized_hashes[h] is not None else None for h in hashes]
+
 
-            orm_normalized = NormalizedFile(hash=nh, snippets=new_snippet_in_normalized)
-            session.add(orm_normalized)
+def _insert_normalized(
+    new_normalized: dict[str, list[dict[str, str]]],
+    session,
+    embedder: EmbeddingBatcher | None,
+) -> None:
+    snippets = {v["hash"]: v for values in new_normalized.values() for v in values}
+    with METRICS.timer("lookup"):
+        known_snippets = set(select_in(session, Snippet.hash, snippets))
+    new_snippets = [v for h, v in snippets.items() if h not in known_snippets]
+    METRICS.tier("snippet", hits=len(known_snippets), misses=len(new_snippets))
+    # Something else may have inserted them in the meantime, so the conflict
+    # handling is still needed.
+    with METRICS.timer("insert"):
+        inserted = set(
+            insert_ignoring_conflicts(
+                session,
+                Snippet.__table__,
+                new_snippets,
+                returning=Snippet.__table__.c.hash,
+            )
+        )
+    batcher = EmbeddingBatcher(get_model) if embedder is None else embedder
+    for v in new_snippets:
+        if v["hash"] in inserted:
+            batcher.add(v["hash"], v["text"])
+    if embedder is None:
+        batcher.flush(session)
 
-        orm_file = File(hash=h, normalized=orm_normalized)
-        session.add(orm_file)
-    return orm_file
+    with METRICS.timer("insert"):
+        session.add_all([NormalizedFile(hash=nh) for nh in new_normalized])
+        # The links are written directly, so the normalized file rows need to
+        # exist first for the foreign key.
+        session.flush()
+        copy_rows(
+            session,
+            SnippetInNormalizedFile.__table__,
+            [
+                {
+                    "normalized_file_hash": nh,
+                    "snippet_hash": v["hash"],
+                    "sequence": i,
+                }
+                for nh, values in new_normalized.items()
+                for i, v in enumerate(values)
+            ],
+        )
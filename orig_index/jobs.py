@@ -0,0 +1,245 @@
+"""
+A small durable job queue, so that the webapp doesn't import archives or
+identify files inside a request.
+
+Jobs are rows in the `job` table.  Workers (`orig worker`, or a thread of the
+webapp itself if `WEB_RUN_JOBS=1`) claim the oldest queued one with
+SELECT ... FOR UPDATE SKIP LOCKED, so any number of them can share the table,
+and record its result or error when done.  A job whose worker died is put back
+in the queue once it's been running for longer than `JOB_TIMEOUT` (workers
+check every `REQUEUE_INTERVAL`), up to `MAX_ATTEMPTS` times.
+"""
+
+import datetime
+import multiprocessing
+import time
+import traceback
+from typing import Any, Callable, Optional
+
+from packaging.utils import canonicalize_name
+from sqlalchemy import select, update
+
+from . import db
+from .db import Job
+
+JOB_TIMEOUT = datetime.timedelta(hours=1)
+MAX_ATTEMPTS = 3
+# How often each worker looks for jobs held by workers that died
+REQUEUE_INTERVAL = 60.0
+
+# kind -> function of (params, payload) returning a json-able result
+HANDLERS: dict[str, Callable[[dict[str, Any], Optional[bytes]], Any]] = {}
+
+
+def handler(kind: str):
+    def inner(func):
+        HANDLERS[kind] = func
+        return func
+
+    return inner
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+
+
+def enqueue(
+    session, kind: str, params: dict[str, Any], payload: Optional[bytes] = None
+) -> Job:
+    """
+    Adds a job to `session` (sync or async); it's queued once that commits.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    job = Job(kind=kind, params=params, payload=payload, status="queued", attempts=0)
+    session.add(job)
+    return job
+
+
+def requeue_stale(session) -> None:
+    """
+    Gives jobs whose worker seems to have died another chance, or fails them.
+    """
+    stale = (Job.status == "running", Job.started < _now() - JOB_TIMEOUT)
+    session.execute(
+        update(Job)
+        .where(*stale, Job.attempts < MAX_ATTEMPTS)
+        .values(status="queued")
+        .execution_options(synchronize_session=False)
+    )
+    session.execute(
+        update(Job)
+        .where(*stale)
+        .values(status="failed", error="Timed out", finished=_now())
+        .execution_options(synchronize_session=False)
+    )
+    session.commit()
+
+
+def claim(session) -> Optional[Job]:
+    job = session.scalars(
+        select(Job)
+        .where(Job.status == "queued")
+        .order_by(Job.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+    if job is not None:
+        job.status = "running"
+        job.started = _now()
+        job.attempts += 1
+        session.commit()
+    return job
+
+
+def run_one(session_factory=None) -> bool:
+    """
+    Runs the next queued job, if any, returning whether there was one.
+    """
+    session_factory = session_factory or db.Session
+    with session_factory() as session:
+        job = claim(session)
+        if job is None:
+            return False
+        id, kind, params, payload = job.id, job.kind, job.params, job.payload
+
+    values: dict[str, Any]
+    try:
+        values = {"status": "done", "result": HANDLERS[kind](params, payload)}
+    except Exception:
+        values = {"status": "failed", "error": traceback.format_exc()}
+
+    with session_factory() as session:
+        session.execute(
+            update(Job)
+            .where(Job.id == id)
+            .values(finished=_now(), **values)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    return True
+
+
+def work(
+    session_factory=None, poll_interval: float = 1.0, until_idle: bool = False
+) -> None:
+    session_factory = session_factory or db.Session
+    next_requeue = 0.0
+    while True:
+        if time.monotonic() >= next_requeue:
+            with session_factory() as session:
+                requeue_stale(session)
+            next_requeue = time.monotonic() + REQUEUE_INTERVAL
+        if not run_one(session_factory):
+            if until_idle:
+                return
+            time.sleep(poll_interval)
+
+
+def run_workers(processes: int, poll_interval: float = 1.0) -> None:
+    """
+    Runs `work` in `processes` separate processes (each loading its own model
+    when it first needs one) until interrupted.
+    """
+    if processes <= 1:
+        return work(poll_interval=poll_interval)
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=work, kwargs={"poll_interval": poll_interval})
+        for _ in range(processes)
+    ]
+    for p in procs:
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+def job_status(job: Job) -> dict[str, Any]:
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "result": job.result,
+        "error": job.error,
+        "attempts": job.attempts,
+        "created": job.created,
+        "started": job.started,
+        "finished": job.finished,
+    }
+
+
+@handler("import_project_url")
+def import_project_url(params: dict[str, Any], payload: Optional[bytes]) -> Any:
+    """
+    Indexes one known url from the given project, which must correspond to a
+    DistributionPackage in it.
+    """
+    from pypi_simple import ACCEPT_JSON_ONLY, PyPISimple
+
+    from .importer import import_url
+
+    ps = PyPISimple(accept=ACCEPT_JSON_ONLY)
+    cn = canonicalize_name(params["project"])
+    pp = ps.get_project_page(cn)
+    for distribution_package in pp.packages:
+        if distribution_package.url == params["url"]:
+            if distribution_package.package_type not in ("sdist", "wheel"):
+                raise ValueError(f"Can't import a {distribution_package.package_type}")
+
+            upload_time = distribution_package.upload_time
+            assert upload_time is not None
+            import_url(
+                hash=distribution_package.digests["sha256"],
+                url=distribution_package.url,
+                date=upload_time,
+                project=cn,
+                version=distribution_package.version,
+            )
+            return {"archive_hash": distribution_package.digests["sha256"]}
+    raise LookupError(f"{params['url']} is not part of {cn}")
+
+
+@handler("identify_file")
+def identify_file(params: dict[str, Any], payload: Optional[bytes]) -> Any:
+    """
+    Looks up an uploaded file without importing it, see `lookup.py`.  If its
+    normalized file is already known the result is just that hash, otherwise
+    it includes the snippets and where the same or similar ones were seen.
+    """
+    from .lookup import embed_snippets, find_snippet_matches, lookup_file
+
+    assert payload is not None
+    with db.Session() as session:
+        looked_up = lookup_file(payload, session)
+        if looked_up.normalized_hash is None:
+            raise ValueError("No python code in that file")
+        result: dict[str, Any] = {
+            "hash": looked_up.hash,
+            "normalized_hash": looked_up.normalized_hash,
+            "known": looked_up.known_normalized,
+        }
+        if looked_up.known_normalized:
+            return result
+
+        embed_snippets(looked_up.snippets, session)
+        similar = find_snippet_matches(looked_up.snippets, session)
+        result["snippets"] = [
+            {
+                "hash": s.hash,
+                "text": s.text,
+                "matches": [
+                    {
+                        "purl": m.archive.purl,
+                        "sample_name": m.sample_name,
+                        "distance": distance,
+                    }
+                    for m, distance, _ in similar[s.hash]
+                ],
+            }
+            for s in looked_up.snippets
+        ]
+        return result
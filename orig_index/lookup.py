@@ -0,0 +1,169 @@
+"""
+Looking up a file without importing it.
+
+`lookup_file` does the same hashing, normalizing and segmenting as the
+importer, but keeps the results in memory and only reads from the database to
+see which of them are already known.  Embeddings are reused for snippets that
+have one and encoded for the rest, so `find_archives_containing_similar_snippets`
+can be called with the returned snippets as if they'd been imported;
+`find_snippet_matches` does that after listing verbatim copies of the known
+ones.
+
+Nothing is written, so lookups don't contend with importers for locks or grow
+the tables (and their vector index) with one-off queries.
+"""
+
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Sequence
+
+from sqlalchemy import func, select
+
+from .bulk import select_in
+from .db import File, FileInArchive, NormalizedFile, Snippet, SnippetInNormalizedFile
+from .importer import get_model
+from .prepare import prepare_file
+from .similarity import find_archives_containing_similar_snippets
+
+
+@dataclass
+class QuerySnippet:
+    """
+    Stands in for a `Snippet` that hasn't been imported.
+    """
+
+    hash: str
+    text: str
+    # Whether there's a Snippet row with this hash
+    known: bool = False
+    embedding: Any = None
+
+
+@dataclass
+class FileLookup:
+    hash: str
+    # None if the file has no python code worth indexing
+    normalized_hash: Optional[str]
+    snippets: list[QuerySnippet]
+    known_file: bool
+    known_normalized: bool
+
+
+def lookup_file(data: bytes, session) -> FileLookup:
+    """
+    Raises whatever `ast.parse` does on unparseable input, like the importer.
+    """
+    prepared = prepare_file(data, hashlib.sha256(data).hexdigest())
+    snippets = [
+        QuerySnippet(hash=hashlib.sha256(text.encode("utf-8")).hexdigest(), text=text)
+        for text in prepared.segments
+    ]
+    known_snippets = set(select_in(session, Snippet.hash, [s.hash for s in snippets]))
+    for s in snippets:
+        s.known = s.hash in known_snippets
+    return FileLookup(
+        hash=prepared.hash,
+        normalized_hash=prepared.normalized_hash if snippets else None,
+        snippets=snippets,
+        known_file=session.get(File, prepared.hash) is not None,
+        known_normalized=bool(snippets)
+        and session.get(NormalizedFile, prepared.normalized_hash) is not None,
+    )
+
+
+def embed_snippets(
+    snippets: Sequence[QuerySnippet],
+    session,
+    model_factory: Optional[Callable[[], Any]] = None,
+) -> None:
+    """
+    Fills in `embedding` on each of `snippets`, from the database where a known
+    snippet has one and otherwise by encoding its text.
+    """
+    stored = dict(
+        select_in(
+            session,
+            Snippet.hash,
+            [s.hash for s in snippets if s.known],
+            Snippet.embedding,
+        )
+    )
+    missing = []
+    for s in snippets:
+        s.embedding = stored.get(s.hash)
+        if s.embedding is None:
+            missing.append(s)
+    if missing:
+        embeddings = (model_factory or get_model)().encode([s.text for s in missing])
+        for s, e in zip(missing, embeddings):
+            s.embedding = e
+
+
+def find_known_snippets(
+    hashes: Sequence[str], session, limit: int = 2
+) -> dict[str, list[tuple[FileInArchive, float, SnippetInNormalizedFile]]]:
+    """
+    Up to `limit` archives (least vendored first) where each of the snippets
+    `hashes` was seen verbatim, as matches at distance 0.
+    """
+    results: dict[str, list] = {h: [] for h in hashes}
+    if not results:
+        return results
+    rank = (
+        func.row_number()
+        .over(
+            partition_by=SnippetInNormalizedFile.snippet_hash,
+            order_by=(FileInArchive.vendor_level, FileInArchive.id),
+        )
+        .label("rank")
+    )
+    locations = (
+        select(
+            FileInArchive.id.label("file_in_archive_id"),
+            SnippetInNormalizedFile.id.label("snippet_in_normalized_file_id"),
+            rank,
+        )
+        .select_from(SnippetInNormalizedFile)
+        .join(
+            File, File.normalized_hash == SnippetInNormalizedFile.normalized_file_hash
+        )
+        .join(File.archives)
+        .where(SnippetInNormalizedFile.snippet_hash.in_(list(results)))
+        .subquery()
+    )
+    for m, norm_snippet in session.execute(
+        select(FileInArchive, SnippetInNormalizedFile)
+        .join(locations, FileInArchive.id == locations.c.file_in_archive_id)
+        .join(
+            SnippetInNormalizedFile,
+            SnippetInNormalizedFile.id == locations.c.snippet_in_normalized_file_id,
+        )
+        .where(locations.c.rank <= limit)
+        .order_by(locations.c.rank)
+    ):
+        results[norm_snippet.snippet_hash].append((m, 0.0, norm_snippet))
+    return results
+
+
+def find_snippet_matches(
+    snippets: Sequence[QuerySnippet], session, limit: int = 2, **kwargs: Any
+) -> dict[str, list[tuple[FileInArchive, float, SnippetInNormalizedFile]]]:
+    """
+    Like `find_archives_containing_similar_snippets` (which `kwargs` are passed
+    on to) for looked up snippets with embeddings, except that verbatim copies
+    of the known ones come first whether or not the (approximate) nearest
+    neighbour search finds them.
+    """
+    matches = find_known_snippets([s.hash for s in snippets if s.known], session, limit)
+    similar = find_archives_containing_similar_snippets(
+        snippets, session, limit=limit, **kwargs
+    )
+    for h, near in similar.items():
+        found = matches.setdefault(h, [])
+        seen = {(m.id, norm_snippet.id) for m, _, norm_snippet in found}
+        for match in near:
+            if len(found) >= limit:
+                break
+            if (match[0].id, match[2].id) not in seen:
+                found.append(match)
+    return matches
@@ -0,0 +1,117 @@
+"""
+Process-wide timings and counters for the importer.
+
+Stages are things like "download", "parse" or "insert" and accumulate wall
+time; tiers are the levels at which an import can find that it already has
+something ("archive", "file", "normalized", "snippet") and count hits and
+misses.  `orig import-project` prints a summary at the end, and the webapp
+serves the same numbers as JSON and prometheus text.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            # stage -> [calls, seconds]
+            self.stages: dict[str, list[float]] = defaultdict(lambda: [0, 0.0])
+            # tier -> [hits, misses]
+            self.tiers: dict[str, list[int]] = defaultdict(lambda: [0, 0])
+            self.counters: dict[str, int] = defaultdict(int)
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            s = self.stages[stage]
+            s[0] += calls
+            s[1] += seconds
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - t0)
+
+    def tier(self, tier: str, hits: int = 0, misses: int = 0) -> None:
+        with self._lock:
+            t = self.tiers[tier]
+            t[0] += hits
+            t[1] += misses
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "stages": {
+                    k: {"calls": int(calls), "seconds": seconds}
+                    for k, (calls, seconds) in sorted(self.stages.items())
+                },
+                "tiers": {
+                    k: {
+                        "hits": hits,
+                        "misses": misses,
+                        "hit_rate": hits / (hits + misses) if hits + misses else None,
+                    }
+                    for k, (hits, misses) in sorted(self.tiers.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def summary(self) -> str:
+        snap = self.snapshot()
+        lines = []
+        total = sum(s["seconds"] for s in snap["stages"].values()) or 1.0
+        for stage, s in snap["stages"].items():
+            lines.append(
+                "%-12s %10.2fs %5.1f%% (%d calls)"
+                % (stage, s["seconds"], 100 * s["seconds"] / total, s["calls"])
+            )
+        for tier, t in snap["tiers"].items():
+            rate = "-" if t["hit_rate"] is None else "%.1f%%" % (100 * t["hit_rate"])
+            lines.append(
+                "%-12s %7d hits %7d misses (%s)" % (tier, t["hits"], t["misses"], rate)
+            )
+        for name, value in snap["counters"].items():
+            lines.append("%-12s %10d" % (name, value))
+        return "\n".join(lines)
+
+    def to_prometheus(self, prefix: str = "orig_import") -> str:
+        snap = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds_total counter",
+        ]
+        for stage, s in snap["stages"].items():
+            lines.append(
+                f'{prefix}_stage_seconds_total{{stage="{stage}"}} {s["seconds"]}'
+            )
+        lines.append(f"# TYPE {prefix}_stage_calls_total counter")
+        for stage, s in snap["stages"].items():
+            lines.append(f'{prefix}_stage_calls_total{{stage="{stage}"}} {s["calls"]}')
+        lines.append(f"# TYPE {prefix}_lookups_total counter")
+        for tier, t in snap["tiers"].items():
+            lines.append(
+                f'{prefix}_lookups_total{{tier="{tier}",result="hit"}} {t["hits"]}'
+            )
+            lines.append(
+                f'{prefix}_lookups_total{{tier="{tier}",result="miss"}} {t["misses"]}'
+            )
+        for name, value in snap["counters"].items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
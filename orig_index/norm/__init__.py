@@ -45,6 +45,12 @@ class RemoveDocstringsAndTypes(ast.NodeTransformer):
         return modified
 
     visit_FunctionDef = visit_something_with_body
+    visit_AsyncFunctionDef = visit_something_with_body
+    visit_For = visit_something_with_body
+    visit_AsyncFor = visit_something_with_body
+    visit_While = visit_something_with_body
+    visit_With = visit_something_with_body
+    visit_AsyncWith = visit_something_with_body
     visit_ClassDef = visit_something_with_body
     visit_If = visit_something_with_body
     visit_ExceptHandler = visit_something_with_body
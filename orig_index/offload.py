@@ -0,0 +1,53 @@
+"""
+Running blocking work from async code without stalling the event loop.
+
+Identifying an uploaded file means parsing, normalizing and running the model,
+which takes anywhere from milliseconds to seconds.  That goes to a few worker
+threads (the model is loaded once per process and torch releases the GIL while
+encoding), and once `queue_depth` more requests are waiting for them, further
+ones are turned away immediately instead of piling up.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_WORKERS = int(os.environ.get("WEB_WORKERS", "2"))
+DEFAULT_QUEUE_DEPTH = int(os.environ.get("WEB_QUEUE_DEPTH", "8"))
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    def __init__(
+        self, workers: int = DEFAULT_WORKERS, queue_depth: int = DEFAULT_QUEUE_DEPTH
+    ) -> None:
+        self.workers = workers
+        self.limit = workers + queue_depth
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="offload")
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """
+        Runs `func` on a worker thread, raising `Overloaded` without waiting if
+        too much is already running or queued.
+        """
+        # Only ever touched from the event loop thread, so no lock needed
+        if self.pending >= self.limit:
+            raise Overloaded(f"{self.pending} requests already running or queued")
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,15 +1,26 @@
 import functools
 import re
 from io import StringIO
-from random import Random
 from tokenize import generate_tokens
 from typing import Sequence, Union
 
 import click
 
 # from cityhash import CityHash64
-from numpy import array, array_equal, zeros
+from numpy import (
+    array_equal,
+    asarray,
+    bincount,
+    concatenate,
+    float32,
+    intp,
+    ndarray,
+    stack,
+    where,
+    zeros,
+)
 from numpy.linalg import norm
+from numpy.random import default_rng
 from xxhash import xxh64_intdigest
 
 from .importer import get_model
@@ -31,38 +42,78 @@ def generate_tokens_re(readline):
                     yield (-1, "")
 
 
-class SimpleModel:
-    def __init__(self, num_vectors: int) -> None:
-        self.num_vectors = num_vectors
+# Distinct token components to keep vectors for, across all texts and models.
+# At 768 float32 dimensions this is 48MB.
+COMPONENT_CACHE_SIZE = 16384
+# Texts per matrix product, which is dense in the components of all of them
+ENCODE_CHUNK = 256
 
-    def encode(self, texts_or_text: Union[Sequence[str], str]):
-        if isinstance(texts_or_text, str):
-            return self._encode(texts_or_text)
-        else:
-            return [self._encode(t) for t in texts_or_text]
 
-    def _encode(self, text: str) -> Sequence[float]:
-        """
-        Extremely simple encoder intended for tests where low recall is ok.
+@functools.lru_cache(maxsize=COMPONENT_CACHE_SIZE)
+def _component_vector(num_vectors: int, component: str) -> ndarray:
+    # r = default_rng(CityHash64(component))
+    return default_rng(xxh64_intdigest(component)).random(num_vectors, dtype=float32)
 
-        Based on bigrams of python-level tokens, and randomly distributed
-        vectors because then my model takes up no space to store :)
-        """
-        tokens = [t[:2] for t in generate_tokens(StringIO(text).readline)]
 
-        @functools.lru_cache(maxsize=None)
-        def get_vector(a, b):
-            t = zeros(self.num_vectors)
-            for i in (f"\x00{a[0]}", f"\x01{b[0]}", f"\x02{a[1]}", f"\x03{b[1]}"):
-                # r = Random(CityHash64(i))
-                r = Random(xxh64_intdigest(i))
-                t += array([r.random() for _ in range(self.num_vectors)])
-            return t
+class SimpleModel:
+    """
+    Extremely simple encoder intended for tests where low recall is ok, and for
+    load testing without torch (`EMBEDDING_BACKEND=simple`, see
+    `embedding_backends`).
+
+    Based on bigrams of python-level tokens, and randomly distributed
+    vectors because then my model takes up no space to store :)  Each bigram is
+    the sum of vectors seeded by its token types and strings, so a text is the
+    sum of those over its bigrams; a batch is encoded as one product of how often
+    each component appears in each text with their vectors.
+    """
 
-        v = array([get_vector(a, b) for (a, b) in zip(tokens, tokens[1:])]).sum(axis=0)
+    def __init__(self, num_vectors: int) -> None:
+        self.num_vectors = num_vectors
+        self.dimension = num_vectors
+        self.model_id = f"simple-{num_vectors}"
 
-        # Scale to unit vector
-        return v / norm(v)
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.num_vectors
+
+    def encode(self, texts_or_text: Union[Sequence[str], str], batch_size: int = 32):
+        # batch_size is only accepted for compatibility with SentenceTransformer
+        if isinstance(texts_or_text, str):
+            return self._encode_batch([texts_or_text])[0]
+        texts = list(texts_or_text)
+        return concatenate(
+            [self._encode_batch([])]
+            + [
+                self._encode_batch(texts[i : i + ENCODE_CHUNK])
+                for i in range(0, len(texts), ENCODE_CHUNK)
+            ]
+        )
+
+    def _encode_batch(self, texts: Sequence[str]) -> ndarray:
+        columns: dict[str, int] = {}
+        rows, cols = [], []
+        for row, text in enumerate(texts):
+            tokens = [t[:2] for t in generate_tokens(StringIO(text).readline)]
+            for a, b in zip(tokens, tokens[1:]):
+                for c in (f"\x00{a[0]}", f"\x01{b[0]}", f"\x02{a[1]}", f"\x03{b[1]}"):
+                    rows.append(row)
+                    cols.append(columns.setdefault(c, len(columns)))
+
+        shape = (len(texts), len(columns))
+        flat = asarray(rows, dtype=intp) * shape[1] + asarray(cols, dtype=intp)
+        counts = (
+            bincount(flat, minlength=shape[0] * shape[1]).reshape(shape).astype(float32)
+        )
+        vectors = (
+            stack([_component_vector(self.num_vectors, c) for c in columns])
+            if columns
+            else zeros((0, self.num_vectors), dtype=float32)
+        )
+        v = counts @ vectors
+
+        # Scale to unit vectors (leaving any empty ones alone)
+        norms = norm(v, axis=1, keepdims=True)
+        return v / where(norms == 0, 1, norms)
 
 
 def l2_distance(a, b):
@@ -88,7 +139,8 @@ if __name__ == "__main__":  # pragma: no cover
     import sys
     import time
 
-    from .importer import normalize, segment
+    from .norm import normalize
+    from .split import segment
 
     if len(sys.argv) > 1:
         for filename in sys.argv[1:]:
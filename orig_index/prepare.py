@@ -0,0 +1,66 @@
+"""
+The CPU-bound part of importing a file: hashing, normalizing and segmenting.
+
+None of this touches the database, so it can run in worker processes while a
+single writer owns the session.  Everything returned here is picklable.
+"""
+
+import ast
+import hashlib
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+from .norm import normalize
+from .split import unparse_and_segment
+
+
+@dataclass
+class PreparedFile:
+    hash: str
+    normalized_hash: str
+    # Just the text of each segment, in order
+    segments: list[str]
+    # stage -> seconds, for `metrics` (which is per-process)
+    timings: dict[str, float] = field(default_factory=dict, compare=False)
+
+
+def prepare_file(data: bytes, hash: Optional[str] = None) -> PreparedFile:
+    """
+    Raises whatever `ast.parse` does on unparseable input (most commonly
+    SyntaxError on py2-era code).
+    """
+    if hash is None:
+        hash = hashlib.sha256(data).hexdigest()
+    t0 = time.perf_counter()
+    mod = ast.parse(data)
+    t1 = time.perf_counter()
+    mod = normalize(mod)
+    t2 = time.perf_counter()
+    normalized_source, segments = unparse_and_segment(mod)
+    normalized_bytes = normalized_source.encode("utf-8")
+    t3 = time.perf_counter()
+    return PreparedFile(
+        hash=hash,
+        normalized_hash=hashlib.sha256(normalized_bytes).hexdigest(),
+        segments=[text for a, b, text in segments],
+        timings={"parse": t1 - t0, "normalize": t2 - t1, "segment": t3 - t2},
+    )
+
+
+def make_executor(jobs: int) -> Optional[Executor]:
+    """
+    Returns None for jobs <= 1, which callers treat as "do it inline".
+
+    Workers are started with forkserver (where available) rather than forked
+    from a parent that may have torch threads and database connections.
+    """
+    if jobs <= 1:
+        return None
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        "forkserver" if "forkserver" in methods else "spawn"
+    )
+    return ProcessPoolExecutor(jobs, mp_context=context)
@@ -0,0 +1,69 @@
+"""
+Retrying what fails for reasons that go away by themselves.
+
+A long import run sees the odd dropped database connection, failover, reset
+download or 503 from PyPI; those are retried with exponential backoff (and
+some jitter, so that parallel runs don't retry in lockstep).  Anything else,
+like a py2-era parse error, is raised straight away.
+"""
+
+import random
+import time
+from typing import Callable, TypeVar
+
+import requests
+import sqlalchemy.exc
+
+from .config import DEFAULT_ATTEMPTS, DEFAULT_BACKOFF
+
+T = TypeVar("T")
+
+MAX_BACKOFF = 60.0
+
+
+def is_transient(e: BaseException) -> bool:
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and (
+            e.response.status_code == 429 or e.response.status_code >= 500
+        )
+    if isinstance(e, sqlalchemy.exc.DBAPIError):
+        return e.connection_invalidated or isinstance(
+            e, (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError)
+        )
+    return isinstance(
+        e,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            ConnectionError,
+            TimeoutError,
+        ),
+    )
+
+
+def with_retries(
+    func: Callable[[], T],
+    attempts: int = DEFAULT_ATTEMPTS,
+    backoff: float = DEFAULT_BACKOFF,
+    description: str = "",
+    on_retry: Callable[[BaseException], None] | None = None,
+) -> T:
+    """
+    Calls `func` until it returns, at most `attempts` times, waiting `backoff`
+    seconds (doubling each time) after transient failures.  `on_retry` is
+    called with the exception before each wait, e.g. to undo partial work.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts or not is_transient(e):
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            delay = min(MAX_BACKOFF, backoff * 2 ** (attempt - 1))
+            delay *= random.uniform(0.5, 1.0)  # nosec
+            print(f"  -> retrying {description} in {delay:.1f}s after {e!r}")
+            time.sleep(delay)
+    raise AssertionError("unreachable")
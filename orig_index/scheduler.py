@@ -0,0 +1,322 @@
+"""
+Concurrent download, serial import.
+
+Fetching project pages and archives is network-bound, while importing is
+CPU-bound and wants exactly one copy of the model.  A few download threads
+fetch archives (by default keeping just their python files in memory, or
+otherwise into temporary directories) and hand them over through a bounded
+queue to the importing (calling) thread, which blocks the downloaders when it
+falls behind so that we never have more than a handful of archives waiting.
+
+Transient failures (see `retry.py`) of project pages, downloads and imports
+are retried, and with `checkpoints` each project's archives and how far we got
+through them are recorded, so that a run can `resume` where it stopped.
+"""
+
+import datetime
+import hashlib
+import queue
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path, PurePath
+from typing import Iterable, Optional
+
+from packaging.utils import canonicalize_name
+from packaging.version import Version
+from pypi_simple import ACCEPT_JSON_ONLY, ProjectPage, PyPISimple
+
+from .checkpoints import Checkpoints
+from .config import DEFAULT_ATTEMPTS
+from .embedding import EmbeddingBatcher
+from .importer import (
+    check_hash,
+    download_url,
+    fetch_members,
+    have_hash,
+    import_archive,
+    import_members,
+)
+from .metrics import METRICS
+from .retry import is_transient, with_retries
+from .util import rank
+
+
+@dataclass
+class ArchiveTask:
+    project: str
+    version: str
+    url: str
+    hash: str
+    date: datetime.datetime
+
+
+@dataclass
+class Downloaded:
+    task: ArchiveTask
+    computed_hash: Optional[str] = None
+    # Exactly one of these is set, depending on whether we're streaming
+    local_file: Optional[Path] = None
+    members: Optional[list[tuple[PurePath, bytes]]] = None
+    error: Optional[Exception] = None
+
+
+_DONE = object()
+
+
+def select_archives(
+    pp: ProjectPage, project: str, shards: set[int], total_shards: int
+) -> list[ArchiveTask]:
+    """
+    Picks the best-ranked artifact of each version (newest first) that falls in
+    one of our shards.
+    """
+    cn = canonicalize_name(project)
+    versions = sorted(
+        {dp.version for dp in pp.packages if dp.version is not None},
+        key=Version,  # type: ignore[arg-type]
+        reverse=True,
+    )
+    tasks = []
+    for version in versions:
+        distribution_package = max(
+            [dp for dp in pp.packages if dp.version == version],
+            key=rank,
+        )
+
+        # .filename
+        # .digests["sha256"]
+        # .url
+        # .size (only if json-fetched)
+        # .upload_time (only if json-fetched)
+        # .package_type == "wheel" for now
+        if distribution_package.package_type not in ("sdist", "wheel"):
+            continue
+
+        if (
+            int.from_bytes(hashlib.sha256(distribution_package.url.encode()).digest())
+            % total_shards
+        ) not in shards:
+            print("omit", distribution_package.url)
+            continue
+
+        upload_time = distribution_package.upload_time
+        assert upload_time is not None
+        tasks.append(
+            ArchiveTask(
+                project=cn,
+                version=version,
+                url=distribution_package.url,
+                hash=distribution_package.digests["sha256"],
+                date=upload_time,
+            )
+        )
+    return tasks
+
+
+class ImportScheduler:
+    """
+    `downloads` is the number of concurrent downloads, and `queue_size` how
+    many finished downloads may wait for the importer before downloaders block.
+
+    As with the old serial loop, the first failure within a project (typically
+    a py2-era parse error) skips its remaining (older) versions.  Transient
+    errors are first retried, up to `attempts` tries in all.
+
+    If `resume` is set, projects with `checkpoints` (for the same shards) pick
+    up with their pending archives instead of fetching their page.
+    """
+
+    def __init__(
+        self,
+        embedder: EmbeddingBatcher,
+        executor: Optional[Executor] = None,
+        downloads: int = 4,
+        queue_size: int = 4,
+        stream: bool = True,
+        checkpoints: Optional[Checkpoints] = None,
+        resume: bool = False,
+        attempts: int = DEFAULT_ATTEMPTS,
+    ) -> None:
+        self.embedder = embedder
+        self.stream = stream
+        self.executor = executor
+        self.checkpoints = checkpoints
+        self.resume = resume
+        self.attempts = attempts
+        self.downloads = max(1, downloads)
+        self.tasks: queue.Queue = queue.Queue()
+        self.ready: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.failed_projects: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _failed(self, project: str) -> bool:
+        with self._lock:
+            return project in self.failed_projects
+
+    def _fail(self, project: str, e: Exception) -> None:
+        with self._lock:
+            if project in self.failed_projects:
+                return
+            print("done with", project, repr(e))
+            self.failed_projects.add(project)
+        # Otherwise the rest of it is tried again when resuming
+        if self.checkpoints is not None and not is_transient(e):
+            self.checkpoints.project_failed(canonicalize_name(project), e)
+
+    def _enqueue_projects(
+        self, projects: Iterable[str], shards: set[int], total_shards: int
+    ) -> None:
+        # TODO this could use cachecontrol session
+        ps = PyPISimple(accept=ACCEPT_JSON_ONLY)
+
+        def fetch(project: str) -> list[ArchiveTask]:
+            cn = canonicalize_name(project)
+            try:
+                checkpoints = self.checkpoints
+                if self.resume and checkpoints is not None:
+                    pending = with_retries(
+                        lambda: checkpoints.pending(cn),
+                        self.attempts,
+                        description=f"checkpoint of {cn}",
+                    )
+                    if pending is not None:
+                        print("resuming", cn, "with", len(pending), "archives left")
+                        return sorted(
+                            (ArchiveTask(**a) for a in pending),
+                            key=lambda t: Version(t.version),
+                            reverse=True,
+                        )
+                pp = with_retries(
+                    lambda: ps.get_project_page(cn),
+                    self.attempts,
+                    description=f"project page of {cn}",
+                )
+                tasks = select_archives(pp, project, shards, total_shards)
+                if self.checkpoints is not None:
+                    self.checkpoints.listed(cn, tasks)
+                return tasks
+            except Exception as e:
+                self._fail(project, e)
+                return []
+
+        try:
+            with ThreadPoolExecutor(self.downloads) as pages:
+                for tasks in pages.map(fetch, projects):
+                    for task in tasks:
+                        self.tasks.put(task)
+        finally:
+            for _ in range(self.downloads):
+                self.tasks.put(_DONE)
+
+    def _download_worker(self) -> None:
+        while (task := self.tasks.get()) is not _DONE:
+            if self._failed(task.project):
+                continue
+            try:
+                if have_hash(task.hash, self.attempts):
+                    print(f"[FILE] {task.hash} from {task.url}\n  -> already have")
+                    METRICS.tier("archive", hits=1)
+                    if self.checkpoints is not None:
+                        self.checkpoints.archive_done(task.url)
+                    continue
+                item = with_retries(
+                    lambda: self._download(task),
+                    self.attempts,
+                    description=task.url,
+                )
+            except Exception as e:
+                item = Downloaded(task, error=e)
+            # Blocks when the importer is behind
+            self.ready.put(item)
+        self.ready.put(_DONE)
+
+    def _download(self, task: ArchiveTask) -> Downloaded:
+        if self.stream:
+            computed_hash, members = fetch_members(task.url)
+            check_hash(task.hash, computed_hash, task.url)
+            return Downloaded(task, computed_hash, members=members)
+
+        td = tempfile.mkdtemp()
+        try:
+            local_file, computed_hash = download_url(task.url, td)
+            check_hash(task.hash, computed_hash, task.url)
+        except Exception:
+            shutil.rmtree(td, ignore_errors=True)
+            raise
+        return Downloaded(task, computed_hash, local_file=local_file)
+
+    def run(self, projects: Iterable[str], shards: set[int], total_shards: int):
+        threads = [
+            threading.Thread(
+                target=self._enqueue_projects,
+                args=(projects, shards, total_shards),
+                daemon=True,
+            )
+        ]
+        threads.extend(
+            threading.Thread(target=self._download_worker, daemon=True)
+            for _ in range(self.downloads)
+        )
+        for t in threads:
+            t.start()
+
+        remaining = self.downloads
+        while remaining:
+            item = self.ready.get()
+            if item is _DONE:
+                remaining -= 1
+                continue
+            self._import(item)
+
+    def _import(self, item: Downloaded) -> None:
+        task = item.task
+        try:
+            if self._failed(task.project):
+                return
+            if item.error is not None:
+                raise item.error
+            if item.members is not None:
+                print(f"[FILE] {item.computed_hash} from {task.url}")
+                # Something else may have imported it while it was downloading,
+                # as import_archive checks for the other branch
+                if have_hash(item.computed_hash, self.attempts):
+                    print("  -> already have")
+                    METRICS.tier("archive", hits=1)
+                else:
+                    import_members(
+                        item.computed_hash,
+                        task.url,
+                        task.date,
+                        item.members,
+                        task.project,
+                        task.version,
+                        embedder=self.embedder,
+                        executor=self.executor,
+                        attempts=self.attempts,
+                    )
+            else:
+                assert item.local_file is not None
+                import_archive(
+                    item.computed_hash,
+                    task.url,
+                    task.date,
+                    item.local_file,
+                    task.project,
+                    task.version,
+                    embedder=self.embedder,
+                    executor=self.executor,
+                    attempts=self.attempts,
+                )
+        except Exception as e:
+            self._fail(task.project, e)
+            if self.checkpoints is not None:
+                self.checkpoints.archive_failed(task.url, e, not is_transient(e))
+        else:
+            if self.checkpoints is not None:
+                self.checkpoints.archive_done(task.url)
+        finally:
+            if item.local_file is not None:
+                shutil.rmtree(item.local_file.parent, ignore_errors=True)
@@ -1,14 +1,23 @@
-from sqlalchemy import select
+from typing import Any, Protocol, Sequence
 
-from .db import (
-    Archive,
-    File,
-    FileInArchive,
-    NormalizedFile,
-    Session,
-    Snippet,
-    SnippetInNormalizedFile,
-)
+from pgvector.sqlalchemy import BIT, HALFVEC
+from sqlalchemy import cast, column, Float, func, select, String, true, values
+from sqlalchemy.orm import Session
+
+from .config import DEFAULT_OVERFETCH, DEFAULT_RERANK, VECTOR_QUANTIZATION
+from .db import Archive, File, FileInArchive, Snippet, SnippetInNormalizedFile
+
+
+def set_ef_search(session: Session, ef_search: int | None) -> None:
+    """
+    How many candidates the HNSW index considers per query (pgvector defaults
+    to 40); higher finds more of the true nearest neighbours, more slowly.
+    Lasts until the end of the current transaction.
+    """
+    if ef_search is not None:
+        session.execute(
+            select(func.set_config("hnsw.ef_search", str(int(ef_search)), True))
+        )
 
 
 def find_archives_containing_file(hash: str, session: Session):
@@ -29,17 +38,206 @@ def find_archives_containing_normalized_file(hash: str, session: Session):
     )
 
 
-def find_archives_containing_similar_snippet(snippet: Snippet, session: Session):
-    return session.execute(
+def quantized_distance(query_embedding, quantization: str):
+    """
+    The distance expression that the vector index was built on (see
+    `db.vector_index_ddl`), or None if it's on the embeddings themselves.
+    """
+    dim = Snippet.__table__.c.embedding.type.dim
+    if quantization == "none":
+        return None
+    elif quantization == "halfvec":
+        return cast(Snippet.embedding, HALFVEC(dim)).l2_distance(
+            cast(query_embedding, HALFVEC(dim))
+        )
+    elif quantization == "binary":
+        return cast(func.binary_quantize(Snippet.embedding), BIT(dim)).hamming_distance(
+            cast(func.binary_quantize(query_embedding), BIT(dim))
+        )
+    raise ValueError(f"Unknown quantization {quantization!r}")
+
+
+class VectorSearch(Protocol):
+    """
+    Something other than pgvector that can find nearest snippets, like
+    `vector_index.LocalVectorIndex`.
+    """
+
+    def search(self, queries: Any, k: int) -> list[list[tuple[str, float]]]: ...
+
+
+def similar_snippets_statement(
+    snippets: Sequence[Snippet],
+    limit: int = 2,
+    overfetch: int = DEFAULT_OVERFETCH,
+    max_distance: float | None = None,
+    quantization: str = VECTOR_QUANTIZATION,
+    rerank: int = DEFAULT_RERANK,
+):
+    """
+    One statement for the nearest matches of every snippet in `snippets`.
+
+    The query embeddings are sent as a VALUES list.  For each, a LATERAL
+    subquery first finds the nearest `limit * overfetch` snippets by
+    looking at the snippet table alone (so that it can use the HNSW index),
+    and only those candidates are then resolved to up to `limit` archives
+    each.  Rows come back ordered by query snippet and distance.
+
+    A snippet that's already indexed is its own nearest match, at distance 0:
+    that's how verbatim copies of it are found, so it isn't left out.
+
+    With a quantized index, `rerank` times as many candidates are taken from
+    it and reranked by their exact distance.
+    """
+    embedding_type = Snippet.__table__.c.embedding.type
+    query = values(
+        column("hash", String(64)),
+        column("embedding", embedding_type),
+        name="query",
+    ).data(list({s.hash: (s.hash, s.embedding) for s in snippets}.values()))
+
+    # VALUES columns are untyped on the server side
+    query_embedding = cast(query.c.embedding, embedding_type)
+    distance = Snippet.embedding.l2_distance(query_embedding)
+    approximate = quantized_distance(query_embedding, quantization)
+    if approximate is None:
+        candidates = (
+            select(Snippet.hash.label("snippet_hash"), distance.label("distance"))
+            .order_by(distance)
+            .limit(limit * overfetch)
+        )
+    else:
+        # The index only gives approximate order, so take more candidates from
+        # it and rerank those by their full precision distance.
+        nearest = (
+            select(Snippet.hash, Snippet.embedding)
+            .order_by(approximate)
+            .limit(limit * overfetch * rerank)
+            # Two levels down from where `query` is in FROM
+            .correlate(query)
+            .lateral("approximate")
+        )
+        distance = nearest.c.embedding.l2_distance(query_embedding)
+        candidates = (
+            select(nearest.c.hash.label("snippet_hash"), distance.label("distance"))
+            .select_from(nearest)
+            .order_by(distance)
+            .limit(limit * overfetch)
+        )
+    if max_distance is not None:
+        candidates = candidates.where(distance <= max_distance)
+    candidates = candidates.lateral("candidate")
+
+    return _with_locations(
+        query.c.hash,
+        candidates,
+        query.join(candidates, true()),
+        limit,
+    )
+
+
+def candidates_statement(candidates: Sequence[tuple[str, str, float]], limit: int = 2):
+    """
+    Resolves (query snippet hash, candidate snippet hash, distance) rows found
+    by a `VectorSearch` to up to `limit` archives per candidate, the same as
+    the second half of `similar_snippets_statement`.
+    """
+    rows = values(
+        column("query_hash", String(64)),
+        column("snippet_hash", String(64)),
+        column("distance", Float),
+        name="candidate",
+    ).data(list(candidates))
+    return _with_locations(rows.c.query_hash, rows, rows, limit)
+
+
+def _with_locations(query_hash, candidates, from_, limit: int):
+    locations = (
         select(
+            FileInArchive.id.label("file_in_archive_id"),
+            SnippetInNormalizedFile.id.label("snippet_in_normalized_file_id"),
+        )
+        .select_from(SnippetInNormalizedFile)
+        .join(
+            File, File.normalized_hash == SnippetInNormalizedFile.normalized_file_hash
+        )
+        .join(File.archives)
+        .where(SnippetInNormalizedFile.snippet_hash == candidates.c.snippet_hash)
+        .order_by(FileInArchive.vendor_level)
+        .limit(limit)
+        .lateral("location")
+    )
+
+    return (
+        select(
+            query_hash,
             FileInArchive,
-            (Snippet.embedding.l2_distance(snippet.embedding).label("distance")),
+            candidates.c.distance,
             SnippetInNormalizedFile,
         )
-        .join(File.normalized)
-        .join(File.archives)
-        .join(NormalizedFile.snippets)
-        .join(SnippetInNormalizedFile.snippet)
-        .order_by("distance")
-        .limit(2)
+        .select_from(from_)
+        .join(locations, true())
+        .join(FileInArchive, FileInArchive.id == locations.c.file_in_archive_id)
+        .join(
+            SnippetInNormalizedFile,
+            SnippetInNormalizedFile.id == locations.c.snippet_in_normalized_file_id,
+        )
+        .order_by(query_hash, candidates.c.distance, FileInArchive.vendor_level)
     )
+
+
+def find_archives_containing_similar_snippets(
+    snippets: Sequence[Snippet],
+    session: Session,
+    limit: int = 2,
+    ef_search: int | None = None,
+    overfetch: int = DEFAULT_OVERFETCH,
+    max_distance: float | None = None,
+    backend: VectorSearch | None = None,
+    quantization: str = VECTOR_QUANTIZATION,
+    rerank: int = DEFAULT_RERANK,
+) -> dict[str, list[tuple[FileInArchive, float, SnippetInNormalizedFile]]]:
+    """
+    Returns {snippet hash: [(file_in_archive, distance, snippet_in_normalized_file)]}
+    with the nearest `limit` matches for every one of `snippets` (possibly
+    none), including verbatim copies at distance 0, in a single round-trip.
+
+    With a `backend`, the nearest neighbours come from it rather than pgvector,
+    and the database is only asked where those are.
+
+    Only `hash` and `embedding` of the snippets are used, so they can also be
+    `lookup.QuerySnippet`s for a file that hasn't been imported.
+    """
+    results: dict[str, list] = {s.hash: [] for s in snippets}
+    if not results:
+        return results
+    if backend is None:
+        set_ef_search(session, ef_search)
+        stmt = similar_snippets_statement(
+            snippets, limit, overfetch, max_distance, quantization, rerank
+        )
+    else:
+        unique = list({s.hash: s for s in snippets}.values())
+        found = backend.search([s.embedding for s in unique], limit * overfetch)
+        candidates = [
+            (s.hash, h, distance)
+            for s, nearest in zip(unique, found)
+            for h, distance in nearest
+            if max_distance is None or distance <= max_distance
+        ]
+        if not candidates:
+            return results
+        stmt = candidates_statement(candidates, limit)
+
+    for h, m, distance, norm_snippet in session.execute(stmt):
+        if len(results[h]) < limit:
+            results[h].append((m, distance, norm_snippet))
+    return results
+
+
+def find_archives_containing_similar_snippet(
+    snippet: Snippet, session: Session, **kwargs
+) -> list[tuple[FileInArchive, float, SnippetInNormalizedFile]]:
+    return find_archives_containing_similar_snippets([snippet], session, **kwargs)[
+        snippet.hash
+    ]
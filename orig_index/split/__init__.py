@@ -27,6 +27,8 @@ python again.
 """
 
 import ast
+import bisect
+import itertools
 import re
 import textwrap
 
@@ -69,6 +71,38 @@ class FunctionFinder(ShortCircuitingVisitor):
         self.covered_ranges[(first_node.lineno - 1, node.end_lineno)] = node
 
 
+class _OutermostFunctions(ShortCircuitingVisitor):
+    """
+    The same functions that `FunctionFinder` finds, in the order they appear.
+    """
+
+    def __init__(self):
+        self.nodes = []
+
+    def visit_FunctionDef(self, node):
+        self.nodes.append(node)
+
+
+class _SpanRecordingUnparser(ast._Unparser):
+    """
+    Behaves like `ast.unparse`, but also records which pieces of the output
+    (indices into `_source`) each of the given nodes wrote, and at which indent.
+    """
+
+    def __init__(self, nodes=(), **kwargs):
+        # f-strings are unparsed by a new instance of the same class
+        super().__init__(**kwargs)
+        self.ids = {id(n) for n in nodes}
+        self.spans = {}
+
+    def traverse(self, node):
+        if isinstance(node, list) or id(node) not in self.ids:
+            return super().traverse(node)
+        start = len(self._source)
+        super().traverse(node)
+        self.spans[id(node)] = (start, len(self._source), self._indent)
+
+
 def remove_whitespace_bookending(lines):
     while lines and WHITESPACE_RE.fullmatch(lines[0]):
         lines.pop(0)
@@ -86,16 +120,68 @@ def segment(mod: ast.Module):
     ff = FunctionFinder()
     ff.visit(mod)
     lines = whitespace_removed_source.splitlines(True)
+    yield from _segments(
+        lines,
+        [
+            (i, j, ast.unparse(node))
+            for (i, j), node in sorted(ff.covered_ranges.items())
+        ],
+    )
+
+
+def _segments(lines, ranges):
+    """
+    Given the lines of unparsed source, and sorted (start, end, text) of the
+    functions in it, yields those and the (dedented) runs of lines between.
+    """
     prev = 0
-    for (i, j), node in sorted(ff.covered_ranges.items()):
+    for i, j, text in ranges:
         if prev != i:
             between = "".join(remove_whitespace_bookending(lines[prev:i]))
             if between and not WHITESPACE_RE.fullmatch(between):
                 yield (prev, i, textwrap.dedent(between))
-        yield (i, j, ast.unparse(node))
+        yield (i, j, text)
         prev = j
 
     if prev != len(lines):
         between = "".join(remove_whitespace_bookending(lines[prev : len(lines)]))
         if between and not WHITESPACE_RE.fullmatch(between):
             yield (prev, len(lines), textwrap.dedent(between))
+
+
+def unparse_and_segment(mod: ast.Module) -> tuple[str, list[tuple[int, int, str]]]:
+    """
+    Returns `(ast.unparse(mod), list(segment(mod)))`, but with a single unparse
+    of the module and no reparse.
+
+    Instead of finding where functions ended up by parsing the unparsed source
+    again, their lines are recorded while unparsing it.  Functions at the top
+    level are then sliced out of that; nested ones (methods) are unparsed on
+    their own, as the text of their multiline strings wouldn't dedent cleanly.
+    """
+    finder = _OutermostFunctions()
+    finder.visit(mod)
+    unparser = _SpanRecordingUnparser(finder.nodes)
+    source = unparser.visit(mod)
+    offsets = list(itertools.accumulate(map(len, unparser._source), initial=0))
+
+    lines = source.splitlines(True)
+    line_starts = list(itertools.accumulate(map(len, lines), initial=0))
+
+    def line_of(pos):
+        return bisect.bisect_right(line_starts, pos) - 1
+
+    ranges = []
+    for node in finder.nodes:
+        a, b, indent = unparser.spans[id(node)]
+        # Each statement starts with a newline (two for functions), not its own
+        text = source[offsets[a] : offsets[b]].lstrip("\n")
+        start = offsets[b] - len(text)
+        ranges.append(
+            (
+                line_of(start),
+                line_of(offsets[b] - 1) + 1,
+                text if indent == 0 else ast.unparse(node),
+            )
+        )
+    return source, list(_segments(lines, sorted(ranges)))
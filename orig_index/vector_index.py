@@ -0,0 +1,312 @@
+"""
+A local, in-process nearest neighbour index over snippet embeddings.
+
+This is an alternative to pgvector for the first phase of similarity lookups
+(see `similarity.py`), so that a lookup node only needs read access to the
+database for resolving a handful of candidates to archives.  Enable for
+`orig lookup` with `--vector-index` or `VECTOR_INDEX_DIR`, and keep it current
+with `orig refresh-vector-index`.
+
+Vectors live in memory-mapped float32 files that grow as snippets are added,
+alongside their hashes and squared norms.  Once there are enough of them, an
+IVF structure (k-means centroids, and the nearest centroid of every row) limits
+each query to the rows of its `nprobe` nearest lists; distances to those are
+exact L2, computed with numpy for all queries at once.
+"""
+
+import json
+import math
+from pathlib import Path
+from typing import Any, Optional, Sequence, Union
+
+import numpy
+from sqlalchemy import select
+
+from .bulk import select_in
+from .db import Snippet
+
+# Below this many vectors a brute force scan is fast enough
+IVF_MIN_ROWS = 50_000
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 10
+# Rows per matrix multiplication, to bound temporary memory
+SCAN_CHUNK = 65536
+# k-means is run on a sample of at most this many rows, into at most this many
+# lists, so that training takes bounded memory however large the index gets
+KMEANS_MAX_SAMPLE = 262144
+MAX_NLIST = 4096
+INITIAL_CAPACITY = 4096
+
+
+class LocalVectorIndex:
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        dimension: int,
+        nprobe: int = DEFAULT_NPROBE,
+    ) -> None:
+        self.path = Path(directory)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.nprobe = nprobe
+
+        meta_path = self.path / "meta.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            # An existing index keeps its shape, regardless of what was asked for
+            if meta["dimension"] != dimension:
+                raise ValueError(
+                    f"Index at {self.path} has dimension {meta['dimension']}, "
+                    f"not {dimension}"
+                )
+        else:
+            meta = {
+                "dimension": dimension,
+                "count": 0,
+                "capacity": INITIAL_CAPACITY,
+                "trained_count": 0,
+            }
+        self.dimension = dimension
+        self.count: int = meta["count"]
+        self.capacity: int = meta["capacity"]
+        self.trained_count: int = meta["trained_count"]
+        self._map()
+
+        centroids_path = self.path / "centroids.npy"
+        self.centroids: Optional[numpy.ndarray] = (
+            numpy.load(centroids_path) if centroids_path.exists() else None
+        )
+        self.rows = {h.decode(): i for i, h in enumerate(self.hashes[: self.count])}
+        # Rows grouped by list, and where each list starts; built on first search
+        self._by_list: Optional[tuple[numpy.ndarray, numpy.ndarray]] = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _memmap(self, name: str, dtype: Any, shape: tuple[int, ...]) -> numpy.memmap:
+        path = self.path / name
+        size = math.prod(shape) * numpy.dtype(dtype).itemsize
+        # Growing is just extending the file; the new rows read as zeros
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return numpy.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _map(self) -> None:
+        self.vectors = self._memmap(
+            "vectors.f32", numpy.float32, (self.capacity, self.dimension)
+        )
+        self.norms = self._memmap("norms.f32", numpy.float32, (self.capacity,))
+        self.hashes = self._memmap("hashes.bin", "S64", (self.capacity,))
+        # Which IVF list each row is in, meaningless until trained
+        self.lists = self._memmap("lists.i32", numpy.int32, (self.capacity,))
+
+    def _save_meta(self) -> None:
+        for m in (self.vectors, self.norms, self.hashes, self.lists):
+            m.flush()
+        (self.path / "meta.json").write_text(
+            json.dumps(
+                {
+                    "dimension": self.dimension,
+                    "count": self.count,
+                    "capacity": self.capacity,
+                    "trained_count": self.trained_count,
+                }
+            )
+        )
+
+    def add(self, hashes: Sequence[str], vectors: Any) -> int:
+        """
+        Appends whichever of `hashes` aren't already present, returning how many.
+        """
+        new = {h: v for h, v in zip(hashes, vectors) if h not in self.rows}
+        if not new:
+            return 0
+        n = len(new)
+        if self.count + n > self.capacity:
+            while self.count + n > self.capacity:
+                self.capacity *= 2
+            self._map()
+
+        start, end = self.count, self.count + n
+        block = numpy.asarray(list(new.values()), dtype=numpy.float32)
+        self.vectors[start:end] = block
+        self.norms[start:end] = (block * block).sum(axis=1)
+        self.hashes[start:end] = [h.encode() for h in new]
+        if self.centroids is not None:
+            self.lists[start:end] = self._assign(block)
+        self.rows.update((h, start + i) for i, h in enumerate(new))
+        self.count = end
+        self._by_list = None
+
+        # Centroids trained on a much smaller corpus make for lopsided lists
+        if self.count >= IVF_MIN_ROWS and self.count >= 2 * self.trained_count:
+            self.train()
+        self._save_meta()
+        return n
+
+    def train(self, nlist: Optional[int] = None, seed: int = 0) -> None:
+        """
+        Runs k-means over a sample of the vectors and reassigns every row to
+        its nearest centroid.  Both `nlist` and the sample are capped (see
+        `MAX_NLIST` and `KMEANS_MAX_SAMPLE`).
+        """
+        if nlist is None:
+            nlist = max(1, int(math.sqrt(self.count)))
+        nlist = min(nlist, MAX_NLIST, self.count)
+        r = numpy.random.default_rng(seed)
+        sample_size = min(self.count, 256 * nlist, KMEANS_MAX_SAMPLE)
+        sample = numpy.array(
+            self.vectors[numpy.sort(r.choice(self.count, sample_size, replace=False))]
+        )
+        centroids = sample[r.choice(sample_size, nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            self.centroids = centroids
+            assignment = self._assign(sample)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, sample)
+            counts = numpy.bincount(assignment, minlength=nlist)
+            # Empty clusters keep their old centroid
+            nonempty = counts > 0
+            centroids = centroids.copy()
+            centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        self.centroids = centroids
+        numpy.save(self.path / "centroids.npy", centroids)
+
+        self.lists[: self.count] = self._assign(self.vectors[: self.count])
+        self.trained_count = self.count
+        self._by_list = None
+        self._save_meta()
+
+    def _assign(self, vectors: numpy.ndarray) -> numpy.ndarray:
+        """
+        The nearest centroid of each of `vectors` (which may be memory-mapped),
+        a block at a time so the distance matrix stays small.
+        """
+        assert self.centroids is not None
+        step = max(1, SCAN_CHUNK * 256 // len(self.centroids))
+        assignment = numpy.empty(len(vectors), dtype=numpy.int32)
+        for start in range(0, len(vectors), step):
+            block = numpy.asarray(vectors[start : start + step])
+            assignment[start : start + step] = self._nearest_centroids(block, 1)[:, 0]
+        return assignment
+
+    def _nearest_centroids(self, queries: numpy.ndarray, n: int) -> numpy.ndarray:
+        assert self.centroids is not None
+        d = (
+            (queries * queries).sum(axis=1)[:, None]
+            - 2 * queries @ self.centroids.T
+            + (self.centroids * self.centroids).sum(axis=1)[None, :]
+        )
+        if n == 1:
+            return numpy.argmin(d, axis=1)[:, None]
+        n = min(n, len(self.centroids))
+        return numpy.argpartition(d, n - 1, axis=1)[:, :n]
+
+    def _list_rows(self, lists: numpy.ndarray) -> numpy.ndarray:
+        assert self.centroids is not None
+        if self._by_list is None:
+            order = numpy.argsort(self.lists[: self.count], kind="stable")
+            offsets = numpy.searchsorted(
+                self.lists[: self.count][order], numpy.arange(len(self.centroids) + 1)
+            )
+            self._by_list = (order, offsets)
+        order, offsets = self._by_list
+        return numpy.sort(
+            numpy.concatenate([order[offsets[i] : offsets[i + 1]] for i in lists])
+        )
+
+    def _scan(
+        self, queries: numpy.ndarray, rows: Optional[numpy.ndarray], k: int
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        Exact top `k` (rows, squared distances) of `queries` among `rows`, or
+        among everything if None.
+        """
+        q_norms = (queries * queries).sum(axis=1)[:, None]
+        best_rows = numpy.zeros((len(queries), 0), dtype=numpy.int64)
+        best_d = numpy.zeros((len(queries), 0), dtype=numpy.float32)
+        total = self.count if rows is None else len(rows)
+        for start in range(0, total, SCAN_CHUNK):
+            if rows is None:
+                chunk_rows = numpy.arange(start, min(start + SCAN_CHUNK, total))
+                vectors = self.vectors[start : start + len(chunk_rows)]
+            else:
+                chunk_rows = rows[start : start + SCAN_CHUNK]
+                vectors = self.vectors[chunk_rows]
+            d = q_norms - 2 * queries @ vectors.T + self.norms[chunk_rows][None, :]
+            all_rows = numpy.concatenate(
+                [best_rows, numpy.broadcast_to(chunk_rows, d.shape)], axis=1
+            )
+            all_d = numpy.concatenate([best_d, d], axis=1)
+            keep = min(k, all_d.shape[1])
+            top = numpy.argpartition(all_d, keep - 1, axis=1)[:, :keep]
+            best_rows = numpy.take_along_axis(all_rows, top, axis=1)
+            best_d = numpy.take_along_axis(all_d, top, axis=1)
+        return best_rows, best_d
+
+    def search(self, queries: Any, k: int) -> list[list[tuple[str, float]]]:
+        """
+        Returns the nearest `k` (hash, l2 distance) for each query, nearest
+        first.
+        """
+        queries = numpy.atleast_2d(numpy.asarray(queries, dtype=numpy.float32))
+        if not self.count:
+            return [[] for _ in queries]
+
+        # Scanning lists separately for each query only pays off while that
+        # adds up to less than one scan of everything, shared by all of them.
+        if self.centroids is None or len(queries) * self.nprobe >= len(self.centroids):
+            results = [self._scan(queries, None, k)]
+            groups = [numpy.arange(len(queries))]
+        else:
+            # Queries probing the same lists share one scan
+            probes = numpy.sort(self._nearest_centroids(queries, self.nprobe), axis=1)
+            keys, inverse = numpy.unique(probes, axis=0, return_inverse=True)
+            results, groups = [], []
+            for i, key in enumerate(keys):
+                group = numpy.flatnonzero(inverse.ravel() == i)
+                rows = self._list_rows(key)
+                results.append(self._scan(queries[group], rows, k))
+                groups.append(group)
+
+        ret: list[list[tuple[str, float]]] = [[] for _ in queries]
+        for (rows, d), group in zip(results, groups):
+            order = numpy.argsort(d, axis=1)
+            for qi, row_order, q_rows, q_d in zip(group, order, rows, d):
+                ret[qi] = [
+                    (
+                        self.hashes[q_rows[j]].decode(),
+                        math.sqrt(max(0.0, float(q_d[j]))),
+                    )
+                    for j in row_order[:k]
+                ]
+        return ret
+
+    def refresh(self, session, batch_size: int = 10000) -> int:
+        """
+        Adds snippets from the database that have an embedding but aren't in
+        the index yet, returning how many.  Hashes aren't in insertion order,
+        so all of them are scanned (in primary key order) every time, but
+        embeddings are fetched just for new ones.
+        """
+        added = 0
+        after = ""
+        while True:
+            hashes = session.scalars(
+                select(Snippet.hash)
+                .where(Snippet.hash > after)
+                .order_by(Snippet.hash)
+                .limit(batch_size)
+            ).all()
+            if not hashes:
+                break
+            after = hashes[-1]
+            new = [h for h in hashes if h not in self.rows]
+            if new:
+                rows = [
+                    (h, e)
+                    for h, e in select_in(session, Snippet.hash, new, Snippet.embedding)
+                    if e is not None
+                ]
+                added += self.add([h for h, _ in rows], [e for _, e in rows])
+        return added
@@ -1,21 +1,30 @@
+import asyncio
 import html
 import logging
-from pathlib import Path
+import os
+from typing import AsyncIterator
 
-from fastapi import FastAPI, Request, UploadFile
+from fastapi import Depends, FastAPI, Request, UploadFile
 from fastapi.exceptions import HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+)
 from fastapi.staticfiles import StaticFiles
 from jinja2_fragments.fastapi import Jinja2Blocks
-from packaging.utils import canonicalize_name
-from pypi_simple import ACCEPT_JSON_ONLY, PyPISimple
+from sqlalchemy import select
+
+from . import db, jobs
 
 from .api.archive import api_explore_files_in_archive
 from .api.normalized import api_normalized_detail, api_normalized_partial
 from .api.snippets import api_snippet_detail
-
-from .db import File, Session, Snippet
-from .importer import import_one_local_file, import_url
+from .db import File, Job, Snippet, SnippetInNormalizedFile
+from .metrics import METRICS
+from .offload import BoundedExecutor, Overloaded
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
@@ -36,6 +45,17 @@ class App(FastAPI):
 
 
 APP = App()
+# For the CPU-bound part of requests, see `offload.py`
+OFFLOAD = BoundedExecutor()
+# Whether to also run queued jobs here rather than only in `orig worker`, for
+# small single-process setups; imports then compete with requests for OFFLOAD.
+WEB_RUN_JOBS = os.environ.get("WEB_RUN_JOBS", "0") != "0"
+
+
+async def get_session() -> AsyncIterator:
+    async with db.AsyncSession() as session:
+        yield session
+
 
 APP.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -46,15 +66,15 @@ async def index(request: Request) -> str:
 
 
 @APP.get("/api/archive/hash/{hash}")
-def archive_hash(hash: str):
+async def archive_hash(hash: str, session=Depends(get_session)):
     """
     Intended to power an inspector-like gui based on archive hash
     """
-    return api_explore_files_in_archive(hash)
+    return await api_explore_files_in_archive(hash, session)
 
 
 @APP.get("/api/normalized/hash/{hash}", response_class=HTMLResponse)
-def normalized_detail(hash: str, request: Request):
+async def normalized_detail(hash: str, request: Request, session=Depends(get_session)):
     """
     Serves the text of the snippets, and mentions what the "oldest" archive
     containing this normalized file is.
@@ -62,25 +82,28 @@ def normalized_detail(hash: str, request: Request):
     Calculating hash-matches of snippets or embedding-similarity of matches is a
     lot more expensive, and should lazy-load from other endpoints.
     """
-    results = api_normalized_detail(hash)
+    results = await api_normalized_detail(hash, session)
     return templates.TemplateResponse(
         "index.html", {"request": request, "results": results}, block_name="results"
     )
 
 
 @APP.get("/api/normalized/partial/{hash}", response_class=HTMLResponse)
-def normalized_partial(hash: str, request: Request):
+async def normalized_partial(hash: str, request: Request, session=Depends(get_session)):
     """
     Search for hashes of snippets of this normalized file, assuming that the
     snippets are unmodified.
     """
-    results = api_normalized_detail(hash)
-    partial = api_normalized_partial(hash)
+    results = await api_normalized_detail(hash, session)
+    partial = await api_normalized_partial(hash, session)
     snippet_table = "<table border='1'>\n"
     snippet_table += "<tr><th>Source</th>"
 
     for col in partial["found"]:
-        snippet_table += f"<th><a href='{request.url_for('normalized_partial', hash=col['hash'])}' title='{col['hash']}'>{col['hash'][:4]}...</a></th>"
+        title = col["hash"]
+        if col["oldest_archive"]:
+            title += f" first seen in {col['oldest_archive']['purl']}"
+        snippet_table += f"<th><a href='{request.url_for('normalized_partial', hash=col['hash'])}' title='{html.escape(title)}'>{col['hash'][:4]}...</a></th>"
 
     snippet_table += "</tr>\n"
     for i, snip in enumerate(results["snippets"]):
@@ -102,92 +125,181 @@ def normalized_partial(hash: str, request: Request):
     )
 
 
+@APP.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Importer timings and hit rates (for imports run by this process), in the
+    prometheus text format.
+    """
+    return METRICS.to_prometheus()
+
+
+@APP.get("/api/metrics")
+def api_metrics():
+    return METRICS.snapshot()
+
+
 @APP.get("/api/snippet-detail/hash/{hash}")
-def snippet_detail(hash: str):
+async def snippet_detail(hash: str, session=Depends(get_session)):
     """
     Intended to power a drill-down page at some point.
     """
-    return api_snippet_detail(hash)
+    return await api_snippet_detail(hash, session)
 
 
 @APP.post("/import/project-url/")
-def import_project_url(project: str, url: str, request: Request):
+async def import_project_url(
+    project: str, url: str, request: Request, session=Depends(get_session)
+):
     """
-    Indexes one known url from the given project.
+    Queues indexing one known url from the given project.
 
     This is primarily intended for testing, as these would be indexed by some
     background process in due course in a production environment.
 
-    The url must correspond to a DistributionPackage in this project.
-    """
-
-    ps = PyPISimple(accept=ACCEPT_JSON_ONLY)
-    cn = canonicalize_name(project)
-    pp = ps.get_project_page(cn)
-    for distribution_package in pp.packages:
-        if distribution_package.url == url:
-            if distribution_package.package_type not in ("sdist", "wheel"):
-                raise HTTPException(500)
-
-            upload_time = distribution_package.upload_time
-            assert upload_time is not None
-            import_url(
-                hash=distribution_package.digests["sha256"],
-                url=distribution_package.url,
-                date=upload_time,
-                project=cn,
-                version=distribution_package.version,
-            )
-            return RedirectResponse(
-                request.url_for(
-                    "archive_hash", hash=distribution_package.digests["sha256"]
-                ),
-                status_code=303,
-            )
-    else:
-        raise HTTPException(404)
+    The url must correspond to a DistributionPackage in this project; that's
+    checked by the job, see `jobs.py`.
+    """
+    job = await _enqueue(
+        session, "import_project_url", {"project": project, "url": url}
+    )
+    return _job_response(request, job)
 
 
 @APP.get("/file/hash/{hash}")
-def file_hash(hash: str, request: Request):
-    with Session() as session:
-        f = session.get(File, hash)
-        if not f:
-            raise HTTPException(404)
-
-        return RedirectResponse(
-            request.url_for("normalized_detail", hash=f.normalized_hash),
-            status_code=303,
-        )
+async def file_hash(hash: str, request: Request, session=Depends(get_session)):
+    f = await session.get(File, hash)
+    if not f:
+        raise HTTPException(404)
+
+    return RedirectResponse(
+        request.url_for("normalized_detail", hash=f.normalized_hash),
+        status_code=303,
+    )
 
 
 @APP.get("/snippet/hash/{hash}")
-def sinppet_hash(hash: str):
-    with Session() as session:
-        s = session.get(Snippet, hash)
-        if not s:
-            raise HTTPException(404)
-        return {
-            "text": s.text,
-            "norm_count": len(s.normalized_files),
-            "norm_files": [x.normalized_file_hash for x in s.normalized_files],
-        }
+async def sinppet_hash(hash: str, session=Depends(get_session)):
+    s = await session.get(Snippet, hash)
+    if not s:
+        raise HTTPException(404)
+    norm_files = list(
+        await session.scalars(
+            select(SnippetInNormalizedFile.normalized_file_hash).where(
+                SnippetInNormalizedFile.snippet_hash == hash
+            )
+        )
+    )
+    return {
+        "text": s.text,
+        "norm_count": len(norm_files),
+        "norm_files": norm_files,
+    }
 
 
 @APP.post("/identify/file/")
-async def identify_file(file: UploadFile, request: Request):
-    local_file = Path(file.filename)
-
-    with Session() as session:
-        imported = import_one_local_file(
-            fp=None,
-            rel=local_file,
-            session=session,
-            file=file.file,
-        )
-        session.commit()
+async def identify_file(
+    file: UploadFile, request: Request, session=Depends(get_session)
+):
+    data = await file.read()
+    job = await _enqueue(
+        session, "identify_file", {"filename": file.filename}, payload=data
+    )
+    return _job_response(request, job)
+
+
+@APP.get("/api/jobs/{id}")
+async def api_job(id: int, session=Depends(get_session)):
+    job = await session.get(Job, id)
+    if not job:
+        raise HTTPException(404)
+    return jobs.job_status(job)
+
+
+@APP.get("/jobs/{id}", response_class=HTMLResponse)
+async def job_detail(id: int, request: Request, session=Depends(get_session)):
+    """
+    Polled by the page until the job is done, then redirects to its result.
+    """
+    job = await session.get(Job, id)
+    if not job:
+        raise HTTPException(404)
+    if job.status == "done":
+        if job.kind == "identify_file" and not job.result["known"]:
+            # Nothing to link to, as lookups aren't imported
+            return templates.TemplateResponse(
+                "index.html",
+                {
+                    "request": request,
+                    "results": {
+                        "hash": job.result["normalized_hash"],
+                        "oldest_archive": None,
+                        "snippets": job.result["snippets"],
+                    },
+                },
+                block_name="results",
+            )
+        if job.kind == "identify_file":
+            url = request.url_for(
+                "normalized_detail", hash=job.result["normalized_hash"]
+            )
+        else:
+            url = request.url_for("archive_hash", hash=job.result["archive_hash"])
+        # htmx follows this, swapping in the result in place of the poller
+        return RedirectResponse(url, status_code=303)
+    return _job_response(request, job)
+
+
+# Keeps the in-process workers' tasks from being garbage collected
+_TASKS: set[asyncio.Task] = set()
+
 
-        return RedirectResponse(
-            request.url_for("normalized_detail", hash=imported.normalized_hash),
-            status_code=303,
+# Backoff while OFFLOAD is too busy to take a queued job
+JOB_RETRY_DELAY = 0.5
+JOB_MAX_RETRY_DELAY = 30.0
+
+
+async def _run_job() -> None:
+    """
+    Runs queued jobs until there are none left, so that one turned away
+    earlier gets picked up by whichever task next has room.
+    """
+    delay = JOB_RETRY_DELAY
+    while True:
+        try:
+            if not await OFFLOAD.run(jobs.run_one):
+                return
+            delay = JOB_RETRY_DELAY
+        except Overloaded:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, JOB_MAX_RETRY_DELAY)
+
+
+async def _enqueue(session, kind: str, params: dict, payload: bytes | None = None):
+    job = jobs.enqueue(session, kind, params, payload)
+    await session.commit()
+    if WEB_RUN_JOBS:
+        task = asyncio.create_task(_run_job())
+        _TASKS.add(task)
+        task.add_done_callback(_TASKS.discard)
+    return job
+
+
+def _job_response(request: Request, job: Job) -> Response:
+    status_url = request.url_for("job_detail", id=job.id)
+    if job.status == "failed":
+        error = (job.error or "").strip().splitlines()[-1:] or ["Failed"]
+        return HTMLResponse(f"<pre>{html.escape(error[0])}</pre>")
+    if request.headers.get("HX-Request"):
+        return HTMLResponse(
+            f"<div hx-get='{status_url}' hx-trigger='load delay:1s' "
+            f"hx-swap='outerHTML'>{html.escape(job.status)}...</div>"
         )
+    return JSONResponse(
+        {
+            "id": job.id,
+            "status": job.status,
+            "status_url": str(request.url_for("api_job", id=job.id)),
+        },
+        status_code=202,
+    )
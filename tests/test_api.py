@@ -0,0 +1,77 @@
+import asyncio
+import datetime
+
+import pytest
+from fastapi.exceptions import HTTPException
+
+from orig_index.api.archive import api_explore_files_in_archive
+from orig_index.api.normalized import api_normalized_detail
+from orig_index.api.snippets import api_snippet_detail
+from orig_index.db import (
+    Archive,
+    Base,
+    File,
+    FileInArchive,
+    NormalizedFile,
+    Snippet,
+    SnippetInNormalizedFile,
+)
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+DATE = datetime.datetime(2020, 1, 1)
+
+
+async def make_session_factory():
+    engine = create_async_engine("sqlite+aiosqlite://", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+    async with factory() as session:
+        session.add(
+            Archive(
+                hash="a",
+                url="https://example.com/x-1.0.tar.gz",
+                timestamp=DATE,
+                canonical_name="x",
+                version="1.0",
+            )
+        )
+        session.add(NormalizedFile(hash="n", first_seen=DATE, first_archive_hash="a"))
+        session.add(
+            Snippet(hash="s", text="x = 1", first_seen=DATE, first_archive_hash="a")
+        )
+        session.add(File(hash="f", normalized_hash="n"))
+        session.add(FileInArchive(archive_hash="a", file_hash="f", sample_name="x.py"))
+        session.add(
+            SnippetInNormalizedFile(
+                normalized_file_hash="n", snippet_hash="s", sequence=0
+            )
+        )
+        await session.commit()
+    return factory
+
+
+def test_api():
+    async def run():
+        factory = await make_session_factory()
+        async with factory() as session:
+            archive = await api_explore_files_in_archive("a", session)
+            assert archive["files"] == [{"normalized_hash": "n", "sample_name": "x.py"}]
+
+            normalized = await api_normalized_detail("n", session)
+            assert normalized["snippets"] == [{"hash": "s", "text": "x = 1"}]
+            assert normalized["oldest_archive"] == {
+                "hash": "a",
+                "purl": "pkg:pypi/x@1.0",
+                "timestamp": DATE,
+            }
+
+            snippet = await api_snippet_detail("s", session)
+            assert snippet["first_seen"]["purl"] == "pkg:pypi/x@1.0"
+            assert [a["count"] for a in snippet["archives"]] == [1]
+
+            with pytest.raises(HTTPException):
+                await api_normalized_detail("missing", session)
+
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+import hashlib
+import io
+import shutil
+import tarfile
+import zipfile
+from pathlib import PurePosixPath
+
+from orig_index.archives import (
+    iter_archive_members,
+    iter_local_dir,
+    stream_archive_members,
+)
+
+FILES = {
+    "pkg-1.0/pkg/__init__.py": b"",
+    "pkg-1.0/pkg/mod.py": b"def f(x):\n    pass\n",
+    "pkg-1.0/pkg/data.bin": b"\x00" * 1000,
+    "pkg-1.0/.venv/lib/site.py": b"x = 1\n",
+    "pkg-1.0/setup.py": b"import setuptools\n",
+}
+EXPECTED = {
+    PurePosixPath("pkg-1.0/pkg/__init__.py"): b"",
+    PurePosixPath("pkg-1.0/pkg/mod.py"): b"def f(x):\n    pass\n",
+    PurePosixPath("pkg-1.0/setup.py"): b"import setuptools\n",
+}
+
+
+def make_tar(path):
+    with tarfile.open(path, "w:gz") as tf:
+        for name, data in FILES.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+        link = tarfile.TarInfo("pkg-1.0/link.py")
+        link.type = tarfile.SYMTYPE
+        link.linkname = "setup.py"
+        tf.addfile(link)
+
+
+def make_zip(path):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, data in FILES.items():
+            zf.writestr(name, data)
+
+
+def test_tar(tmp_path):
+    make_tar(tmp_path / "pkg-1.0.tar.gz")
+    assert dict(iter_archive_members(tmp_path / "pkg-1.0.tar.gz")) == EXPECTED
+    with open(tmp_path / "pkg-1.0.tar.gz", "rb") as f:
+        assert dict(iter_archive_members("pkg-1.0.tar.gz", f)) == EXPECTED
+
+
+def test_zip(tmp_path):
+    make_zip(tmp_path / "pkg-1.0.whl")
+    assert dict(iter_archive_members(tmp_path / "pkg-1.0.whl")) == EXPECTED
+
+
+def test_same_as_extracting(tmp_path):
+    make_zip(tmp_path / "pkg-1.0.zip")
+    shutil.unpack_archive(tmp_path / "pkg-1.0.zip", tmp_path / "x", format="zip")
+    assert dict(iter_local_dir(tmp_path / "x")) == EXPECTED
+
+
+def chunked(data, n=7):
+    return (data[i : i + n] for i in range(0, len(data), n))
+
+
+def test_stream_archive_members(tmp_path):
+    make_tar(tmp_path / "pkg-1.0.tar.gz")
+    make_zip(tmp_path / "pkg-1.0.whl")
+    for name in ("pkg-1.0.tar.gz", "pkg-1.0.whl"):
+        data = (tmp_path / name).read_bytes()
+        h, members = stream_archive_members(name, chunked(data))
+        assert h == hashlib.sha256(data).hexdigest()
+        assert dict(members) == EXPECTED
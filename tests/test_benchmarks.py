@@ -0,0 +1,51 @@
+import ast
+
+from orig_index import importer
+from orig_index.benchmarks import (
+    run_benchmark,
+    run_normalize_benchmark,
+    sqlite_session_factory,
+    ZeroModel,
+)
+from orig_index.benchmarks.corpus import generate_corpus
+
+SHAPE = ((3, 4), (1, 10))
+
+
+def test_corpus_is_deterministic_and_parses():
+    packages = generate_corpus(1, SHAPE)
+    assert packages == generate_corpus(1, SHAPE)
+    assert packages != generate_corpus(2, SHAPE)
+    assert [len(p) for p in packages] == [4, 4, 4, 10]
+    for members in packages:
+        for name, data in members:
+            assert name.suffix == ".py"
+            ast.parse(data)
+
+
+def test_run_benchmark(monkeypatch):
+    # The insert stage reuses what the earlier stages prepared
+    def prepare_file(*args):
+        raise AssertionError("prepared again")
+
+    monkeypatch.setattr(importer, "prepare_file", prepare_file)
+    results = run_benchmark(
+        generate_corpus(0, SHAPE), ZeroModel(), sqlite_session_factory()
+    )
+    assert [r.name for r in results] == [
+        "hash",
+        "parse",
+        "normalize",
+        "segment",
+        "encode",
+        "insert",
+    ]
+    assert all(r.files == 22 for r in results)
+    assert results[-1].snippets > 0
+
+
+def test_run_normalize_benchmark():
+    datas = [data for members in generate_corpus(0, SHAPE) for _, data in members]
+    results = run_normalize_benchmark(datas)
+    assert [r.name for r in results] == ["roundtrip", "single"]
+    assert all(r.files == 22 and r.snippets > 0 for r in results)
@@ -0,0 +1,52 @@
+from orig_index.bulk import (
+    chunks,
+    insert_ignoring_conflicts,
+    MAX_PARAMETERS,
+    rows_per_statement,
+    STATS,
+)
+from orig_index.db import Snippet
+
+
+class FakeResult:
+    def __init__(self, values):
+        self.values = values
+
+    def scalars(self):
+        return iter(self.values)
+
+
+class FakeSession:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, stmt):
+        self.statements.append(stmt)
+        params = stmt.compile().params
+        return FakeResult([v for k, v in params.items() if k.startswith("hash")])
+
+
+def test_chunks():
+    assert [list(c) for c in chunks(range(5), 2)] == [[0, 1], [2, 3], [4]]
+    assert list(chunks([], 2)) == []
+
+
+def test_rows_per_statement():
+    assert rows_per_statement(2, budget=10) == 5
+    assert rows_per_statement(3, budget=10**6) == MAX_PARAMETERS // 3
+    assert rows_per_statement(100, budget=10) == 1
+
+
+def test_insert_ignoring_conflicts_chunks():
+    rows = [{"hash": str(i), "text": "x"} for i in range(25)]
+    session = FakeSession()
+    ret = insert_ignoring_conflicts(
+        session,
+        Snippet.__table__,
+        rows,
+        returning=Snippet.__table__.c.hash,
+        budget=20,
+    )
+    assert len(session.statements) == 3
+    assert sorted(ret, key=int) == [str(i) for i in range(25)]
+    assert STATS["snippet"].rows >= 25
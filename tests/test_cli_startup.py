@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+import click
+import pytest
+
+from orig_index.cli import main
+
+# None of these should be needed just to parse arguments or print help
+HEAVY = (
+    "sqlalchemy",
+    "uvicorn",
+    "fastapi",
+    "requests",
+    "pypi_simple",
+    "numpy",
+    "torch",
+    "sentence_transformers",
+    "psycopg",
+    "moreorless",
+)
+
+
+def commands(group: click.Group, prefix: tuple[str, ...] = ()):
+    yield prefix
+    for name, command in group.commands.items():
+        if isinstance(command, click.Group):
+            yield from commands(command, prefix + (name,))
+        else:
+            yield prefix + (name,)
+
+
+def imported(code: str, *args: str) -> dict[str, int]:
+    """
+    Modules imported by running `code`, with their cumulative import time in us.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code, *args],
+        capture_output=True,
+        encoding="utf-8",
+        check=True,
+    )
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def heavy(modules: dict[str, int]) -> dict[str, int]:
+    # A submodule can't be imported without its top-level package
+    return {name: us for name, us in modules.items() if name in HEAVY}
+
+
+@pytest.mark.parametrize("command", list(commands(main)), ids=" ".join)
+def test_help_is_light(command):
+    modules = imported("from orig_index.cli import main; main()", *command, "--help")
+    assert "orig_index.cli" in modules
+    assert heavy(modules) == {}, f"orig_index.cli took {modules['orig_index.cli']}us"
+
+
+def test_db_is_light():
+    modules = imported("import orig_index.db")
+    for name in ("psycopg", "sqlalchemy.ext.asyncio", "requests", "numpy"):
+        assert name not in modules, f"orig_index.db took {modules['orig_index.db']}us"
+
+
+def test_configuration_error(tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != "EMBEDDING_DIMENSION"}
+    env["MODEL_NAME"] = "someone/something"
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from orig_index.cli import main; main()",
+            "lookup",
+            "local-file",
+            str(tmp_path / "x.py"),
+        ],
+        capture_output=True,
+        encoding="utf-8",
+        env=env,
+    )
+    assert proc.returncode == 1
+    assert "Traceback" not in proc.stderr
+    assert "set EMBEDDING_DIMENSION" in proc.stderr
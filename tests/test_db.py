@@ -0,0 +1,23 @@
+from orig_index.db import Base, vector_index_ddl
+from sqlalchemy import create_engine, inspect
+
+
+def test_vector_index_not_built_by_create_all():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    assert "ix_snippet" not in {
+        i["name"] for i in inspect(engine).get_indexes("snippet")
+    }
+
+
+def test_vector_index_ddl():
+    ddl = vector_index_ddl("ix_snippet_new", 32, 128)
+    assert ddl.startswith("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_snippet_new")
+    assert "WITH (m = 32, ef_construction = 128)" in ddl
+
+
+def test_quantized_vector_index_ddl():
+    assert "(CAST(embedding AS HALFVEC(768))) halfvec_l2_ops" in vector_index_ddl(
+        "ix_snippet", 16, 64, "halfvec"
+    )
+    assert "bit_hamming_ops" in vector_index_ddl("ix_snippet", 16, 64, "binary")
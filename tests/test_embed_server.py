@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pytest
+
+from orig_index.embed_server import EmbedClient, EmbedServer
+from orig_index.overly_simple_embedding import SimpleModel
+
+
+class SlowModel(SimpleModel):
+    # So that requests pile up while it's busy
+    def encode(self, texts_or_text, batch_size=32):
+        threading.Event().wait(0.05)
+        return super().encode(texts_or_text, batch_size)
+
+
+class BrokenModel(SimpleModel):
+    def encode(self, texts_or_text, batch_size=32):
+        raise ValueError("nope")
+
+
+@pytest.fixture
+def serve(tmp_path):
+    threads = []
+    servers = []
+
+    def serve(model):
+        server = EmbedServer(model)
+        started = threading.Event()
+        thread = threading.Thread(
+            target=asyncio.run, args=(server.serve(tmp_path / "embed.sock", started),)
+        )
+        thread.start()
+        assert started.wait(5)
+        threads.append(thread)
+        servers.append(server)
+        return server, tmp_path / "embed.sock"
+
+    yield serve
+    for server, thread in zip(servers, threads):
+        server.stop()
+        thread.join(5)
+    assert not (tmp_path / "embed.sock").exists()
+
+
+def test_encode(serve):
+    model = SimpleModel(32)
+    _, path = serve(model)
+    client = EmbedClient(path)
+    assert client.model_id == model.model_id
+    assert client.dimension == 32
+
+    texts = ["def f(): pass", "x = 1", "", "class C:\n    y = 2"]
+    numpy.testing.assert_allclose(client.encode(texts), model.encode(texts), rtol=1e-5)
+    numpy.testing.assert_allclose(
+        client.encode("x = 1"), model.encode("x = 1"), rtol=1e-5
+    )
+    assert client.encode([]).shape == (0, 32)
+    client.close()
+
+
+def test_coalesces_concurrent_clients(serve):
+    model = SlowModel(32)
+    server, path = serve(model)
+    clients = [EmbedClient(path) for _ in range(8)]
+    texts = [[f"x = {i}", f"y = {i} * {i}"] for i in range(8)]
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda c, t: c.encode(t), clients, texts))
+
+    for t, r in zip(texts, results):
+        numpy.testing.assert_allclose(r, model.encode(t), rtol=1e-5)
+    assert server.texts == 16
+    assert server.batches < 8
+
+
+def test_error(serve):
+    _, path = serve(BrokenModel(32))
+    client = EmbedClient(path)
+    with pytest.raises(RuntimeError, match="ValueError: nope"):
+        client.encode(["x = 1"])
+    # Still usable afterwards
+    with pytest.raises(RuntimeError):
+        client.encode(["x = 1"])
+
+
+def test_get_model_uses_server(serve, monkeypatch):
+    from orig_index import importer
+    from orig_index.db import EMBEDDING_DIMENSION
+
+    _, path = serve(SimpleModel(EMBEDDING_DIMENSION))
+    monkeypatch.setattr(importer, "MODEL", None)
+    monkeypatch.setenv("EMBED_SERVER", str(path))
+    model = importer.get_model()
+    assert isinstance(model, EmbedClient)
+    assert model.encode(["x = 1"]).shape == (1, EMBEDDING_DIMENSION)
+    model.close()
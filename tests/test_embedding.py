@@ -0,0 +1,40 @@
+from orig_index.embedding import EmbeddingBatcher, length_batches
+from orig_index.overly_simple_embedding import SimpleModel
+
+
+def test_length_batches_sorted_and_bounded():
+    items = [(str(i), "x" * n) for i, n in enumerate([50, 1, 10, 1000, 5, 20])]
+    batches = list(length_batches(items, max_batch=3, char_budget=100))
+    flat = [t for b in batches for _, t in b]
+    assert [len(t) for t in flat] == [1, 5, 10, 20, 50, 1000]
+    for b in batches:
+        assert len(b) <= 3
+        # a single oversized text is allowed its own batch
+        assert len(b) == 1 or len(b) * max(len(t) for _, t in b) <= 100
+
+
+class FakeSession:
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, stmt, params=None):
+        self.executed.append(params)
+
+
+def test_batcher_flush():
+    model = SimpleModel(8)
+    b = EmbeddingBatcher(lambda: model, max_batch=2, flush_threshold=3)
+    b.add("a", "x = 1")
+    b.add("b", "y = 2")
+    b.add("a", "x = 1")
+    assert len(b) == 2
+    assert not b.should_flush()
+    b.add("c", "def f(x): return x")
+    assert b.should_flush()
+
+    session = FakeSession()
+    assert b.flush(session) == 3
+    assert len(b) == 0
+    assert [len(p) for p in session.executed] == [2, 1]
+    assert {p["hash"] for ps in session.executed for p in ps} == {"a", "b", "c"}
+    assert b.flush(session) == 0
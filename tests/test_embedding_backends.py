@@ -0,0 +1,60 @@
+import pytest
+
+from orig_index import importer
+from orig_index.embedding_backends import (
+    backend_name,
+    embedding_dimension,
+    make_backend,
+)
+from orig_index.overly_simple_embedding import SimpleModel
+
+
+@pytest.fixture
+def env(monkeypatch):
+    for name in (
+        "EMBEDDING_BACKEND",
+        "EMBEDDING_DIMENSION",
+        "EMBED_SERVER",
+        "MODEL_NAME",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+
+def test_selection(env):
+    assert backend_name() == "sentence-transformers"
+    assert embedding_dimension() == 768
+
+    env.setenv("MODEL_NAME", "someone/something")
+    with pytest.raises(ValueError):
+        embedding_dimension()
+    env.setenv("EMBEDDING_DIMENSION", "384")
+    assert embedding_dimension() == 384
+
+    env.setenv("EMBEDDING_BACKEND", "nope")
+    with pytest.raises(ValueError):
+        backend_name()
+
+    env.setenv("MODEL_NAME", "simple")
+    assert backend_name() == "simple"
+
+
+def test_simple(env):
+    env.setenv("EMBEDDING_BACKEND", "simple")
+    env.setenv("EMBEDDING_DIMENSION", "16")
+    backend = make_backend()
+    assert isinstance(backend, SimpleModel)
+    assert backend.dimension == 16
+    assert backend.model_id == "simple-16"
+    assert backend.encode(["x = 1", "y = 2"]).shape == (2, 16)
+
+
+def test_get_model_checks_dimension(env):
+    env.setattr(importer, "MODEL", None)
+    env.setenv("EMBEDDING_BACKEND", "simple")
+    assert importer.get_model().dimension == 768
+
+    env.setattr(importer, "MODEL", None)
+    env.setenv("EMBEDDING_DIMENSION", "16")
+    with pytest.raises(ValueError):
+        importer.get_model()
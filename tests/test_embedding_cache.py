@@ -0,0 +1,82 @@
+import threading
+
+import numpy
+
+from orig_index.embedding_cache import CachedModel, EmbeddingCache, text_key
+from orig_index.overly_simple_embedding import SimpleModel
+
+
+class CountingModel:
+    def __init__(self):
+        self.model = SimpleModel(8)
+        self.seen = []
+
+    def encode(self, texts, **kwargs):
+        self.seen.extend(texts)
+        return self.model.encode(texts)
+
+
+def test_cached_model(tmp_path):
+    inner = CountingModel()
+    model = CachedModel(inner, EmbeddingCache(tmp_path, "test/model", 8))
+    first = model.encode(["x = 1", "y = 2", "x = 1"])
+    assert inner.seen == ["x = 1", "y = 2"]
+    assert first.shape == (3, 8)
+    numpy.testing.assert_allclose(first[0], first[2])
+
+    # A new process (well, object) on the same directory hits the cache
+    inner = CountingModel()
+    model = CachedModel(inner, EmbeddingCache(tmp_path, "test/model", 8))
+    second = model.encode(["y = 2", "z = 3"])
+    assert inner.seen == ["z = 3"]
+    numpy.testing.assert_allclose(second[0], first[1], rtol=1e-6)
+    assert model.encode("z = 3").shape == (8,)
+
+
+def test_eviction(tmp_path):
+    cache = EmbeddingCache(tmp_path, "m", 2, capacity=4)
+    keys = [text_key(str(i)) for i in range(6)]
+    cache.put_many(keys[:4], numpy.ones((4, 2)))
+    cache.get_many(keys[2:4])  # touch, so 0 and 1 are least recently used
+    cache.put_many(keys[4:], numpy.zeros((2, 2)))
+    assert len(cache) == 4
+    assert set(cache.get_many(keys)) == set(keys[2:])
+
+    # Reopening keeps the original capacity
+    assert EmbeddingCache(tmp_path, "m", 2, capacity=100).capacity == 4
+
+
+def test_shared_directory(tmp_path):
+    # Separate connections, as from separate processes
+    caches = [EmbeddingCache(tmp_path, "m", 2, capacity=1000) for _ in range(4)]
+    keys = [[text_key(f"{i}-{j}") for j in range(100)] for i in range(4)]
+
+    def put(i):
+        for j in range(0, 100, 10):
+            caches[i].put_many(keys[i][j : j + 10], numpy.full((10, 2), i))
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(caches[0]) == 400
+    for i in range(4):
+        found = caches[0].get_many(keys[i])
+        assert all((v == i).all() for v in found.values())
+
+    # Both missed the same key, and the other one cached it first
+    a, b = caches[:2]
+    allocate = a._allocate
+
+    def racing_allocate(n):
+        slots = allocate(n)
+        b.put_many(["same"], numpy.ones((1, 2)))
+        return slots
+
+    a._allocate = racing_allocate
+    a.put_many(["same"], numpy.zeros((1, 2)))
+    assert (a.get_many(["same"])["same"] == 1).all()
+    # And the slot a allocated is free to be used again
+    (slot,) = a.db.execute("SELECT slot FROM free_slot").fetchone()
+    assert slot not in a._slots(["same"]).values()
@@ -0,0 +1,257 @@
+import datetime
+from pathlib import PurePath
+
+import pytest
+
+from orig_index import importer, retry
+from orig_index.db import Base, File, FileInArchive, NormalizedFile, Snippet
+from orig_index.embedding import EmbeddingBatcher
+from orig_index.lookup import embed_snippets, find_snippet_matches, lookup_file
+from orig_index.metrics import METRICS
+from orig_index.overly_simple_embedding import SimpleModel
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+DATE = datetime.datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def session(monkeypatch):
+    # sqlite is close enough to exercise the importer's logic without postgres
+    monkeypatch.setattr(importer, "MODEL", SimpleModel(768))
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session
+
+
+def count(session, cls) -> int:
+    return session.scalar(select(func.count()).select_from(cls))
+
+
+def make_tree(tmp_path, n):
+    for i in range(n):
+        (tmp_path / f"mod{i}.py").write_text(f"def f{i}(x):\n    return x + {i}\n")
+    (tmp_path / "copy.py").write_text("def f0(x):\n    return x + 0\n")
+    (tmp_path / "doc.py").write_text('"""doc"""\ndef f0(x):\n    return x + 0\n')
+    (tmp_path / "empty.py").write_text("")
+    (tmp_path / "data.txt").write_text("not python")
+
+
+def import_dir(tmp_path, session, archive_hash, date=DATE):
+    embedder = EmbeddingBatcher(importer.get_model)
+    importer.import_local_dir(
+        archive_hash=archive_hash,
+        archive_url=f"https://example.com/{archive_hash}.tar.gz",
+        archive_date=date,
+        local_dir=tmp_path,
+        session=session,
+        project="example",
+        version="1.0",
+        embedder=embedder,
+    )
+    embedder.flush(session)
+    session.commit()
+
+
+def test_import_local_dir(tmp_path, session):
+    METRICS.reset()
+    make_tree(tmp_path, 3)
+    import_dir(tmp_path, session, "a")
+
+    # mod0 and copy are the same file, doc normalizes to the same thing
+    assert count(session, File) == 4
+    assert count(session, NormalizedFile) == 3
+    assert count(session, Snippet) == 3
+    # empty.py isn't recorded at all
+    assert count(session, FileInArchive) == 5
+    assert session.scalar(select(func.count()).where(Snippet.embedding.is_(None))) == 0
+
+    snap = METRICS.snapshot()
+    assert snap["tiers"]["archive"] == {"hits": 0, "misses": 1, "hit_rate": 0.0}
+    # Nothing was known beforehand, and empty.py isn't a hit either
+    assert snap["tiers"]["normalized"] == {"hits": 0, "misses": 3, "hit_rate": 0.0}
+    assert snap["tiers"]["snippet"]["misses"] == 3
+    assert {"parse", "encode", "insert", "lookup"} <= set(snap["stages"])
+
+
+def test_reimport_queries_do_not_scale_with_files(tmp_path, session):
+    make_tree(tmp_path, 50)
+    import_dir(tmp_path, session, "a")
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(session.get_bind(), "before_cursor_execute", listener)
+    import_dir(tmp_path, session, "b")
+    event.remove(session.get_bind(), "before_cursor_execute", listener)
+
+    selects = [s for s in statements if s.lstrip().startswith("SELECT")]
+    assert len(selects) <= 5
+    assert count(session, FileInArchive) == 2 * 52
+
+
+def test_first_seen(tmp_path, session):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "x.py").write_text("def f(x):\n    return x\n\ny = 1\n")
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "x.py").write_text("def f(x):\n    return x\n\ny = 2\n")
+
+    import_dir(tmp_path / "a", session, "new", datetime.datetime(2022, 1, 1))
+    import_dir(tmp_path / "b", session, "old", datetime.datetime(2021, 1, 1))
+    # Newer again, shouldn't change (or even write) anything
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(session.get_bind(), "before_cursor_execute", listener)
+    import_dir(tmp_path / "a", session, "newer", datetime.datetime(2023, 1, 1))
+    event.remove(session.get_bind(), "before_cursor_execute", listener)
+    assert not [s for s in statements if s.lstrip().startswith("UPDATE")]
+
+    first = dict(
+        session.execute(select(Snippet.text, Snippet.first_archive_hash)).all()
+    )
+    assert first == {"def f(x):\n    return x": "old", "y = 1": "new", "y = 2": "old"}
+    assert sorted(
+        session.execute(
+            select(NormalizedFile.first_archive_hash, NormalizedFile.first_seen)
+        ).all()
+    ) == [
+        ("new", datetime.datetime(2022, 1, 1)),
+        ("old", datetime.datetime(2021, 1, 1)),
+    ]
+
+
+def test_import_one_local_file(tmp_path, session):
+    p = tmp_path / "x.py"
+    p.write_text("def f(x):\n    pass\n\nx = 1\n")
+    f = importer.import_one_local_file(p, p, session)
+    session.commit()
+    assert [s.snippet.text for s in f.normalized.snippets] == [
+        "def f(x):\n    pass",
+        "x = 1",
+    ]
+    assert all(s.snippet.embedding is not None for s in f.normalized.snippets)
+
+    empty = tmp_path / "empty.py"
+    empty.write_text("\n")
+    assert importer.import_one_local_file(empty, empty, session) is None
+
+
+def test_lookup_file_writes_nothing(tmp_path, session):
+    make_tree(tmp_path, 2)
+    import_dir(tmp_path, session, "a")
+    tables = (File, NormalizedFile, Snippet)
+    before = [count(session, cls) for cls in tables]
+
+    same = lookup_file((tmp_path / "mod1.py").read_bytes(), session)
+    assert same.known_file and same.known_normalized
+
+    # Only differs in a way normalization removes
+    renormalized = lookup_file(
+        b'"""other doc"""\ndef f1(x):\n    return x + 1\n', session
+    )
+    assert not renormalized.known_file
+    assert renormalized.normalized_hash == same.normalized_hash
+
+    new = lookup_file(b"def f1(x):\n    return x + 1\n\ny = 2\n", session)
+    assert not new.known_normalized
+    assert [s.known for s in new.snippets] == [True, False]
+    embed_snippets(new.snippets, session)
+    stored = session.get(Snippet, new.snippets[0].hash).embedding
+    assert list(new.snippets[0].embedding) == list(stored)
+    assert new.snippets[1].embedding is not None
+
+    assert lookup_file(b"\n", session).normalized_hash is None
+    session.commit()
+    assert [count(session, cls) for cls in tables] == before
+
+
+class NoNeighbours:
+    def search(self, queries, k):
+        return [[] for _ in queries]
+
+
+def test_lookup_reports_verbatim_snippets(tmp_path, session):
+    make_tree(tmp_path, 2)
+    import_dir(tmp_path, session, "a")
+
+    looked_up = lookup_file(b"def f1(x):\n    return x + 1\n\ny = 2\n", session)
+    embed_snippets(looked_up.snippets, session)
+    known, new = looked_up.snippets
+    # Found without the nearest neighbour search
+    matches = find_snippet_matches(looked_up.snippets, session, backend=NoNeighbours())
+    assert [(m.archive_hash, m.sample_name, d) for m, d, _ in matches[known.hash]] == [
+        ("a", "mod1.py", 0.0)
+    ]
+    assert matches[known.hash][0][2].snippet_hash == known.hash
+    assert matches[new.hash] == []
+
+
+def test_import_members_retries(monkeypatch):
+    monkeypatch.setattr(importer, "MODEL", SimpleModel(768))
+    monkeypatch.setattr(retry.time, "sleep", lambda delay: None)
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(importer, "Session", sessionmaker(engine))
+
+    add_archive_members = importer.add_archive_members
+    calls = []
+
+    def flaky(**kwargs):
+        add_archive_members(**kwargs)
+        calls.append(len(kwargs["embedder"]))
+        if len(calls) == 1:
+            raise OperationalError("INSERT", {}, ConnectionError("gone"))
+
+    monkeypatch.setattr(importer, "add_archive_members", flaky)
+    embedder = EmbeddingBatcher(importer.get_model)
+    embedder.add("earlier", "x = 1")
+    importer.import_members(
+        "a",
+        "https://example.com/a.tar.gz",
+        DATE,
+        [(PurePath("mod.py"), b"def f(x):\n    return x + 1\n")],
+        "example",
+        "1.0",
+        embedder=embedder,
+    )
+    # Queued again by the second attempt, on top of what was there before
+    assert calls == [2, 2]
+    assert set(embedder.pending) >= {"earlier"}
+    with Session(engine) as session:
+        assert count(session, FileInArchive) == 1
+
+    monkeypatch.setattr(importer, "add_archive_members", add_archive_members)
+    with pytest.raises(SyntaxError):
+        importer.import_members(
+            "b", "b", DATE, [(PurePath("bad.py"), b"def")], "example", "1.0"
+        )
+
+
+def test_in_transaction_restores_pending_on_failure(monkeypatch):
+    monkeypatch.setattr(importer, "MODEL", SimpleModel(768))
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(importer, "Session", sessionmaker(engine))
+    with Session(engine) as session:
+        session.add_all(
+            [Snippet(hash="earlier", text="x = 1"), Snippet(hash="mine", text="y = 2")]
+        )
+        session.commit()
+
+    # Queued by an archive that was already committed
+    embedder = EmbeddingBatcher(importer.get_model)
+    embedder.add("earlier", "x = 1")
+
+    def work(session):
+        embedder.add("mine", "y = 2")
+        embedder.flush(session)
+        raise SyntaxError("py2")
+
+    with pytest.raises(SyntaxError):
+        importer.in_transaction(work, embedder)
+    # The flush was rolled back, so it's still to be done
+    assert embedder.pending == {"earlier": "x = 1"}
+    with Session(engine) as session:
+        assert session.get(Snippet, "earlier").embedding is None
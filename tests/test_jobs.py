@@ -0,0 +1,109 @@
+import asyncio
+import datetime
+
+import pytest
+
+from orig_index import jobs
+from orig_index.db import Base, Job
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+
+    def double(params, payload):
+        if params["n"] < 0:
+            raise ValueError("negative")
+        return {"n": params["n"] * 2, "payload": payload.decode()}
+
+    monkeypatch.setitem(jobs.HANDLERS, "double", double)
+    return sessionmaker(engine)
+
+
+def test_run_jobs(session_factory):
+    with session_factory() as session:
+        ok = jobs.enqueue(session, "double", {"n": 2}, b"x")
+        bad = jobs.enqueue(session, "double", {"n": -1}, b"x")
+        session.commit()
+        ids = ok.id, bad.id
+
+    assert jobs.run_one(session_factory)
+    assert jobs.run_one(session_factory)
+    assert not jobs.run_one(session_factory)
+
+    with session_factory() as session:
+        ok, bad = (session.get(Job, i) for i in ids)
+        assert ok.status == "done"
+        assert ok.result == {"n": 4, "payload": "x"}
+        assert ok.attempts == 1
+        assert ok.finished is not None
+        assert bad.status == "failed"
+        assert "ValueError: negative" in bad.error
+
+
+def test_unknown_kind(session_factory):
+    with session_factory() as session:
+        with pytest.raises(ValueError):
+            jobs.enqueue(session, "nope", {})
+
+
+def test_requeue_stale(session_factory):
+    long_ago = datetime.datetime(2020, 1, 1)
+    with session_factory() as session:
+        retry = Job(
+            kind="double", params={}, status="running", started=long_ago, attempts=1
+        )
+        give_up = Job(
+            kind="double",
+            params={},
+            status="running",
+            started=long_ago,
+            attempts=jobs.MAX_ATTEMPTS,
+        )
+        session.add_all([retry, give_up])
+        session.commit()
+        jobs.requeue_stale(session)
+        session.expire_all()
+        assert retry.status == "queued"
+        assert give_up.status == "failed"
+
+
+def test_web_retries_when_overloaded(monkeypatch):
+    from orig_index import web
+    from orig_index.offload import Overloaded
+
+    queued = [1, 2]
+    turned_away = []
+
+    class BusyOnce:
+        async def run(self, func):
+            if not turned_away:
+                turned_away.append(func)
+                raise Overloaded("busy")
+            return func()
+
+    def run_one():
+        return bool(queued and queued.pop())
+
+    monkeypatch.setattr(web, "OFFLOAD", BusyOnce())
+    monkeypatch.setattr(web, "JOB_RETRY_DELAY", 0)
+    monkeypatch.setattr(jobs, "run_one", run_one)
+    asyncio.run(web._run_job())
+    assert turned_away and queued == []
+
+
+def test_work_requeues_periodically(session_factory, monkeypatch):
+    calls = []
+    monkeypatch.setattr(jobs, "requeue_stale", calls.append)
+    monkeypatch.setattr(jobs, "REQUEUE_INTERVAL", 0)
+    with session_factory() as session:
+        for n in range(3):
+            jobs.enqueue(session, "double", {"n": n}, b"x")
+        session.commit()
+    jobs.work(session_factory, until_idle=True)
+    # Before each of the three jobs, and before finding there are no more
+    assert len(calls) == 4
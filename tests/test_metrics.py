@@ -0,0 +1,33 @@
+from orig_index.metrics import Metrics
+
+
+def test_snapshot():
+    m = Metrics()
+    m.add_time("parse", 1.5)
+    m.add_time("parse", 0.5)
+    with m.timer("insert"):
+        pass
+    m.tier("file", hits=3, misses=1)
+    m.tier("snippet", misses=2)
+    m.incr("snippet_rows", 2)
+
+    snap = m.snapshot()
+    assert snap["stages"]["parse"] == {"calls": 2, "seconds": 2.0}
+    assert snap["stages"]["insert"]["calls"] == 1
+    assert snap["tiers"]["file"]["hit_rate"] == 0.75
+    assert snap["tiers"]["snippet"]["hit_rate"] == 0.0
+    assert snap["counters"] == {"snippet_rows": 2}
+    assert "75.0%" in m.summary()
+
+    m.reset()
+    assert m.snapshot() == {"stages": {}, "tiers": {}, "counters": {}}
+
+
+def test_prometheus():
+    m = Metrics()
+    m.add_time("parse", 2.0)
+    m.tier("file", hits=3, misses=1)
+    text = m.to_prometheus()
+    assert 'orig_import_stage_seconds_total{stage="parse"} 2.0' in text
+    assert 'orig_import_lookups_total{tier="file",result="hit"} 3' in text
+    assert 'orig_import_lookups_total{tier="file",result="miss"} 1' in text
@@ -115,3 +115,9 @@ def test_only_string_stmt():
 #
 #
 # def test_split_basic(
+
+
+def test_async_funcdef_docstring_only():
+    assert "async def f():\n    pass" == ast.unparse(
+        normalize(ast.parse('async def f():\n    """doc"""'))
+    )
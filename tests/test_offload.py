@@ -0,0 +1,26 @@
+import asyncio
+import threading
+
+import pytest
+
+from orig_index.offload import BoundedExecutor, Overloaded
+
+
+def test_bounded():
+    release = threading.Event()
+
+    async def run():
+        executor = BoundedExecutor(workers=1, queue_depth=1)
+        running = [
+            asyncio.ensure_future(executor.run(release.wait)),
+            asyncio.ensure_future(executor.run(release.wait)),
+        ]
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await executor.run(release.wait)
+        release.set()
+        assert await asyncio.gather(*running) == [True, True]
+        assert await executor.run(lambda x: x + 1, 1) == 2
+        executor.shutdown()
+
+    asyncio.run(run())
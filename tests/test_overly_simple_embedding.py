@@ -1,3 +1,5 @@
+import numpy
+
 from orig_index.overly_simple_embedding import l2_distance, SimpleModel
 
 
@@ -15,3 +17,13 @@ def test_basic_embedding_functionality():
     )
     assert l2_distance(emb[0], emb[1]) < l2_distance(emb[0], emb[3])
     assert l2_distance(emb[1], emb[2]) < l2_distance(emb[0], emb[3])
+
+
+def test_batch_matches_single():
+    texts = ["x = 1", "def f(x):\n    return x + 1", "x = 1"]
+    emb = SimpleModel(16).encode(texts)
+    assert emb.shape == (3, 16)
+    for t, e in zip(texts, emb):
+        assert numpy.allclose(SimpleModel(16).encode(t), e)
+    assert numpy.allclose(numpy.linalg.norm(emb, axis=1), 1)
+    assert SimpleModel(16).encode([]).shape == (0, 16)
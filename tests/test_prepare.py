@@ -0,0 +1,33 @@
+import ast
+import hashlib
+from pathlib import Path
+
+from orig_index.norm import normalize
+from orig_index.prepare import make_executor, prepare_file
+from orig_index.split import segment
+
+TESTDATA = Path(__file__).parent.parent / "testdata"
+
+
+def test_prepare_file_matches_serial():
+    data = (TESTDATA / "a.py").read_bytes()
+    prepared = prepare_file(data)
+    mod = normalize(ast.parse(data))
+    assert prepared.hash == hashlib.sha256(data).hexdigest()
+    assert (
+        prepared.normalized_hash
+        == hashlib.sha256(ast.unparse(mod).encode("utf-8")).hexdigest()
+    )
+    assert prepared.segments == [t for a, b, t in segment(mod)]
+
+
+def test_make_executor():
+    assert make_executor(1) is None
+
+    datas = [(TESTDATA / "a.py").read_bytes(), (TESTDATA / "b.py").read_bytes()]
+    executor = make_executor(2)
+    try:
+        results = list(executor.map(prepare_file, datas))
+    finally:
+        executor.shutdown()
+    assert results == [prepare_file(d) for d in datas]
@@ -0,0 +1,66 @@
+import pytest
+import requests
+from orig_index import retry
+from orig_index.retry import is_transient, with_retries
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    delays = []
+    monkeypatch.setattr(retry.time, "sleep", delays.append)
+    return delays
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_is_transient():
+    assert is_transient(OperationalError("SELECT 1", {}, Exception("gone")))
+    assert is_transient(requests.ConnectionError())
+    assert is_transient(ConnectionResetError())
+    assert is_transient(http_error(503))
+    assert is_transient(http_error(429))
+    assert not is_transient(http_error(404))
+    assert not is_transient(IntegrityError("INSERT", {}, Exception("dupe")))
+    assert not is_transient(SyntaxError("py2"))
+
+
+def test_with_retries(no_sleep):
+    results = [ConnectionResetError(), requests.Timeout(), "ok"]
+    retried = []
+
+    def flaky():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert with_retries(flaky, on_retry=retried.append) == "ok"
+    assert [type(e) for e in retried] == [ConnectionResetError, requests.Timeout]
+    assert len(no_sleep) == 2
+    assert 0.5 <= no_sleep[0] <= 1.0 <= no_sleep[1] <= 2.0
+
+
+def test_with_retries_gives_up(no_sleep):
+    calls = []
+
+    def fail(e):
+        def inner():
+            calls.append(e)
+            raise e
+
+        return inner
+
+    with pytest.raises(ValueError):
+        with_retries(fail(ValueError()))
+    assert len(calls) == 1
+
+    calls.clear()
+    with pytest.raises(ConnectionResetError):
+        with_retries(fail(ConnectionResetError()), attempts=3)
+    assert len(calls) == 3
+    assert len(no_sleep) == 2
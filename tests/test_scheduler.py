@@ -0,0 +1,202 @@
+import datetime
+from pathlib import Path
+from unittest.mock import Mock
+
+import pytest
+
+from orig_index import retry, scheduler
+from orig_index.checkpoints import Checkpoints
+from orig_index.db import ArchiveCheckpoint, Base, ProjectCheckpoint
+from orig_index.scheduler import ImportScheduler, select_archives
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+DATE = datetime.datetime(2020, 1, 1, tzinfo=datetime.UTC)
+
+
+def dp(version, package_type="sdist", filename=None):
+    filename = filename or f"foo-{version}.tar.gz"
+    return Mock(
+        version=version,
+        package_type=package_type,
+        filename=filename,
+        url=f"https://example.com/{filename}",
+        digests={"sha256": f"hash-{filename}"},
+        upload_time=DATE,
+    )
+
+
+def test_select_archives():
+    pp = Mock(
+        packages=[
+            dp("1.0"),
+            dp("1.0", "wheel", "foo-1.0-py3-none-any.whl"),
+            dp("2.0", "wheel", "foo-2.0-py3-none-any.whl"),
+            dp("1.5", "wininst", "foo-1.5.exe"),
+        ]
+    )
+    tasks = select_archives(pp, "Foo", set(range(100)), 100)
+    assert [(t.project, t.version, t.url) for t in tasks] == [
+        ("foo", "2.0", "https://example.com/foo-2.0-py3-none-any.whl"),
+        ("foo", "1.0", "https://example.com/foo-1.0.tar.gz"),
+    ]
+    assert select_archives(pp, "foo", set(), 100) == []
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_scheduler_stops_project_on_failure(monkeypatch, tmp_path, stream):
+    pages = {
+        "foo": Mock(packages=[dp("3.0"), dp("2.0"), dp("1.0")]),
+        "bar": Mock(packages=[dp("1.0", filename="bar-1.0.tar.gz")]),
+    }
+    monkeypatch.setattr(
+        scheduler,
+        "PyPISimple",
+        lambda accept: Mock(get_project_page=lambda cn: pages[cn]),
+    )
+    monkeypatch.setattr(
+        scheduler, "have_hash", lambda h, attempts: h == "hash-foo-3.0.tar.gz"
+    )
+
+    def download_url(url, td):
+        p = Path(td, url.split("/")[-1])
+        p.write_bytes(b"")
+        return p, "hash-" + p.name
+
+    def fetch_members(url):
+        return "hash-" + url.split("/")[-1], []
+
+    imported = []
+
+    def import_archive(hash, url, date, local_file, project, version, **kwargs):
+        assert local_file.exists()
+        import_members(hash, url, date, [], project, version)
+
+    def import_members(hash, url, date, members, project, version, **kwargs):
+        imported.append(version if project == "foo" else url)
+        if version == "2.0":
+            raise SyntaxError("py2")
+
+    monkeypatch.setattr(scheduler, "download_url", download_url)
+    monkeypatch.setattr(scheduler, "fetch_members", fetch_members)
+    monkeypatch.setattr(scheduler, "import_archive", import_archive)
+    monkeypatch.setattr(scheduler, "import_members", import_members)
+
+    s = ImportScheduler(embedder=Mock(), downloads=1, queue_size=1, stream=stream)
+    s.run(["foo", "bar"], set(range(100)), 100)
+    assert imported == ["2.0", "https://example.com/bar-1.0.tar.gz"]
+    assert s.failed_projects == {"foo"}
+
+
+def test_scheduler_resumes(monkeypatch, tmp_path):
+    # A file, since checkpoints are written from several threads
+    engine = create_engine(f"sqlite:///{tmp_path / 'checkpoints.db'}")
+    Base.metadata.create_all(engine)
+    checkpoints = Checkpoints("0-99/100", sessionmaker(engine))
+    pages = {
+        "foo": Mock(packages=[dp("3.0"), dp("2.0"), dp("1.0")]),
+        "bar": Mock(packages=[dp("1.0", filename="bar-1.0.tar.gz")]),
+    }
+    monkeypatch.setattr(
+        scheduler,
+        "PyPISimple",
+        lambda accept: Mock(get_project_page=lambda cn: pages[cn]),
+    )
+    lookups = []
+
+    def have_hash(h, attempts):
+        lookups.append(attempts)
+        return h == "hash-foo-3.0.tar.gz"
+
+    monkeypatch.setattr(scheduler, "have_hash", have_hash)
+    monkeypatch.setattr(
+        scheduler, "fetch_members", lambda url: ("hash-" + url.split("/")[-1], [])
+    )
+    imported = []
+    errors = {"2.0": ConnectionResetError()}
+
+    def import_members(hash, url, date, members, project, version, **kwargs):
+        imported.append((project, version))
+        if version in errors:
+            raise errors.pop(version)
+
+    monkeypatch.setattr(scheduler, "import_members", import_members)
+
+    def run(resume):
+        imported.clear()
+        ImportScheduler(
+            embedder=Mock(),
+            downloads=1,
+            checkpoints=checkpoints,
+            resume=resume,
+            attempts=2,
+        ).run(["foo", "bar"], set(range(100)), 100)
+        with sessionmaker(engine)() as session:
+            return {
+                a.version if a.project == "foo" else a.project: a.status
+                for a in session.scalars(select(ArchiveCheckpoint))
+            }
+
+    # The connection error gives up on foo for this run only
+    assert run(resume=False) == {
+        "3.0": "done",
+        "2.0": "pending",
+        "1.0": "pending",
+        "bar": "done",
+    }
+    assert imported == [("foo", "2.0"), ("bar", "1.0")]
+    assert lookups and set(lookups) == {2}
+
+    # Project pages aren't needed to pick up where that left off, and reading
+    # checkpoints is retried like anything else
+    pages.clear()
+    pending = checkpoints.pending
+    blips = [OperationalError("SELECT", {}, ConnectionResetError())]
+
+    def flaky_pending(project):
+        if blips:
+            raise blips.pop()
+        return pending(project)
+
+    monkeypatch.setattr(checkpoints, "pending", flaky_pending)
+    monkeypatch.setattr(retry.time, "sleep", lambda delay: None)
+    errors["1.0"] = SyntaxError("py2")
+    assert run(resume=True) == {
+        "3.0": "done",
+        "2.0": "done",
+        "1.0": "failed",
+        "bar": "done",
+    }
+    assert imported == [("foo", "2.0"), ("foo", "1.0")]
+
+    assert run(resume=True)["1.0"] == "failed"
+    assert imported == []
+    with sessionmaker(engine)() as session:
+        assert "SyntaxError" in session.get(ProjectCheckpoint, "foo").failed
+
+
+def test_scheduler_rechecks_streamed_archives(monkeypatch):
+    monkeypatch.setattr(
+        scheduler,
+        "PyPISimple",
+        lambda accept: Mock(get_project_page=lambda cn: Mock(packages=[dp("1.0")])),
+    )
+    # Imported by someone else between queueing the download and importing it
+    lookups = []
+
+    def have_hash(h, attempts):
+        lookups.append(h)
+        return len(lookups) > 1
+
+    monkeypatch.setattr(scheduler, "have_hash", have_hash)
+    monkeypatch.setattr(
+        scheduler, "fetch_members", lambda url: ("hash-" + url.split("/")[-1], [])
+    )
+    imported = []
+    monkeypatch.setattr(
+        scheduler, "import_members", lambda *args, **kwargs: imported.append(args)
+    )
+    ImportScheduler(embedder=Mock(), downloads=1).run(["foo"], set(range(100)), 100)
+    assert lookups == ["hash-foo-1.0.tar.gz"] * 2
+    assert imported == []
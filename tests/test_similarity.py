@@ -0,0 +1,79 @@
+import pytest
+
+from orig_index.db import Snippet
+from orig_index.similarity import (
+    find_archives_containing_similar_snippets,
+    similar_snippets_statement,
+)
+from sqlalchemy.dialects import postgresql
+
+
+def make_snippet(h, value):
+    return Snippet(hash=h, text=h, embedding=[value] * 768)
+
+
+def compile_pg(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def test_statement_is_lateral():
+    sql = compile_pg(
+        similar_snippets_statement(
+            [make_snippet("a", 0.0), make_snippet("b", 1.0), make_snippet("a", 0.0)]
+        )
+    )
+    assert sql.count("JOIN LATERAL") == 2
+    # the nearest neighbour search only looks at the snippet table
+    assert "FROM snippet ORDER BY snippet.embedding <-> " in sql
+    # and a snippet that's indexed can match itself (its verbatim copies)
+    assert "!=" not in sql
+    # duplicate snippets are only queried once
+    assert sql.count("::VARCHAR") == 2
+
+
+class FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = 0
+
+    def execute(self, stmt):
+        self.calls += 1
+        return iter(self.rows)
+
+
+def test_grouped_by_snippet():
+    session = FakeSession(
+        [("a", "m1", 0.5, "n1"), ("a", "m2", 0.7, "n2"), ("a", "m3", 0.8, "n3")]
+    )
+    results = find_archives_containing_similar_snippets(
+        [make_snippet("a", 0.0), make_snippet("b", 1.0)], session
+    )
+    assert session.calls == 1
+    assert results == {"a": [("m1", 0.5, "n1"), ("m2", 0.7, "n2")], "b": []}
+
+    empty = FakeSession([])
+    assert find_archives_containing_similar_snippets([], empty) == {}
+    assert empty.calls == 0
+
+
+def test_ef_search_is_set_in_the_same_transaction():
+    session = FakeSession([])
+    find_archives_containing_similar_snippets(
+        [make_snippet("a", 0.0)], session, ef_search=100
+    )
+    assert session.calls == 2
+
+
+def test_quantized_statement_reranks():
+    sql = compile_pg(
+        similar_snippets_statement([make_snippet("a", 0.0)], quantization="binary")
+    )
+    assert sql.count("JOIN LATERAL") == 2
+    # the approximate search is nested in the exact one, and still correlated
+    assert "FROM LATERAL" in sql
+    assert sql.count("VALUES") == 1
+    assert "binary_quantize(snippet.embedding) AS BIT(768)) <~>" in sql
+    assert "approximate.embedding <-> " in sql
+
+    with pytest.raises(ValueError):
+        similar_snippets_statement([make_snippet("a", 0.0)], quantization="int3")
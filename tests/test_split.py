@@ -1,6 +1,9 @@
 import ast
+from pathlib import Path
 
-from orig_index.split import segment
+from orig_index.split import segment, unparse_and_segment
+
+TESTDATA = Path(__file__).parent.parent / "testdata"
 
 
 def test_basic_split():
@@ -23,3 +26,34 @@ def test_split_after():
     actual = list(segment(ast.parse("""def f():\n    pass\n\nimport foo""")))
     assert actual[0] == (0, 2, "def f():\n    pass")
     assert actual[1] == (2, 3, "import foo")
+
+
+def test_unparse_and_segment_matches_segment():
+    source = '''
+import os
+
+@decorator(1)
+@other
+def f(x):
+    return """a
+b"""
+
+class C:
+    x = 1
+
+    def method(self, y):
+        return f"{y!r}\\n" + """c
+  d"""
+
+    async def other(self):
+        pass
+
+if os.name:
+    def g():
+        def inner():
+            pass
+'''
+    for data in [source] + [p.read_bytes() for p in TESTDATA.glob("*.py")]:
+        mod = ast.parse(data)
+        expected = (ast.unparse(mod), list(segment(mod)))
+        assert unparse_and_segment(mod) == expected
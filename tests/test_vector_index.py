@@ -0,0 +1,107 @@
+import numpy
+import pytest
+
+from orig_index import vector_index
+from orig_index.db import Base, Snippet
+from orig_index.vector_index import LocalVectorIndex
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+
+def exact(vectors, queries, k):
+    d = ((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    return numpy.argsort(d, axis=1)[:, :k], numpy.sqrt(numpy.sort(d, axis=1)[:, :k])
+
+
+@pytest.fixture
+def data():
+    r = numpy.random.default_rng(0)
+    # Clustered, so that a few IVF lists are enough
+    centers = r.normal(size=(10, 8)) * 10
+    vectors = centers[r.integers(0, 10, 2000)] + r.normal(size=(2000, 8))
+    return vectors.astype(numpy.float32), [f"{i:064x}" for i in range(2000)]
+
+
+def test_brute_force(tmp_path, monkeypatch, data):
+    vectors, hashes = data
+    # Small chunks exercise merging top-k across chunks, and growth
+    monkeypatch.setattr(vector_index, "SCAN_CHUNK", 300)
+    monkeypatch.setattr(vector_index, "INITIAL_CAPACITY", 100)
+    index = LocalVectorIndex(tmp_path, 8)
+    assert index.add(hashes[:1500], vectors[:1500]) == 1500
+    assert index.add(hashes[1000:], vectors[1000:]) == 500
+    assert len(index) == 2000
+
+    expected_rows, expected_d = exact(vectors, vectors[:5], 3)
+    found = index.search(vectors[:5], 3)
+    assert [[h for h, _ in f] for f in found] == [
+        [hashes[i] for i in row] for row in expected_rows
+    ]
+    numpy.testing.assert_allclose(
+        [[d for _, d in f] for f in found], expected_d, atol=1e-3
+    )
+
+    # And it's all still there when reopened
+    reopened = LocalVectorIndex(tmp_path, 8)
+    assert len(reopened) == 2000
+    assert reopened.search(vectors[:5], 3) == index.search(vectors[:5], 3)
+    with pytest.raises(ValueError):
+        LocalVectorIndex(tmp_path, 16)
+
+
+def test_ivf(tmp_path, data):
+    vectors, hashes = data
+    index = LocalVectorIndex(tmp_path, 8, nprobe=2)
+    index.add(hashes, vectors)
+    index.train(nlist=10)
+    index.add(["new".ljust(64, "0")], vectors[:1] + 0.01)
+
+    expected_rows, _ = exact(vectors, vectors[100:150], 5)
+    # One at a time, since a batch this size would just scan everything
+    found = [index.search(q, 5)[0] for q in vectors[100:150]]
+    recall = numpy.mean(
+        [
+            len({h for h, _ in f} & {hashes[i] for i in row}) / 5
+            for f, row in zip(found, expected_rows)
+        ]
+    )
+    assert recall > 0.9
+    # Added after training, and still found in its list
+    assert index.search(vectors[:1] + 0.01, 1)[0][0][0].startswith("new")
+
+
+def test_train_is_capped(tmp_path, monkeypatch, data):
+    vectors, hashes = data
+    monkeypatch.setattr(vector_index, "KMEANS_MAX_SAMPLE", 500)
+    monkeypatch.setattr(vector_index, "MAX_NLIST", 20)
+    # Small blocks exercise assigning a chunk at a time
+    monkeypatch.setattr(vector_index, "SCAN_CHUNK", 2)
+    index = LocalVectorIndex(tmp_path, 8)
+    index.add(hashes, vectors)
+    index.train(nlist=100)
+    assert index.centroids.shape == (20, 8)
+    numpy.testing.assert_array_equal(
+        index.lists[:2000],
+        numpy.argmin(((vectors[:, None] - index.centroids[None]) ** 2).sum(2), 1),
+    )
+
+
+def test_refresh(tmp_path):
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            [
+                Snippet(hash="a" * 64, text="a", embedding=[1.0, 0.0]),
+                Snippet(hash="b" * 64, text="b", embedding=[0.0, 1.0]),
+                Snippet(hash="c" * 64, text="c", embedding=None),
+            ]
+        )
+        session.commit()
+
+        index = LocalVectorIndex(tmp_path, 2)
+        assert index.refresh(session, batch_size=1) == 2
+        assert index.refresh(session) == 0
+        assert index.search([[0.9, 0.1]], 1) == [
+            [("a" * 64, pytest.approx(0.1414, abs=1e-3))]
+        ]